@@ -0,0 +1,217 @@
+"""
+JSON Serialization Benchmark
+
+This script measures how long the list endpoints take to turn query results into a JSON response, apart from the
+queries themselves. Rows shaped like those of ``GET /customers``, ``GET /inventory/goods`` and
+``GET /sales-history/<username>`` are fetched from an in-memory SQLite table, then serialized three ways:
+
+- ``baseline``: a dict per row built by looking each column up by name (and ``strftime`` for sale times), encoded by
+  Flask's default provider, as the endpoints used to do.
+- ``stdlib``: dicts built by position with :func:`json_provider.records`, encoded by the services' provider with the
+  standard library encoder.
+- ``orjson``: the same with the orjson encoder, when it is installed.
+- ``positional``: no dicts at all; each object is written from its row tuple through a template of the sorted keys,
+  one column at a time, with the standard library's C string encoder. It shows what building the dicts costs: the
+  dicts are cheaper than encoding value by value in Python, so the services keep :func:`json_provider.records`.
+
+The median time of each, and its speed-up over the baseline, is printed as JSON.
+
+Usage::
+
+    python benchmarks/json_serialization.py --rows 100000 --repeat 5
+
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from functools import partial
+from datetime import datetime, timedelta
+from json.encoder import encode_basestring_ascii
+
+from flask import Flask, Response
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, create_engine, insert, select
+
+# The provider is the same file in every service
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sales'))
+from json_provider import JSONProvider, orjson, records  # noqa: E402
+
+metadata = MetaData()
+customers = Table(
+    'customer', metadata,
+    Column('username', String, primary_key=True), Column('full_name', String), Column('age', Integer),
+    Column('address', String), Column('gender', String), Column('marital_status', String), Column('wallet', Float),
+)
+goods = Table(
+    'inventory_item', metadata,
+    Column('id', Integer, primary_key=True), Column('name', String), Column('category', String), Column('price', Float),
+)
+sales = Table(
+    'sales', metadata,
+    Column('id', Integer, primary_key=True), Column('name', String), Column('price', Float), Column('time', DateTime),
+)
+
+# For each endpoint: the table, the response keys, the columns in the order they are queried, and the baseline
+# serialization of one row
+SHAPES = {
+    'customers': (customers, ('username', 'full_name', 'age', 'address', 'gender', 'marital_status', 'wallet'), None),
+    'goods': (goods, ('name', 'category', 'price'), None),
+    'sales_history': (sales, ('good', 'price', 'time'), ('name', 'price', 'time')),
+}
+
+
+def seed(connection, count):
+    """
+    Fills the tables with ``count`` rows each.
+
+    Args:
+        connection (Connection): Connection to the in-memory database.
+        count (int): Rows per table.
+    """
+    start = datetime(2024, 1, 1)
+    connection.execute(insert(customers), [
+        {'username': f'user{i:07d}', 'full_name': f'User {i}', 'age': 20 + i % 60, 'address': f'{i} Main St',
+         'gender': 'Other', 'marital_status': 'Single', 'wallet': i * 0.25} for i in range(count)
+    ])
+    connection.execute(insert(goods), [
+        {'id': i + 1, 'name': f'item{i}', 'category': 'food', 'price': 1 + i % 100 * 0.5} for i in range(count)
+    ])
+    connection.execute(insert(sales), [
+        {'id': i + 1, 'name': f'item{i % 500}', 'price': 1 + i % 100 * 0.5, 'time': start + timedelta(seconds=i)}
+        for i in range(count)
+    ])
+
+
+def baseline_document(name, rows):
+    """Builds the response document the way the endpoints did before rows were serialized by position."""
+    if name == 'customers':
+        fields = SHAPES[name][1]
+        return [{field: row._mapping[field] for field in fields} for row in rows]
+    if name == 'goods':
+        fields = SHAPES[name][1]
+        return {'Inventory': [{field: row._mapping[field] for field in fields} for row in rows], 'next_cursor': None}
+    return {
+        'sales_history': [
+            {'good': sale.name, 'price': sale.price, 'time': sale.time.strftime('%Y-%m-%d %H:%M:%S')} for sale in rows
+        ],
+        'next_cursor': None,
+    }
+
+
+def records_document(name, rows):
+    """Builds the response document from rows serialized by position, as the endpoints do now."""
+    document = records(SHAPES[name][1], rows)
+    if name == 'customers':
+        return document
+    return {'Inventory' if name == 'goods' else 'sales_history': document, 'next_cursor': None}
+
+
+def provider_response(provider, build, name, rows):
+    """Builds the response document from the rows with ``build``, then encodes it with a JSON provider."""
+    return provider.response(build(name, rows))
+
+
+# Encoders of the values of each type, as the standard library writes them
+VALUE_ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: float.__repr__,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+    datetime: lambda value: f'"{value.isoformat(sep=" ", timespec="seconds")}"',
+}
+
+
+def positional_response(name, rows):
+    """Builds the response by writing each object from its row tuple, without a dict per row."""
+    fields = SHAPES[name][1]
+    order = sorted(range(len(fields)), key=fields.__getitem__)
+    template = '{' + ','.join(f'{json.dumps(fields[index])}:%s' for index in order) + '}'
+    columns = list(zip(*rows)) or [()] * len(fields)
+    encoded = []
+    for index in order:
+        column = columns[index]
+        types = set(map(type, column))
+        if len(types) == 1:
+            encoded.append(map(VALUE_ENCODERS[types.pop()], column))
+        else:
+            encoded.append([VALUE_ENCODERS[type(value)](value) for value in column])
+    document = '[' + ','.join([template % values for values in zip(*encoded)]) + ']'
+    if name == 'goods':
+        document = '{"Inventory":%s,"next_cursor":null}' % document
+    elif name == 'sales_history':
+        document = '{"next_cursor":null,"sales_history":%s}' % document
+    return Response(document.encode() + b'\n', mimetype='application/json')
+
+
+def measure(app, respond, name, rows, repeat):
+    """
+    Times building and encoding one response.
+
+    Args:
+        app (Flask): App the response is built for.
+        respond (callable): Function building the response from the endpoint shape and the rows.
+        name (str): Endpoint shape.
+        rows (list): The query results.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        tuple: The median time in milliseconds and the body size in bytes.
+    """
+    timings = []
+    size = 0
+    with app.app_context():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = respond(name, rows)
+            timings.append(time.perf_counter() - start)
+            size = len(response.get_data())
+    return round(statistics.median(timings) * 1000, 1), size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks JSON serialization of large list responses.')
+    parser.add_argument('--rows', type=int, default=100000, help='rows per response (default: 100000)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each case (default: 5)')
+    parser.add_argument('--output', help='file to write the JSON report to (default: standard output)')
+    args = parser.parse_args(argv)
+
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        seed(connection, args.rows)
+
+    app = Flask(__name__)
+    cases = {
+        'baseline': partial(provider_response, DefaultJSONProvider(app), baseline_document),
+        'stdlib': partial(provider_response, JSONProvider(app, 'stdlib'), records_document),
+    }
+    if orjson is not None:
+        cases['orjson'] = partial(provider_response, JSONProvider(app, 'orjson'), records_document)
+    cases['positional'] = positional_response
+
+    results = {}
+    with engine.connect() as connection:
+        for name, (table, fields, columns) in SHAPES.items():
+            rows = connection.execute(select(*[table.c[column] for column in columns or fields])).all()
+            results[name] = {}
+            for case, respond in cases.items():
+                median_ms, size = measure(app, respond, name, rows, args.repeat)
+                results[name][case] = {'median_ms': median_ms, 'bytes': size}
+            for case in cases:
+                results[name][case]['speedup'] = round(results[name]['baseline']['median_ms'] / results[name][case]['median_ms'], 2)
+
+    report = {'rows': args.rows, 'repeat': args.repeat, 'orjson': orjson.__version__ if orjson else None, 'results': results}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+"""
+Load Test
+
+This script benchmarks the sale path end to end. It starts the three services under Gunicorn on free local ports,
+each on its own SQLite file in a temporary directory, seeds them with customers and items through the import
+endpoints, then drives a weighted mix of requests from concurrent clients:
+
+- ``sale``: ``POST /sale`` for a random customer and item.
+- ``goods``: ``GET /inventory/goods``, one page of the catalog.
+- ``customers``: ``GET /customers``, one page of customers.
+- ``sales_history``: ``GET /sales-history/<username>`` for a random customer.
+
+It reports the throughput and the p50/p95/p99 latency of each endpoint as JSON. Passing the JSON of an earlier run
+with ``--baseline`` adds the relative change of every figure, so two commits can be compared on the same machine.
+
+Usage::
+
+    python benchmarks/load_test.py --customers 1000 --items 200 --concurrency 16 --duration 30 --output run.json
+    python benchmarks/load_test.py --baseline run.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.security import generate_password_hash
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SERVICES = ('customers', 'inventory', 'sales')
+
+#: Default share of each endpoint in the request mix.
+DEFAULT_MIX = {'sale': 4, 'goods': 2, 'customers': 1, 'sales_history': 3}
+PERCENTILES = (50, 95, 99)
+
+
+def free_port():
+    """
+    Finds a local TCP port that is not in use.
+
+    Returns:
+        int: The port number.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_services(workdir, workers, threads):
+    """
+    Starts every service under Gunicorn, each on its own SQLite file in ``workdir``.
+
+    Args:
+        workdir (str): Directory holding the databases and the server logs.
+        workers (int): Gunicorn worker processes per service.
+        threads (int): Threads per worker.
+
+    Returns:
+        tuple: The base URL of each service by name, and the started processes.
+    """
+    urls = {name: f'http://127.0.0.1:{free_port()}' for name in SERVICES}
+    processes = []
+    for name in SERVICES:
+        env = dict(
+            os.environ,
+            DATABASE_URL=f'sqlite:///{os.path.join(workdir, name + ".db")}',
+            GUNICORN_BIND=urls[name].split('//')[1],
+            GUNICORN_WORKERS=str(workers),
+            GUNICORN_THREADS=str(threads),
+            METRICS_DIR='',
+            CUSTOMER_SERVICE_URL=urls['customers'],
+            INVENTORY_SERVICE_URL=urls['inventory'],
+            SALES_SERVICE_URL=urls['sales'],
+        )
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate'], cwd=os.path.join(ROOT, name), env=env,
+                       check=True, stdout=subprocess.DEVNULL)
+        log = open(os.path.join(workdir, f'{name}.log'), 'w')
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py'],
+            cwd=os.path.join(ROOT, name), env=env, stdout=log, stderr=subprocess.STDOUT,
+        ))
+    return urls, processes
+
+
+def wait_until_ready(urls, processes, timeout=60):
+    """
+    Waits until every service answers on its home endpoint.
+
+    Args:
+        urls (dict): The base URL of each service.
+        processes (list): The service processes, checked for early exits.
+        timeout (float): Seconds to wait in total.
+
+    Raises:
+        RuntimeError: If a service exits or does not answer in time.
+    """
+    deadline = time.monotonic() + timeout
+    pending = dict(urls)
+    while pending:
+        if any(process.poll() is not None for process in processes):
+            raise RuntimeError('A service exited during startup, see its log in the work directory')
+        for name, url in list(pending.items()):
+            try:
+                if requests.get(f'{url}/', timeout=1).status_code == 200:
+                    del pending[name]
+            except requests.exceptions.RequestException:
+                pass
+        if pending and time.monotonic() > deadline:
+            raise RuntimeError(f'Services not ready after {timeout}s: {", ".join(pending)}')
+        time.sleep(0.2)
+
+
+def stop_services(processes):
+    """
+    Shuts the services down gracefully, killing the ones that do not exit.
+
+    Args:
+        processes (list): The service processes.
+    """
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    for process in processes:
+        try:
+            process.wait(timeout=35)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def seed(urls, customers, items, stock):
+    """
+    Imports the benchmark customers and items.
+
+    All customers share one precomputed password hash, so seeding does not spend its time hashing, and have a
+    wallet large enough for every sale of the run.
+
+    Args:
+        urls (dict): The base URL of each service.
+        customers (int): Number of customers to create.
+        items (int): Number of items to create.
+        stock (int): Stock of each item.
+
+    Returns:
+        tuple: The usernames and the item names.
+    """
+    password_hash = generate_password_hash('benchmark', method='pbkdf2:sha256:1000')
+    usernames = [f'bench_user_{i}' for i in range(customers)]
+    body = '\n'.join(json.dumps({
+        'username': username, 'full_name': f'Benchmark User {i}', 'password_hash': password_hash, 'age': 30,
+        'address': f'{i} Benchmark St', 'gender': 'Other', 'marital_status': 'Single', 'wallet': 1e9,
+    }) for i, username in enumerate(usernames))
+    response = requests.post(f'{urls["customers"]}/customers/import', data=body.encode(), headers={'Content-Type': 'application/x-ndjson'})
+    response.raise_for_status()
+    if response.json()['imported'] != customers:
+        raise RuntimeError(f'Customer seeding failed: {response.json()}')
+
+    names = [f'bench_item_{i}' for i in range(items)]
+    body = '\n'.join(json.dumps({
+        'name': name, 'category': ('food', 'clothes', 'accessories', 'electronics')[i % 4],
+        'price': round(1 + i % 100 * 0.5, 2), 'description': 'Benchmark item', 'stock_count': stock,
+    }) for i, name in enumerate(names))
+    response = requests.post(f'{urls["inventory"]}/inventory/import', data=body.encode(), headers={'Content-Type': 'application/x-ndjson'})
+    response.raise_for_status()
+    if response.json()['inserted'] != items:
+        raise RuntimeError(f'Item seeding failed: {response.json()}')
+    return usernames, names
+
+
+class LoadGenerator:
+    """
+    Sends a weighted mix of requests from concurrent clients and records the latency of each.
+
+    Attributes:
+        urls (dict): The base URL of each service.
+        usernames (list): Customers to buy as and to read the history of.
+        names (list): Items to buy.
+        mix (dict): Relative weight of each endpoint.
+        samples (dict): Latencies in seconds of the successful requests, by endpoint.
+        errors (dict): Number of failed requests (transport errors and 5xx) by endpoint.
+        statuses (dict): Number of responses by endpoint and status code.
+    """
+
+    def __init__(self, urls, usernames, names, mix, seed=None):
+        self.urls = urls
+        self.usernames = usernames
+        self.names = names
+        self.mix = mix
+        self.samples = {endpoint: [] for endpoint in mix}
+        self.errors = {endpoint: 0 for endpoint in mix}
+        self.statuses = {endpoint: {} for endpoint in mix}
+        self._seed = seed
+        self._lock = threading.Lock()
+        self._budget = 0
+
+    def build_request(self, endpoint, rng):
+        """
+        Builds a random request for an endpoint.
+
+        Args:
+            endpoint (str): One of the keys of :data:`DEFAULT_MIX`.
+            rng (random.Random): Random source of the calling client.
+
+        Returns:
+            tuple: The HTTP method, the URL and the JSON body (or None).
+        """
+        if endpoint == 'sale':
+            return 'POST', f'{self.urls["sales"]}/sale', {'name': rng.choice(self.names), 'customer_user': rng.choice(self.usernames)}
+        if endpoint == 'goods':
+            return 'GET', f'{self.urls["inventory"]}/inventory/goods?limit=100', None
+        if endpoint == 'customers':
+            return 'GET', f'{self.urls["customers"]}/customers?limit=100', None
+        return 'GET', f'{self.urls["sales"]}/sales-history/{rng.choice(self.usernames)}?limit=100', None
+
+    def run_client(self, index, deadline, max_requests):
+        """
+        Sends requests from one client until the deadline or the request budget is reached.
+
+        Args:
+            index (int): Client number, used to derive its random seed.
+            deadline (float): ``time.monotonic()`` value at which to stop.
+            max_requests (int): Total requests to send across all clients, or 0 for no limit.
+        """
+        rng = random.Random(None if self._seed is None else self._seed + index)
+        session = requests.Session()
+        endpoints, weights = list(self.mix), list(self.mix.values())
+        while time.monotonic() < deadline:
+            if max_requests:
+                with self._lock:
+                    if self._budget <= 0:
+                        return
+                    self._budget -= 1
+            endpoint = rng.choices(endpoints, weights)[0]
+            method, url, body = self.build_request(endpoint, rng)
+            start = time.perf_counter()
+            try:
+                response = session.request(method, url, json=body, timeout=30)
+                status = response.status_code
+            except requests.exceptions.RequestException:
+                status = None
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                key = str(status) if status is not None else 'error'
+                self.statuses[endpoint][key] = self.statuses[endpoint].get(key, 0) + 1
+                if status is None or status >= 500:
+                    self.errors[endpoint] += 1
+                else:
+                    self.samples[endpoint].append(elapsed)
+
+    def run(self, concurrency, duration, max_requests=0):
+        """
+        Runs the clients and waits for them.
+
+        Args:
+            concurrency (int): Number of concurrent clients.
+            duration (float): Seconds to run for.
+            max_requests (int): Stop after this many requests in total; 0 for no limit.
+
+        Returns:
+            float: The wall-clock seconds the run took.
+        """
+        self._budget = max_requests
+        start = time.monotonic()
+        deadline = start + duration
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(self.run_client, index, deadline, max_requests) for index in range(concurrency)]:
+                future.result()
+        return time.monotonic() - start
+
+
+def percentile(sorted_values, percent):
+    """
+    Computes a percentile with linear interpolation between the closest ranks.
+
+    Args:
+        sorted_values (list): The values, in ascending order.
+        percent (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * percent / 100
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def summarize(samples, errors, statuses, elapsed):
+    """
+    Summarizes the latencies of one endpoint, or of all of them.
+
+    Args:
+        samples (list): Latencies in seconds of the successful requests.
+        errors (int): Number of failed requests.
+        statuses (dict): Number of responses by status code.
+        elapsed (float): Length of the run in seconds.
+
+    Returns:
+        dict: Request and error counts, throughput in requests per second and latencies in milliseconds.
+    """
+    values = sorted(samples)
+    summary = {
+        'requests': len(values) + errors,
+        'errors': errors,
+        'statuses': dict(sorted(statuses.items())),
+        'throughput_rps': round(len(values) / elapsed, 2) if elapsed else 0.0,
+        'latency_mean_ms': round(sum(values) / len(values) * 1000, 3) if values else None,
+    }
+    for percent in PERCENTILES:
+        value = percentile(values, percent)
+        summary[f'latency_p{percent}_ms'] = round(value * 1000, 3) if value is not None else None
+    summary['latency_max_ms'] = round(values[-1] * 1000, 3) if values else None
+    return summary
+
+
+def compare(report, baseline):
+    """
+    Computes the relative change of every figure between a baseline run and this one.
+
+    Args:
+        report (dict): The report of this run.
+        baseline (dict): The report of an earlier run.
+
+    Returns:
+        dict: For each endpoint and ``total``, the change of each throughput and latency figure in percent.
+    """
+    changes = {}
+    for endpoint, summary in report['results'].items():
+        before = baseline.get('results', {}).get(endpoint)
+        if before is None:
+            continue
+        changes[endpoint] = {
+            key: round((summary[key] - before[key]) / before[key] * 100, 1)
+            for key in summary
+            if (key == 'throughput_rps' or key.startswith('latency_'))
+            and isinstance(summary[key], (int, float)) and before.get(key)
+        }
+    return changes
+
+
+def git_commit():
+    """Returns the commit of the working tree being benchmarked, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(value):
+    """
+    Parses a request mix such as ``sale=4,goods=2``.
+
+    Args:
+        value (str): Comma-separated ``endpoint=weight`` pairs.
+
+    Returns:
+        dict: The weight of each endpoint.
+
+    Raises:
+        argparse.ArgumentTypeError: If an endpoint is unknown or a weight is not a positive number.
+    """
+    mix = {}
+    for pair in value.split(','):
+        endpoint, _, weight = pair.partition('=')
+        if endpoint not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'Unknown endpoint {endpoint!r}, choose from {", ".join(DEFAULT_MIX)}')
+        try:
+            mix[endpoint] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Invalid weight for {endpoint}: {weight!r}')
+        if mix[endpoint] <= 0:
+            raise argparse.ArgumentTypeError(f'Weight of {endpoint} must be positive')
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the sale path of the three services under concurrent load.')
+    parser.add_argument('--customers', type=int, default=1000, help='customers to seed (default: 1000)')
+    parser.add_argument('--items', type=int, default=200, help='items to seed (default: 200)')
+    parser.add_argument('--stock', type=int, default=1000000, help='initial stock of each item (default: 1000000)')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients (default: 16)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of measured load (default: 30)')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many measured requests (default: no limit)')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of unmeasured load first (default: 5)')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='endpoint weights, e.g. sale=4,goods=2,customers=1,sales_history=3')
+    parser.add_argument('--workers', type=int, default=2, help='Gunicorn workers per service (default: 2)')
+    parser.add_argument('--threads', type=int, default=4, help='threads per Gunicorn worker (default: 4)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed, for a repeatable request sequence')
+    parser.add_argument('--output', help='file to write the JSON report to (default: standard output)')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory with the databases and server logs')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='load-test-')
+    urls, processes = start_services(workdir, args.workers, args.threads)
+    try:
+        wait_until_ready(urls, processes)
+        print(f'Seeding {args.customers} customers and {args.items} items...', file=sys.stderr)
+        usernames, names = seed(urls, args.customers, args.items, args.stock)
+
+        if args.warmup > 0:
+            print(f'Warming up for {args.warmup}s...', file=sys.stderr)
+            LoadGenerator(urls, usernames, names, args.mix, args.seed).run(args.concurrency, args.warmup)
+
+        print(f'Running {args.concurrency} clients for {args.duration}s...', file=sys.stderr)
+        generator = LoadGenerator(urls, usernames, names, args.mix, args.seed)
+        elapsed = generator.run(args.concurrency, args.duration, args.requests)
+    finally:
+        stop_services(processes)
+        if args.keep:
+            print(f'Work directory kept in {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        endpoint: summarize(generator.samples[endpoint], generator.errors[endpoint], generator.statuses[endpoint], elapsed)
+        for endpoint in args.mix
+    }
+    all_statuses = {}
+    for statuses in generator.statuses.values():
+        for status, count in statuses.items():
+            all_statuses[status] = all_statuses.get(status, 0) + count
+    results['total'] = summarize(
+        [sample for samples in generator.samples.values() for sample in samples],
+        sum(generator.errors.values()), all_statuses, elapsed,
+    )
+
+    report = {
+        'commit': git_commit(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - elapsed)),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'config': {
+            'customers': args.customers, 'items': args.items, 'stock': args.stock, 'concurrency': args.concurrency,
+            'duration': args.duration, 'requests': args.requests, 'warmup': args.warmup, 'mix': args.mix,
+            'workers': args.workers, 'threads': args.threads, 'seed': args.seed,
+        },
+        'elapsed_s': round(elapsed, 3),
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)
+        report['baseline'] = {'commit': baseline.get('commit'), 'change_percent': compare(report, baseline)}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
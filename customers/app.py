@@ -1,18 +1,46 @@
-from flask import Flask, jsonify, request
-from flask_sqlalchemy import SQLAlchemy
+from flask import Blueprint, Flask, Response, current_app, jsonify, request, stream_with_context
+from sqlalchemy import insert, update
 from sqlalchemy.exc import IntegrityError
-from werkzeug.security import generate_password_hash
+import click
+import contextlib
+import csv
+import io
+import json
 import os
-
-app = Flask(__name__)
+import re
+import sys
+
+from db_config import configure_engine, database_url, db, engine_options
+from hashing import PasswordHasher
+from idempotency import idempotent, purge_idempotency_records
+from json_provider import JSONProvider, records
+from metrics import Metrics
+from request_body import open_request_text
+from startup import StartupTimer, measure_cold_start
+from versions import bump_version, conditional, ensure_versions
+
+# Routes and commands of the service, registered on each app built by create_app
+bp = Blueprint('customers', __name__, cli_group=None)
+
+# Listing configuration
+CUSTOMER_FIELDS = ('username', 'full_name', 'age', 'address', 'gender', 'marital_status', 'wallet')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+
+# Registration configuration
+REGISTRATION_FIELDS = ('username', 'full_name', 'password', 'age', 'address', 'gender', 'marital_status')
+MAX_BULK_REGISTRATION = int(os.environ.get('MAX_BULK_REGISTRATION', 5000))
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+MAX_IMPORT_ERRORS = 1000
+PASSWORD_HASH_PATTERN = re.compile(r'(scrypt|pbkdf2):[^$]+\$[^$]+\$[0-9a-f]+')
+password_hasher = PasswordHasher()
 
 # Database Configuration
 base_dir = os.path.abspath(os.path.dirname(__file__))
 # db_path = os.path.join(base_dir, '..', 'db', 'database.db')
 db_path = os.path.join(base_dir, 'database.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+metrics = Metrics()
 
 # Customer Model
 class Customer(db.Model):
@@ -32,7 +60,7 @@ class Customer(db.Model):
     """
     username = db.Column(db.String(80), primary_key=True, unique=True)
     full_name = db.Column(db.String(150), nullable=False)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(256))
     age = db.Column(db.Integer)
     address = db.Column(db.String(200))
     gender = db.Column(db.String(50))
@@ -40,24 +68,120 @@ class Customer(db.Model):
     wallet = db.Column(db.Float, default=0.0)
 
     def set_password(self, password):
-        """Sets the password of the customer."""
-        self.password_hash = generate_password_hash(password)
+        """Sets the password of the customer, hashed on the password hashing pool."""
+        self.password_hash = password_hasher.hash(password)
 
     def __repr__(self):
         """Returns the string representation of the customer."""
         return f'<Customer {self.username}>'
 
-# Create the database tables
-with app.app_context():
+@bp.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys():
+    """Deletes expired idempotency records. They are also purged periodically while the service handles requests."""
+    print(f'{purge_idempotency_records()} expired idempotency records deleted')
+
+def debit_wallet(username, amount):
+    """
+    Atomically deducts an amount from a customer's wallet if the balance covers it.
+
+    Args:
+        username (str): The username of the customer to debit.
+        amount (float): The amount to deduct.
+
+    Returns:
+        float: The new balance, or None if the customer does not exist or has insufficient funds.
+    """
+    result = db.session.execute(
+        update(Customer)
+        .where(Customer.username == username, Customer.wallet >= amount)
+        .values(wallet=Customer.wallet - amount)
+        .returning(Customer.wallet)
+    )
+    new_balance = result.scalar()
+    if new_balance is None:
+        db.session.rollback()
+        return None
+    bump_version('customer')
+    db.session.commit()
+    return new_balance
+
+def credit_wallet(username, amount):
+    """
+    Atomically adds an amount to a customer's wallet.
+
+    The balance is updated in SQL rather than read and written back, so a refund never overwrites a debit running
+    at the same time.
+
+    Args:
+        username (str): The username of the customer to credit.
+        amount (float): The amount to add.
+
+    Returns:
+        float: The new balance, or None if the customer does not exist.
+    """
+    result = db.session.execute(
+        update(Customer)
+        .where(Customer.username == username)
+        .values(wallet=Customer.wallet + amount)
+        .returning(Customer.wallet)
+    )
+    new_balance = result.scalar()
+    if new_balance is None:
+        db.session.rollback()
+        return None
+    bump_version('customer')
+    db.session.commit()
+    return new_balance
+
+def migrate():
+    """Creates the tables and version rows that do not exist yet. Existing data is left untouched."""
     db.create_all()
+    ensure_versions('customer')
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Creates or upgrades the database schema. Run it once per deploy, before the workers start."""
+    migrate()
+    print('Database schema is up to date')
 
 # Routes
-@app.route('/')
+@bp.route('/')
 def home():
     """Returns a welcome message."""
     return "Welcome to the Customer Service API!"
 
-@app.route('/register', methods=['POST'])
+def parse_registration(data, require_password=True):
+    """
+    Validates the details of a customer to register.
+
+    Args:
+        data (dict): The registration details, including the plain-text password.
+        require_password (bool): Whether the plain-text password is required, i.e. not supplied already hashed.
+
+    Returns:
+        tuple: ``(customer column values without the password hash, None)``, or ``(None, error message)``.
+    """
+    required = REGISTRATION_FIELDS if require_password else tuple(field for field in REGISTRATION_FIELDS if field != 'password')
+    if not isinstance(data, dict) or any(data.get(field) is None for field in required):
+        return None, 'All fields are required'
+
+    try:
+        age = int(data['age'])
+    except (TypeError, ValueError):
+        return None, 'Invalid age'
+    if age < 0:
+        return None, 'Age cannot be negative'
+
+    return {
+        'username': data['username'],
+        'full_name': data['full_name'],
+        'age': age,
+        'address': data['address'],
+        'gender': data['gender'],
+        'marital_status': data['marital_status'],
+    }, None
+
+@bp.route('/register', methods=['POST'])
 def register_customer():
     """
     Registers a new customer.
@@ -66,28 +190,15 @@ def register_customer():
     Validates the required fields and age before creating the customer.
     """
     data = request.json
-    required_fields = ['username', 'full_name', 'password', 'age', 'address', 'gender', 'marital_status']
-    if not all(field in data for field in required_fields):
-        return jsonify({'error': 'All fields are required'}), 400
+    values, error = parse_registration(data)
+    if error:
+        return jsonify({'error': error}), 400
 
     try:
-        age = int(data['age'])
-        if age < 0:
-            return jsonify({'error': 'Age cannot be negative'}), 400
-    except ValueError:
-        return jsonify({'error': 'Invalid age'}), 400
-
-    try:
-        new_customer = Customer(
-            username=data['username'],
-            full_name=data['full_name'],
-            age=age,
-            address=data['address'],
-            gender=data['gender'],
-            marital_status=data['marital_status']
-        )
+        new_customer = Customer(**values)
         new_customer.set_password(data['password'])
         db.session.add(new_customer)
+        bump_version('customer')
         db.session.commit()
     except IntegrityError:
         db.session.rollback()  # Rollback to save the session state
@@ -95,7 +206,229 @@ def register_customer():
 
     return jsonify({'message': 'Customer registered successfully'}), 201
 
-@app.route('/delete/<username>', methods=['DELETE'])
+@bp.route('/register/bulk', methods=['POST'])
+def register_customers_bulk():
+    """
+    Registers many customers in one request.
+
+    Expects a JSON body of the form ``{"customers": [{...}, ...]}`` with the same fields as ``/register``. Every
+    customer is validated first and the usernames are checked against the database in one query; the passwords of
+    the valid customers are then hashed in parallel on the password hashing pool and the customers are inserted in
+    one batch. Invalid customers are reported and skipped without failing the others.
+
+    Returns:
+        JSON: The number of customers registered and the errors of the ones that were not.
+    """
+    customers = (request.get_json(silent=True) or {}).get('customers')
+    if not isinstance(customers, list) or not customers:
+        return jsonify({'error': 'Invalid input data'}), 400
+    if len(customers) > MAX_BULK_REGISTRATION:
+        return jsonify({'error': f'At most {MAX_BULK_REGISTRATION} customers can be registered at once'}), 400
+
+    errors = []
+    valid = []
+    for index, data in enumerate(customers):
+        values, error = parse_registration(data)
+        if error:
+            errors.append({'index': index, 'username': data.get('username') if isinstance(data, dict) else None, 'error': error})
+        else:
+            valid.append((index, values, data['password']))
+
+    usernames = [values['username'] for _, values, _ in valid]
+    taken = {username for (username,) in db.session.query(Customer.username).filter(Customer.username.in_(usernames))}
+    rows = []
+    passwords = []
+    for index, values, password in valid:
+        if values['username'] in taken:
+            errors.append({'index': index, 'username': values['username'], 'error': 'Username already exists'})
+            continue
+        taken.add(values['username'])
+        rows.append(values)
+        passwords.append(password)
+
+    if rows:
+        for values, password_hash in zip(rows, password_hasher.hash_many(passwords)):
+            values['password_hash'] = password_hash
+        try:
+            db.session.execute(insert(Customer), rows)
+            bump_version('customer')
+            db.session.commit()
+        except IntegrityError:
+            # A customer with one of the usernames was registered concurrently
+            db.session.rollback()
+            return jsonify({'error': 'Username already exists'}), 409
+
+    errors.sort(key=lambda error: error['index'])
+    return jsonify({'message': f'{len(rows)} customers registered', 'registered': len(rows), 'failed': len(errors), 'errors': errors}), 201 if rows else 400
+
+def read_customer_records(stream, fmt):
+    """
+    Parses customers from a CSV (with a header row) or NDJSON text stream, one record at a time.
+
+    Args:
+        stream (io.TextIOBase): The text to parse. CSV streams must be opened with ``newline=''``.
+        fmt (str): ``csv`` or ``ndjson``.
+
+    Yields:
+        tuple: ``(line number, customer dict)``, with None instead of the dict for a line that is not valid JSON.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record
+
+def import_customer_batch(batch, report):
+    """
+    Inserts one batch of validated customers in a single transaction, skipping usernames that are taken.
+
+    The plain-text passwords of the batch are hashed in parallel on the password hashing pool and the customers
+    are inserted with one ``executemany``.
+
+    Args:
+        batch (list): ``(line number, column values, plain-text password or None)`` tuples.
+        report (dict): The import report, updated in place.
+    """
+    usernames = [values['username'] for _, values, _ in batch]
+    taken = {username for (username,) in db.session.query(Customer.username).filter(Customer.username.in_(usernames))}
+    lines = []
+    rows = []
+    for line, values, password in batch:
+        if values['username'] in taken:
+            record_import_error(report, line, values['username'], 'Username already exists')
+            continue
+        taken.add(values['username'])
+        lines.append(line)
+        rows.append((values, password))
+    if not rows:
+        return
+
+    to_hash = [(values, password) for values, password in rows if password is not None]
+    for (values, _), password_hash in zip(to_hash, password_hasher.hash_many([password for _, password in to_hash])):
+        values['password_hash'] = password_hash
+    rows = [values for values, _ in rows]
+
+    try:
+        db.session.execute(insert(Customer), rows)
+        imported = len(rows)
+    except IntegrityError:
+        # Some usernames were registered concurrently: insert the rows one at a time to find them
+        db.session.rollback()
+        imported = 0
+        for line, values in zip(lines, rows):
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(Customer), values)
+                imported += 1
+            except IntegrityError:
+                record_import_error(report, line, values['username'], 'Username already exists')
+    if imported:
+        bump_version('customer')
+    db.session.commit()
+    report['imported'] += imported
+
+def record_import_error(report, line, username, error):
+    """
+    Adds a rejected row to an import report, keeping at most ``MAX_IMPORT_ERRORS`` of them.
+
+    Args:
+        report (dict): The import report, updated in place.
+        line (int): Line number of the row in the input.
+        username (str): Username of the row, if it has one.
+        error (str): Why the row was rejected.
+    """
+    report['failed'] += 1
+    if len(report['errors']) < MAX_IMPORT_ERRORS:
+        report['errors'].append({'line': line, 'username': username, 'error': error})
+    else:
+        report['errors_truncated'] = True
+
+def import_customers(records, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Imports a stream of customers in batched transactions.
+
+    Each record is validated with the same rules as ``/register``. A record may carry an existing ``password_hash``
+    instead of a ``password``, e.g. when importing an export made with ``--with-password-hash``, and an optional
+    non-negative ``wallet``. Valid records are inserted ``batch_size`` at a time, each batch in its own transaction,
+    so memory use does not grow with the size of the input; invalid records are reported and skipped.
+
+    Args:
+        records (iterable): ``(line number, customer dict)`` tuples, as produced by :func:`read_customer_records`.
+        batch_size (int): Number of customers inserted per transaction.
+
+    Returns:
+        dict: The number of customers imported and rejected, and the first rejected rows.
+    """
+    report = {'imported': 0, 'failed': 0, 'errors': [], 'errors_truncated': False}
+    batch = []
+    for line, record in records:
+        if record is None:
+            record_import_error(report, line, None, 'Invalid JSON')
+            continue
+
+        password_hash = record.get('password_hash') if isinstance(record, dict) else None
+        password_hash = password_hash or None
+        values, error = parse_registration(record, require_password=password_hash is None)
+        if not error and password_hash is not None and not PASSWORD_HASH_PATTERN.fullmatch(password_hash):
+            error = 'Invalid password hash'
+        if not error:
+            values['wallet'] = 0.0
+        if not error and record.get('wallet') not in (None, ''):
+            try:
+                values['wallet'] = float(record['wallet'])
+                if values['wallet'] < 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                error = 'Invalid wallet'
+        if error:
+            record_import_error(report, line, record.get('username') if isinstance(record, dict) else None, error)
+            continue
+
+        if password_hash is not None:
+            values['password_hash'] = password_hash
+        batch.append((line, values, None if password_hash is not None else record['password']))
+        if len(batch) >= batch_size:
+            import_customer_batch(batch, report)
+            batch = []
+
+    if batch:
+        import_customer_batch(batch, report)
+    return report
+
+@bp.route('/customers/import', methods=['POST'])
+def import_customers_endpoint():
+    """
+    Imports customers from a CSV or NDJSON request body.
+
+    The body is parsed while it is read and inserted in batched transactions, so it can hold any number of
+    customers. The format is taken from the ``format`` query parameter, or else from the ``Content-Type``
+    (``text/csv`` for CSV, NDJSON otherwise).
+
+    Returns:
+        JSON: The number of customers imported and rejected, and the first rejected rows.
+    """
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Invalid format, choose csv or ndjson'}), 400
+
+    stream = open_request_text()
+    try:
+        report = import_customers(read_customer_records(stream, fmt))
+    except UnicodeDecodeError:
+        db.session.rollback()
+        return jsonify({'error': 'The import must be UTF-8 encoded'}), 400
+    return jsonify(report), 200
+
+@bp.route('/delete/<username>', methods=['DELETE'])
 def delete_customer(username):
     """
     Deletes a customer.
@@ -107,10 +440,11 @@ def delete_customer(username):
     if not customer:
         return jsonify({'error': 'Customer not found'}), 404
     db.session.delete(customer)
+    bump_version('customer')
     db.session.commit()
     return jsonify({'message': 'Customer deleted successfully'}), 200
 
-@app.route('/update/<username>', methods=['PUT'])
+@bp.route('/update/<username>', methods=['PUT'])
 def update_customer(username):
     """
     Updates a customer's information.
@@ -136,20 +470,94 @@ def update_customer(username):
         if hasattr(customer, key):
             setattr(customer, key, value)
 
+    bump_version('customer')
     db.session.commit()
     return jsonify({'message': 'Customer updated successfully'}), 200
 
-@app.route('/customers', methods=['GET'])
+def export_customers(query, fields, fmt):
+    """
+    Serializes the customers of a query as NDJSON or CSV, fetching and yielding them in chunks.
+
+    Args:
+        query (Query): Query selecting the given fields first, in order; further columns are ignored.
+        fields (tuple): Fields to export, in column order.
+        fmt (str): ``ndjson`` or ``csv``; CSV starts with a header row.
+
+    Yields:
+        str: Chunks of serialized customers.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(fields)
+
+    for count, row in enumerate(query.execution_options(yield_per=EXPORT_CHUNK_SIZE), 1):
+        if writer:
+            writer.writerow(row[:len(fields)])
+        else:
+            buffer.write(current_app.json.dumps(dict(zip(fields, row))) + '\n')
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@bp.route('/customers', methods=['GET'])
+@conditional('customer')
 def get_all_customers():
-    """Returns a list of all customers."""
-    customers = db.session.query(Customer).all()
-    if not customers:
+    """
+    Returns a page of customers ordered by username.
+
+    Only the requested columns are queried. The username to pass as ``after`` for the next page is returned in
+    the ``X-Next-Cursor`` header. With ``format=ndjson`` or ``format=csv`` every customer is streamed instead, as
+    one JSON object or CSV row per line, for full exports that ``/customers/import`` can read back.
+
+    Query Parameters:
+        after (str): Only return customers whose username sorts after this cursor.
+        limit (int): Page size, at most 1000 (default 100).
+        fields (str): Comma-separated fields to return (default: all public fields).
+        format (str): ``json`` (default), ``ndjson`` or ``csv``.
+    """
+    fields = request.args.get('fields')
+    fields = tuple(fields.split(',')) if fields else CUSTOMER_FIELDS
+    if any(field not in CUSTOMER_FIELDS for field in fields):
+        return jsonify({'error': f'Unknown field, choose from {", ".join(CUSTOMER_FIELDS)}'}), 400
+
+    after = request.args.get('after')
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    # Query only the requested columns, plus username for the cursor, last so the rows line up with the fields
+    query = db.session.query(*[getattr(Customer, field) for field in dict.fromkeys(fields + ('username',))])
+    if after is not None:
+        query = query.filter(Customer.username > after)
+    query = query.order_by(Customer.username)
+
+    fmt = request.args.get('format')
+    if fmt in ('ndjson', 'csv'):
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        return Response(stream_with_context(export_customers(query, fields, fmt)), mimetype=mimetype)
+
+    # Fetch one extra row to learn whether another page follows
+    rows = query.limit(limit + 1).all()
+    if not rows and after is None:
         return jsonify({'error': 'No customers found'}), 404
 
-    customer_list = [{'username': customer.username, 'full_name': customer.full_name, 'age': customer.age, 'address': customer.address, 'gender': customer.gender, 'marital_status': customer.marital_status, 'wallet': customer.wallet} for customer in customers]
-    return jsonify(customer_list), 200
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    response = jsonify(records(fields, rows))
+    if has_more:
+        response.headers['X-Next-Cursor'] = rows[-1].username
+    return response, 200
 
-@app.route('/customer/<username>', methods=['GET'])
+@bp.route('/customer/<username>', methods=['GET'])
+@conditional('customer')
 def get_customer(username):
     """
     Retrieves a single customer.
@@ -164,29 +572,32 @@ def get_customer(username):
     customer_info = {'username': customer.username, 'full_name': customer.full_name, 'age': customer.age, 'address': customer.address, 'gender': customer.gender, 'marital_status': customer.marital_status, 'wallet': customer.wallet}
     return jsonify(customer_info), 200
 
-@app.route('/charge_wallet/<username>', methods=['POST'])
+@bp.route('/charge_wallet/<username>', methods=['POST'])
+@idempotent
 def charge_wallet(username):
     """
-    Charges a customer's wallet.
+    Charges a customer's wallet. The Sales Service also uses it to refund sales that did not go through.
 
     Args:
         username (str): The username of the customer whose wallet is to be charged.
     """
-    customer = db.session.get(Customer, username)
-    if not customer:
+    if not db.session.get(Customer, username):
         return jsonify({'error': 'Customer not found'}), 404
 
     try:
         amount = float(request.json.get('amount', 0))
         if amount <= 0:
             raise ValueError
-        customer.wallet += amount
-        db.session.commit()
-        return jsonify({'message': f'{amount} added to wallet', 'new_balance': customer.wallet}), 200
-    except ValueError:
+    except (TypeError, ValueError):
         return jsonify({'error': 'Invalid amount'}), 400
 
-@app.route('/deduct_wallet/<username>', methods=['POST'])
+    new_balance = credit_wallet(username, amount)
+    if new_balance is None:
+        return jsonify({'error': 'Customer not found'}), 404
+    return jsonify({'message': f'{amount} added to wallet', 'new_balance': new_balance}), 200
+
+@bp.route('/deduct_wallet/<username>', methods=['POST'])
+@idempotent
 def deduct_wallet(username):
     """
         Deducts an amount from a customer's wallet.
@@ -195,23 +606,51 @@ def deduct_wallet(username):
         username (str): The username of the customer whose wallet is to be deducted.
     """
 
-    customer = db.session.get(Customer, username)
-    if not customer:
-        return jsonify({'error': 'Customer not found'}), 404
-
     try:
         amount = float(request.json.get('amount', 0))
-        if amount <= 0 or customer.wallet < amount:
+        if amount <= 0:
             raise ValueError
-        customer.wallet -= amount
-        db.session.commit()
-        return jsonify({'message': f'{amount} deducted from wallet', 'new_balance': customer.wallet}), 200
     except ValueError:
         return jsonify({'error': 'Invalid amount or insufficient funds'}), 400
 
+    new_balance = debit_wallet(username, amount)
+    if new_balance is None:
+        if not db.session.get(Customer, username):
+            return jsonify({'error': 'Customer not found'}), 404
+        return jsonify({'error': 'Invalid amount or insufficient funds'}), 400
+
+    return jsonify({'message': f'{amount} deducted from wallet', 'new_balance': new_balance}), 200
+
+@bp.route('/purchase/<username>', methods=['POST'])
+@idempotent
+def purchase(username):
+    """
+    Checks and debits a customer's wallet in a single round trip.
+
+    The balance check and the debit run as one conditional ``UPDATE``, so concurrent purchases cannot overdraw
+    the wallet.
+
+    Args:
+        username (str): The username of the customer paying for the purchase.
+    """
+    try:
+        amount = float(request.json.get('amount', 0))
+        if amount <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid amount'}), 400
+
+    new_balance = debit_wallet(username, amount)
+    if new_balance is None:
+        if not db.session.get(Customer, username):
+            return jsonify({'error': 'Customer not found'}), 404
+        return jsonify({'error': 'Insufficient funds'}), 400
+
+    return jsonify({'message': f'{amount} deducted from wallet', 'username': username, 'new_balance': new_balance}), 200
+
 #additional route (to check the balance of the customer)
-@app.route('/balance/<username>', methods=['GET'])
-@app.route('/balance/<username>', methods=['GET'])
+@bp.route('/balance/<username>', methods=['GET'])
+@bp.route('/balance/<username>', methods=['GET'])
 def get_balance(username):
     """
     Retrieves the balance of a customer's wallet.
@@ -230,6 +669,92 @@ def get_balance(username):
 
     return jsonify(balance_info), 200
 
+@bp.cli.command('import-customers')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Input format (default: from the file extension).')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True, help='Customers inserted per transaction.')
+def import_customers_command(path, fmt, batch_size):
+    """Imports customers from a CSV or NDJSON file, or from standard input with PATH ``-``."""
+    fmt = fmt or ('csv' if path.endswith('.csv') else 'ndjson')
+    with (open(path, encoding='utf-8', newline='') if path != '-' else contextlib.nullcontext(sys.stdin)) as stream:
+        report = import_customers(read_customer_records(stream, fmt), batch_size=batch_size)
+    for error in report['errors']:
+        print(f"line {error['line']}: {error['error']} ({error['username']})", file=sys.stderr)
+    print(f"{report['imported']} customers imported, {report['failed']} rejected")
+
+@bp.cli.command('export-customers')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Output format (default: from the file extension).')
+@click.option('--with-password-hash', is_flag=True, help='Include password hashes, so the customers can be imported elsewhere with their passwords.')
+def export_customers_command(path, fmt, with_password_hash):
+    """Exports every customer to a CSV or NDJSON file, or to standard output with PATH ``-``."""
+    fmt = fmt or ('csv' if path.endswith('.csv') else 'ndjson')
+    fields = CUSTOMER_FIELDS + (('password_hash',) if with_password_hash else ())
+    query = db.session.query(*[getattr(Customer, field) for field in fields]).order_by(Customer.username)
+    with (open(path, 'w', encoding='utf-8', newline='') if path != '-' else contextlib.nullcontext(sys.stdout)) as stream:
+        for chunk in export_customers(query, fields, fmt):
+            stream.write(chunk)
+
+@bp.cli.command('startup-report')
+@click.option('--budget', type=float, help='Fail if a cold start takes longer than this many milliseconds.')
+def startup_report_command(budget):
+    """Measures how long a fresh process takes to import and build the app, phase by phase."""
+    report = measure_cold_start(base_dir)
+    print(json.dumps(report, indent=2))
+    if budget is not None and report['total_ms'] > budget:
+        raise click.ClickException(f"Cold start took {report['total_ms']} ms, over the {budget:g} ms budget")
+
+def load_config():
+    """
+    Reads the service settings from the environment.
+
+    Returns:
+        dict: Flask configuration values.
+    """
+    return {
+        'SQLALCHEMY_DATABASE_URI': database_url(db_path),
+        'JSON_ENCODER': os.environ.get('JSON_ENCODER', 'auto'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        # Idempotency keys
+        'IDEMPOTENCY_TTL': float(os.environ.get('IDEMPOTENCY_TTL', 86400)),
+        'IDEMPOTENCY_LEASE': float(os.environ.get('IDEMPOTENCY_LEASE', 60)),
+        'IDEMPOTENCY_PURGE_INTERVAL': float(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 60)),
+    }
+
+def create_app(config=None):
+    """
+    Builds the Customer Service app.
+
+    Building the app does not connect to the database: connections are opened by the first request, and the schema
+    is created by the ``migrate`` command instead of on every start. How long each phase took is kept in
+    ``app.extensions['startup_report']``.
+
+    Args:
+        config (dict): Settings overriding the ones read from the environment, e.g. the database URI in tests.
+
+    Returns:
+        Flask: The application.
+    """
+    timer = StartupTimer()
+    app = Flask(__name__)
+    with timer.phase('config'):
+        app.config.update(load_config())
+        app.config.update(config or {})
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+        app.json = JSONProvider(app, app.config['JSON_ENCODER'])
+    with timer.phase('database'):
+        db.init_app(app)
+        configure_engine(app, db)
+    with timer.phase('routes'):
+        app.register_blueprint(bp)
+        metrics.init_app(app, db)
+    app.extensions['startup_report'] = timer.report()
+    return app
+
+# Development server only; in production the app is served by Gunicorn (see gunicorn.conf.py)
 if __name__ == "__main__":
+    app = create_app()
+    with app.app_context():
+        migrate()
     app.run(host='0.0.0.0', port=5000)
 
@@ -0,0 +1,109 @@
+"""
+Password Hashing
+
+This module hashes customer passwords on a bounded pool of worker threads. The key derivation functions Werkzeug uses
+(scrypt and PBKDF2 from :mod:`hashlib`) release the GIL while they run, so the pool hashes in parallel across cores,
+and its size caps how many cores hashing can take away from the requests being served.
+
+"""
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+
+class PasswordHasher:
+    """
+    Hashes passwords with a configurable Werkzeug method and cost on a bounded thread pool.
+
+    Each setting falls back to an environment variable and then to a default.
+
+    Attributes:
+        method (str): Werkzeug hash method, e.g. ``scrypt:16384:8:1`` or ``pbkdf2:sha256:600000``. Built from
+            ``PASSWORD_HASH_METHOD`` (``scrypt`` or ``pbkdf2``, default ``scrypt``) and ``PASSWORD_HASH_COST`` (the
+            scrypt ``N`` or the PBKDF2 iteration count, default Werkzeug's).
+        salt_length (int): Length of the random salt (``PASSWORD_SALT_LENGTH``, default 16).
+        workers (int): Threads hashing at the same time (``PASSWORD_HASH_WORKERS``, default the CPU count); 0 hashes
+            in the calling thread.
+    """
+
+    def __init__(self, method=None, cost=None, salt_length=None, workers=None):
+        method = method if method is not None else os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+        cost = cost if cost is not None else os.environ.get('PASSWORD_HASH_COST')
+        self.method = self.build_method(method, cost)
+        self.salt_length = int(salt_length if salt_length is not None else os.environ.get('PASSWORD_SALT_LENGTH', 16))
+        self.workers = int(workers if workers is not None else os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @staticmethod
+    def build_method(method, cost=None):
+        """
+        Builds the Werkzeug method string for a hash method and cost.
+
+        Args:
+            method (str): ``scrypt``, ``pbkdf2`` or a complete Werkzeug method string.
+            cost (int): The scrypt ``N`` or the PBKDF2 iteration count, or None for Werkzeug's default.
+
+        Returns:
+            str: The Werkzeug method string.
+
+        Raises:
+            ValueError: If the method is not supported or the cost does not apply to it.
+        """
+        if cost in (None, ''):
+            spec = method
+        elif method == 'scrypt':
+            spec = f'scrypt:{int(cost)}:8:1'
+        elif method == 'pbkdf2':
+            spec = f'pbkdf2:sha256:{int(cost)}'
+        else:
+            raise ValueError(f'A hash cost can only be set for scrypt or pbkdf2, not {method!r}')
+
+        if not re.fullmatch(r'scrypt(:\d+:\d+:\d+)?|pbkdf2(:\w+(:\d+)?)?', spec):
+            raise ValueError(f'Unsupported password hash method: {spec!r}')
+        return spec
+
+    def hash(self, password):
+        """
+        Hashes one password on the pool.
+
+        Args:
+            password (str): The plain-text password.
+
+        Returns:
+            str: The salted hash, in Werkzeug's format.
+        """
+        if self.workers <= 0:
+            return self._hash(password)
+        return self._get_executor().submit(self._hash, password).result()
+
+    def hash_many(self, passwords):
+        """
+        Hashes many passwords in parallel on the pool.
+
+        Args:
+            passwords (list): The plain-text passwords.
+
+        Returns:
+            list: The hashes, in the order of the passwords.
+        """
+        if self.workers <= 0:
+            return [self._hash(password) for password in passwords]
+        return list(self._get_executor().map(self._hash, passwords))
+
+    def _hash(self, password):
+        """Hashes a password in the calling thread."""
+        return generate_password_hash(password, method=self.method, salt_length=self.salt_length)
+
+    def _get_executor(self):
+        """Returns the hashing thread pool, creating it in this process if needed."""
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+                self._executor_pid = os.getpid()
+            return self._executor
@@ -0,0 +1,135 @@
+"""
+Idempotent Requests
+
+This module lets clients retry write requests safely. A request sent with an ``Idempotency-Key`` header runs once;
+its response is stored under the key in the ``IdempotencyRecord`` table, and a retry with the same key gets the
+stored response instead of running the request again. The app's config sets how long keys are kept
+(``IDEMPOTENCY_TTL``), after how long an unfinished request is given up (``IDEMPOTENCY_LEASE``) and how often expired
+records are purged while the service handles requests (``IDEMPOTENCY_PURGE_INTERVAL``).
+
+"""
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, current_app, jsonify, make_response, request
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+
+from db_config import db
+
+
+class IdempotencyRecord(db.Model):
+    """
+    Stored outcome of a write request sent with an ``Idempotency-Key`` header.
+
+    Attributes:
+        key (str): The key chosen by the client, unique per logical request.
+        fingerprint (str): SHA-256 of the method, path, query string and body of the first request with the key.
+        status_code (int): Status of the stored response, or None while the first request is still running.
+        headers (str): JSON list of the stored response headers.
+        body (bytes): Body of the stored response.
+        created_at (datetime): Time the first request with the key started.
+        expires_at (datetime): Time after which the record is purged and the key can be reused.
+    """
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    headers = db.Column(db.Text)
+    body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+# When this process last purged the expired records, in time.monotonic() seconds
+last_idempotency_purge = 0.0
+
+
+def purge_idempotency_records():
+    """
+    Deletes every expired idempotency record with one statement on the indexed expiry column.
+
+    Returns:
+        int: The number of records deleted.
+    """
+    result = db.session.execute(delete(IdempotencyRecord).where(IdempotencyRecord.expires_at <= datetime.utcnow()))
+    db.session.commit()
+    return result.rowcount
+
+
+def idempotent(view):
+    """
+    Decorator making a write endpoint safe to retry with an ``Idempotency-Key`` header.
+
+    The first request with a key runs the endpoint and stores its response under the key; a retry with the same key
+    and the same request gets the stored response back, with an ``Idempotent-Replayed`` header, without running the
+    endpoint again. Reusing a key for a different request returns ``422``, and a retry arriving while the first
+    request is still running returns ``409``. Server errors are not stored, so the request can be retried for real.
+    Requests without the header are not affected.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        global last_idempotency_purge
+
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > 255:
+            return jsonify({'error': 'Invalid Idempotency-Key header'}), 400
+
+        fingerprint = hashlib.sha256(b'\n'.join([request.method.encode(), request.full_path.encode(), request.get_data()])).hexdigest()
+        now = datetime.utcnow()
+        record = db.session.get(IdempotencyRecord, key)
+        abandoned_before = now - timedelta(seconds=current_app.config['IDEMPOTENCY_LEASE'])
+        if record is not None and (record.expires_at <= now or (record.status_code is None and record.created_at < abandoned_before)):
+            # An expired key, or one whose request never finished (e.g. the worker died), starts over
+            db.session.delete(record)
+            db.session.commit()
+            record = None
+
+        if record is None:
+            db.session.add(IdempotencyRecord(key=key, fingerprint=fingerprint, created_at=now,
+                                             expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_TTL'])))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # A concurrent request with the same key got there first
+                db.session.rollback()
+                record = db.session.get(IdempotencyRecord, key)
+
+        if record is not None:
+            if record.fingerprint != fingerprint:
+                return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+            if record.status_code is None:
+                return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+            response = Response(record.body, status=record.status_code, headers=json.loads(record.headers))
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        stored = IdempotencyRecord.key == key
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            db.session.execute(delete(IdempotencyRecord).where(stored))
+            db.session.commit()
+            raise
+
+        if response.status_code >= 500:
+            db.session.execute(delete(IdempotencyRecord).where(stored))
+        else:
+            headers = [(name, value) for name, value in response.headers if name.lower() != 'content-length']
+            db.session.execute(
+                update(IdempotencyRecord)
+                .where(stored)
+                .values(status_code=response.status_code, headers=json.dumps(headers), body=response.get_data())
+            )
+        db.session.commit()
+
+        if time.monotonic() - last_idempotency_purge >= current_app.config['IDEMPOTENCY_PURGE_INTERVAL']:
+            last_idempotency_purge = time.monotonic()
+            purge_idempotency_records()
+        return response
+    return wrapper
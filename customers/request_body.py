@@ -0,0 +1,44 @@
+"""
+Request Bodies
+
+This module reads request bodies as text while they arrive, for the endpoints that import large CSV or NDJSON
+uploads. It works on the bare input stream WSGI servers such as Gunicorn give for chunked bodies, which has nothing
+but ``read()``.
+
+"""
+import io
+
+from flask import request
+
+
+def open_request_text():
+    """
+    Opens the request body as UTF-8 text, decoded while it is read.
+
+    Lines end only at ``\\n``, ``\\r`` and ``\\r\\n``, as in a file opened with ``newline=''``, so a value holding
+    another Unicode line separator (e.g. U+2028) stays on its line.
+
+    Returns:
+        io.TextIOWrapper: The body as a text stream.
+    """
+    return io.TextIOWrapper(io.BufferedReader(RequestBody(request.stream)), encoding='utf-8', newline='')
+
+
+class RequestBody(io.RawIOBase):
+    """
+    Raw stream over a WSGI input stream, which may support nothing but ``read()``.
+
+    Args:
+        stream: The WSGI input stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
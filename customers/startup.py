@@ -0,0 +1,84 @@
+"""
+Startup Timing
+
+This module measures how long a service takes to start, so cold starts can be kept within the time the autoscaler
+allows a new instance. :class:`StartupTimer` records the phases of the application factory; :func:`measure_cold_start`
+imports and builds the app in a fresh interpreter, which also counts the time spent importing Flask, SQLAlchemy and
+the service itself.
+
+"""
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Run in a fresh interpreter by measure_cold_start: times the import and the factory, then prints the report as JSON
+COLD_START_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+report = {'import_ms': round((imported - started) * 1000, 1)}
+report.update(application.extensions['startup_report'])
+report['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+print(json.dumps(report))
+'''
+
+
+class StartupTimer:
+    """
+    Records how long each phase of building an app takes.
+
+    Attributes:
+        phases (dict): Milliseconds spent in each phase, in the order they ran.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times the code run inside the ``with`` block as one phase.
+
+        Args:
+            name (str): Name of the phase in the report.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    def report(self):
+        """
+        Returns the time spent in each phase and in the whole factory.
+
+        Returns:
+            dict: ``phases_ms`` (milliseconds per phase) and ``create_app_ms``.
+        """
+        return {'phases_ms': dict(self.phases), 'create_app_ms': round((time.perf_counter() - self._started) * 1000, 1)}
+
+
+def measure_cold_start(directory):
+    """
+    Imports a service and builds its app in a new Python process, as a server worker does when it boots.
+
+    Args:
+        directory (str): Directory of the service's ``app.py``.
+
+    Returns:
+        dict: ``import_ms``, the factory phases, ``create_app_ms`` and ``total_ms``.
+
+    Raises:
+        RuntimeError: If the app cannot be imported or built.
+    """
+    result = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT], cwd=directory, env=dict(os.environ),
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'The app failed to start:\n{result.stderr}')
+    return json.loads(result.stdout.strip().splitlines()[-1])
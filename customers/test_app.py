@@ -1,27 +1,40 @@
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
 import pytest
-from app import app, db, Customer  
+from app import create_app, db, migrate, Customer
+from app import import_customers, read_customer_records, export_customers, CUSTOMER_FIELDS
+from hashing import PasswordHasher
+from idempotency import IdempotencyRecord, purge_idempotency_records
+from versions import TableVersion
+from werkzeug.security import check_password_hash
+
+# The tests get their own database file, configured before the engine is created
+app = create_app({
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='customers-test-'), 'test.db')}",
+})
 
 @pytest.fixture(scope='module')
 def test_client():
     """
     Fixture for setting up a test client for the app.
 
-    This fixture configures the app for testing by setting the necessary testing flags and database URI.
-    It also creates a test client using the app.test_client() method and sets up the necessary database operations.
+    This fixture creates a test client for the app, which is configured for testing above, and creates the schema.
 
     Yields:
         FlaskClient: The test client for making requests to the app.
 
     """
-    # Configure the app for testing
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
     # Set up the test client
     with app.test_client() as testing_client:
         with app.app_context():
-            db.create_all()
+            migrate()
             db.session.query(Customer).delete()  # Clear Customer table
             db.session.commit()
         yield testing_client  # This is where the testing happens
@@ -72,6 +85,73 @@ def test_get_customers(test_client, new_customer):
     assert response.status_code == 200
     assert b'testuser' in response.data
 
+def test_get_customers_pagination(test_client):
+    for name in ('page_a', 'page_b', 'page_c'):
+        db.session.add(Customer(username=name, full_name=name.title(), age=20, wallet=5.0))
+    db.session.commit()
+
+    response = test_client.get('/customers?after=page&limit=2&fields=username,wallet')
+    assert response.status_code == 200
+    assert response.json == [{'username': 'page_a', 'wallet': 5.0}, {'username': 'page_b', 'wallet': 5.0}]
+    assert response.headers['X-Next-Cursor'] == 'page_b'
+
+    response = test_client.get('/customers?after=page_b&limit=2&fields=username')
+    assert response.json[0] == {'username': 'page_c'}
+
+    assert test_client.get('/customers?fields=password_hash').status_code == 400
+    # A malformed limit is an error rather than the default page size
+    assert test_client.get('/customers?limit=ten').json == {'error': 'Invalid limit'}
+
+def test_get_customers_ndjson(test_client):
+    response = test_client.get('/customers?format=ndjson&fields=username')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    usernames = [json.loads(line)['username'] for line in response.data.splitlines()]
+    assert usernames == sorted(usernames)
+    assert 'page_a' in usernames
+
+def test_get_customer_conditional(test_client):
+    data = {'username': 'etaguser', 'full_name': 'ETag User', 'password': 'pw', 'age': 40, 'address': '1 Cache Rd', 'gender': 'Female', 'marital_status': 'Single'}
+    test_client.post('/register', json=data)
+
+    response = test_client.get('/customer/etaguser')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+
+    response = test_client.get('/customer/etaguser', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # The write happened in the current second, so the truncated Last-Modified cannot vouch for it yet
+    response = test_client.get('/customer/etaguser', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+
+    test_client.post('/charge_wallet/etaguser', json={'amount': 5})
+    response = test_client.get('/customer/etaguser', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json['wallet'] == 5.0
+
+def test_get_customer_if_modified_since(test_client):
+    data = {'username': 'imsuser', 'full_name': 'IMS User', 'password': 'pw', 'age': 40, 'address': '1 Cache Rd', 'gender': 'Male', 'marital_status': 'Single'}
+    test_client.post('/register', json=data)
+    with app.app_context():
+        db.session.query(TableVersion).filter_by(table_name='customer').update({'updated_at': datetime(2024, 1, 1, 12, 0, 0, 500000)})
+        db.session.commit()
+
+    # A past write is rounded up to the next second, which then validates
+    response = test_client.get('/customer/imsuser')
+    assert response.headers['Last-Modified'] == 'Mon, 01 Jan 2024 12:00:01 GMT'
+    response = test_client.get('/customer/imsuser', headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert response.status_code == 304
+
+    # A write in the same second as the previous response is never hidden behind a 304
+    response = test_client.get('/customer/imsuser')
+    test_client.post('/charge_wallet/imsuser', json={'amount': 50})
+    response = test_client.get('/customer/imsuser', headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert response.status_code == 200
+    assert response.json['wallet'] == 50.0
+
 def test_update_customer(test_client, new_customer):
     # Setup - Create a customer to update
     db.session.add(new_customer)
@@ -118,6 +198,181 @@ def test_deduct_wallet(test_client, new_customer):
     response = test_client.post(f'/deduct_wallet/{new_customer.username}', json=insufficient_data)
     assert response.status_code == 400
 
+def test_purchase(test_client, new_customer):
+    # Setup - Create a customer
+    db.session.add(new_customer)
+    db.session.commit()
+    balance = test_client.get(f'/balance/{new_customer.username}').json['balance']
+
+    # Success case
+    response = test_client.post(f'/purchase/{new_customer.username}', json={'amount': 10})
+    assert response.status_code == 200
+    assert response.json['new_balance'] == balance - 10
+
+    # Error case: Insufficient funds
+    response = test_client.post(f'/purchase/{new_customer.username}', json={'amount': 100000})
+    assert response.status_code == 400
+    assert test_client.get(f'/balance/{new_customer.username}').json['balance'] == balance - 10
+
+    # Error case: Invalid amount
+    response = test_client.post(f'/purchase/{new_customer.username}', json={'amount': -5})
+    assert response.status_code == 400
+
+    # Error case: Customer not found
+    response = test_client.post('/purchase/nonexistinguser', json={'amount': 10})
+    assert response.status_code == 404
+
+def test_concurrent_refunds_and_purchases(test_client):
+    # Credits are applied in SQL like debits, so neither overwrites the other
+    data = {'username': 'busyuser', 'full_name': 'Busy User', 'password': 'pw', 'age': 33, 'address': '2 Rush Rd', 'gender': 'Male', 'marital_status': 'Single'}
+    test_client.post('/register', json=data)
+    test_client.post('/charge_wallet/busyuser', json={'amount': 100})
+    barrier = threading.Barrier(16, timeout=10)
+    statuses = []
+
+    def call(path, amount):
+        with app.test_client() as client:
+            barrier.wait()
+            for _ in range(5):
+                statuses.append(client.post(path, json={'amount': amount}).status_code)
+
+    threads = [threading.Thread(target=call, args=('/charge_wallet/busyuser', 3)) for _ in range(8)]
+    threads += [threading.Thread(target=call, args=('/purchase/busyuser', 2)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses == [200] * 80
+    assert test_client.get('/balance/busyuser').json['balance'] == 100 + 40 * 3 - 40 * 2
+
+def test_idempotent_charge_wallet(test_client, new_customer):
+    db.session.add(new_customer)
+    db.session.commit()
+    balance = test_client.get(f'/balance/{new_customer.username}').json['balance']
+    headers = {'Idempotency-Key': uuid.uuid4().hex}
+
+    first = test_client.post(f'/charge_wallet/{new_customer.username}', json={'amount': 5}, headers=headers)
+    retry = test_client.post(f'/charge_wallet/{new_customer.username}', json={'amount': 5}, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json == first.json
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert test_client.get(f'/balance/{new_customer.username}').json['balance'] == balance + 5
+
+    # The same key cannot be reused for a different request
+    response = test_client.post(f'/charge_wallet/{new_customer.username}', json={'amount': 6}, headers=headers)
+    assert response.status_code == 422
+
+    # Rejected requests are replayed too
+    headers = {'Idempotency-Key': uuid.uuid4().hex}
+    assert test_client.post(f'/deduct_wallet/{new_customer.username}', json={'amount': 10 ** 6}, headers=headers).status_code == 400
+    assert test_client.post(f'/deduct_wallet/{new_customer.username}', json={'amount': 10 ** 6}, headers=headers).status_code == 400
+
+def test_idempotency_records_expire(test_client, new_customer):
+    db.session.add(new_customer)
+    db.session.commit()
+    headers = {'Idempotency-Key': uuid.uuid4().hex}
+    test_client.post(f'/purchase/{new_customer.username}', json={'amount': 1}, headers=headers)
+
+    record = db.session.get(IdempotencyRecord, headers['Idempotency-Key'])
+    assert record.status_code == 200
+    record.expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert purge_idempotency_records() >= 1
+    assert db.session.get(IdempotencyRecord, headers['Idempotency-Key']) is None
+
+def test_register_customers_bulk(test_client):
+    base = {'full_name': 'Bulk User', 'password': 'pw', 'age': 30, 'address': '1 Batch St', 'gender': 'Female', 'marital_status': 'Single'}
+    response = test_client.post('/register/bulk', json={'customers': [
+        dict(base, username='bulk1'),
+        dict(base, username='bulk2'),
+        dict(base, username='bulk1'),
+        dict(base, username='bulk3', age=-1),
+        {'username': 'bulk4'},
+    ]})
+    assert response.status_code == 201
+    assert response.json['registered'] == 2
+    assert [(error['index'], error['error']) for error in response.json['errors']] == [
+        (2, 'Username already exists'), (3, 'Age cannot be negative'), (4, 'All fields are required')
+    ]
+
+    customer = db.session.get(Customer, 'bulk2')
+    assert check_password_hash(customer.password_hash, 'pw')
+    assert test_client.post('/register/bulk', json={'customers': [dict(base, username='bulk1')]}).status_code == 400
+    assert test_client.post('/register/bulk', json={'customers': []}).status_code == 400
+
+def test_import_customers_ndjson(test_client):
+    existing = {'username': 'import0', 'full_name': 'Import Zero', 'password': 'pw', 'age': 20, 'address': 'A', 'gender': 'Male', 'marital_status': 'Single'}
+    test_client.post('/register', json=existing)
+    prehashed = db.session.get(Customer, 'import0').password_hash
+
+    lines = [
+        json.dumps(dict(existing, username='import1')),
+        json.dumps(dict(existing, username='import2', wallet=12.5)),
+        '{not json',
+        json.dumps(dict(existing, username='import0')),
+        json.dumps(dict(existing, username='import3', age='old')),
+        json.dumps({k: v for k, v in dict(existing, username='import4', password_hash=prehashed).items() if k != 'password'}),
+        json.dumps(dict(existing, username='import1')),
+    ]
+    response = test_client.post('/customers/import', data='\n'.join(lines) + '\n', content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert response.json['imported'] == 3
+    assert [(error['line'], error['error']) for error in response.json['errors']] == [
+        (3, 'Invalid JSON'), (5, 'Invalid age'), (4, 'Username already exists'), (7, 'Username already exists')
+    ]
+    assert db.session.get(Customer, 'import2').wallet == 12.5
+    assert check_password_hash(db.session.get(Customer, 'import1').password_hash, 'pw')
+    assert db.session.get(Customer, 'import4').password_hash == prehashed
+
+def test_import_customers_csv_batches(test_client):
+    csv_body = 'username,full_name,password,age,address,gender,marital_status\n'
+    csv_body += ''.join(f'csv{i},"Csv, User",pw,{30 + i},1 Row St,Female,Single\n' for i in range(5))
+    csv_body += 'csvbad,Csv User,pw,,1 Row St,Female,Single\n'
+    with app.app_context():
+        report = import_customers(read_customer_records(io.StringIO(csv_body, newline=''), 'csv'), batch_size=2)
+    assert report['imported'] == 5
+    assert report['errors'] == [{'line': 7, 'username': 'csvbad', 'error': 'Invalid age'}]
+    assert db.session.get(Customer, 'csv4').full_name == 'Csv, User'
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_import_keeps_unicode_line_separators(test_client, fmt):
+    # Exports write U+2028 as is, and the import must not end a line on it
+    username = f'separator_{fmt}'
+    test_client.post('/register', json={'username': username, 'full_name': 'Line Separator', 'password': 'pw', 'age': 40, 'address': 'line1\u2028line2', 'gender': 'Female', 'marital_status': 'Single'})
+    fields = CUSTOMER_FIELDS + ('password_hash',)
+    query = db.session.query(*[getattr(Customer, field) for field in fields]).filter(Customer.username == username)
+    body = ''.join(export_customers(query, fields, fmt))
+    assert '\u2028' in body
+    db.session.delete(db.session.get(Customer, username))
+    db.session.commit()
+
+    response = test_client.post(f'/customers/import?format={fmt}', data=body.encode('utf-8'))
+    assert (response.json['imported'], response.json['failed']) == (1, 0)
+    assert db.session.get(Customer, username).address == 'line1\u2028line2'
+
+def test_export_customers_csv(test_client):
+    response = test_client.get('/customers?format=csv&fields=username,age')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    assert rows[0] == ['username', 'age']
+    assert rows[1:] == sorted(rows[1:])
+    assert ['csv0', '30'] in rows
+
+def test_password_hasher_configuration(monkeypatch):
+    monkeypatch.setenv('PASSWORD_HASH_METHOD', 'pbkdf2')
+    monkeypatch.setenv('PASSWORD_HASH_COST', '1000')
+    hasher = PasswordHasher(workers=2)
+    assert hasher.method == 'pbkdf2:sha256:1000'
+    hashes = hasher.hash_many(['a', 'b', 'c'])
+    assert [check_password_hash(h, p) for h, p in zip(hashes, 'abc')] == [True, True, True]
+    assert hashes[0].startswith('pbkdf2:sha256:1000$')
+    assert PasswordHasher(method='scrypt', cost=16384, workers=0).hash('a').startswith('scrypt:16384:8:1$')
+
+    with pytest.raises(ValueError):
+        PasswordHasher(method='md5')
+
 def test_register_duplicate_customer(test_client, new_customer):
     # Setup - Attempt to register a customer with the same username
     db.session.add(new_customer)
@@ -159,3 +414,113 @@ def test_delete_customer(test_client, new_customer):
     assert response.status_code == 404
 
 
+
+def test_sqlite_pragmas(test_client):
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+            assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+
+def test_sqlite_pragmas_from_environment(monkeypatch):
+    from db_config import sqlite_pragmas
+    monkeypatch.setenv('SQLITE_JOURNAL_MODE', 'DELETE')
+    monkeypatch.setenv('SQLITE_MMAP_SIZE', '')
+    pragmas = sqlite_pragmas()
+    assert pragmas['journal_mode'] == 'DELETE'
+    assert 'mmap_size' not in pragmas
+
+    monkeypatch.setenv('SQLITE_CACHE_SIZE', '1; DROP TABLE customer')
+    with pytest.raises(ValueError):
+        sqlite_pragmas()
+
+def test_database_url_and_pool_options(monkeypatch):
+    from db_config import database_url, engine_options
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    assert database_url('/data/customers.db') == 'sqlite:////data/customers.db'
+    monkeypatch.setenv('DATABASE_URL', 'postgres://shop@db/customers')
+    assert database_url('/data/customers.db') == 'postgresql://shop@db/customers'
+
+    monkeypatch.setenv('DB_POOL_SIZE', '20')
+    options = engine_options('postgresql://shop@db/customers')
+    assert options == {'pool_pre_ping': True, 'pool_size': 20, 'max_overflow': 10, 'pool_timeout': 30, 'pool_recycle': 1800}
+    assert engine_options('sqlite:////data/customers.db')['pool_pre_ping'] is False
+    assert engine_options('sqlite:///:memory:') == {'pool_pre_ping': False}
+
+    monkeypatch.setenv('DB_POOL_PRE_PING', 'maybe')
+    with pytest.raises(ValueError):
+        engine_options('sqlite:////data/customers.db')
+
+def test_metrics(test_client):
+    test_client.get('/balance/nobody')
+    test_client.get('/customers?limit=1')
+    body = test_client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE http_requests_total counter' in body
+    assert 'http_requests_total{method="GET",route="/balance/<username>",status="404"}' in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/customers",le="+Inf"}' in body
+    assert 'http_requests_in_flight 1' in body  # the /metrics request itself
+    count = next(line for line in body.splitlines() if line.startswith('http_request_db_queries_sum{route="/balance/<username>"}'))
+    assert float(count.split()[-1]) >= 1
+
+def test_metrics_shared_directory(tmp_path):
+    from metrics import Metrics
+    first, second = Metrics(directory=str(tmp_path)), Metrics(directory=str(tmp_path))
+    first.inc('http_requests_total', {'method': 'GET', 'route': '/', 'status': '200'})
+    first.observe('http_request_duration_seconds', {'method': 'GET', 'route': '/'}, 0.02)
+    first.flush(force=True)
+    # Both registries live in this process, so move the first one's file as another worker's would be
+    os.replace(tmp_path / f'{os.getpid()}.json', tmp_path / 'worker.json')
+    second.inc('http_requests_total', {'method': 'GET', 'route': '/', 'status': '200'}, 2)
+    body = second.render()
+    assert 'http_requests_total{method="GET",route="/",status="200"} 3' in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/",le="0.025"} 1' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="/"} 1' in body
+
+def test_metrics_archive_exited_workers(tmp_path):
+    import subprocess
+    import sys
+    from metrics import Metrics, archive_process
+    # Two short-lived worker processes each record a request, then exit
+    script = ("from metrics import Metrics; m = Metrics(directory=%r); "
+              "m.inc('http_requests_total', {'method': 'GET', 'route': '/', 'status': '200'}); "
+              "m.inc('http_requests_in_flight', {}); m.flush(force=True); print(__import__('os').getpid())") % str(tmp_path)
+    pids = [int(subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               capture_output=True, text=True, check=True).stdout) for _ in range(2)]
+    scraper = Metrics(directory=str(tmp_path))
+    assert 'http_requests_total{method="GET",route="/",status="200"} 2' in scraper.render()
+
+    for pid in pids:
+        archive_process(str(tmp_path), pid)
+    # Their files are gone, but their counts are kept; the gauges of exited processes are not
+    assert {path.name for path in tmp_path.iterdir()} == {'archive.json', f'{os.getpid()}.json'}
+    body = scraper.render()
+    assert 'http_requests_total{method="GET",route="/",status="200"} 2' in body
+    assert '\nhttp_requests_in_flight ' not in body
+
+def test_gunicorn_worker_flushes_metrics_on_exit(tmp_path, monkeypatch):
+    # A recycled worker must not lose the requests it served since its last write
+    import runpy
+    from types import SimpleNamespace
+    metrics = app.extensions['metrics']
+    monkeypatch.setattr(metrics, 'directory', str(tmp_path))
+    metrics.flush(force=True)
+    metrics.inc('http_requests_total', {'method': 'GET', 'route': '/exit', 'status': '200'})
+    metrics.flush()
+    config = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py'))
+    config['worker_exit'](None, SimpleNamespace(wsgi=app, pid=os.getpid()))
+    with open(tmp_path / f'{os.getpid()}.json') as stream:
+        counters = json.load(stream)['counters']
+    assert ['http_requests_total', [['method', 'GET'], ['route', '/exit'], ['status', '200']], 1] in counters
+
+def test_gunicorn_hooks_skip_empty_metrics_dir(tmp_path, monkeypatch):
+    # An empty METRICS_DIR disables the shared metrics; the hooks must not archive into the working directory
+    import runpy
+    from types import SimpleNamespace
+    (tmp_path / '1.json').write_text('{}')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('METRICS_DIR', '')
+    config = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py'))
+    config['on_starting'](None)
+    config['child_exit'](None, SimpleNamespace(pid=1))
+    assert os.environ['METRICS_DIR'] == ''
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['1.json']
@@ -1,15 +1,50 @@
-from flask import Flask, jsonify, request
-from flask_sqlalchemy import SQLAlchemy
+from flask import Blueprint, Flask, Response, current_app, jsonify, request, stream_with_context
+from sqlalchemy import bindparam, delete, func, insert, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from functools import partial
+import click
+import contextlib
+import csv
+import json
+import math
+import requests
 import os
+import sys
 
-app = Flask(__name__)
+from db_config import configure_engine, database_url, db, engine_options
+from idempotency import idempotent, purge_idempotency_records
+from json_provider import JSONProvider, records
+from metrics import Metrics
+from request_body import open_request_text
+from startup import StartupTimer, measure_cold_start
+from versions import bump_version, conditional, ensure_versions
+from worker import BackgroundWorker
+
+# Routes and commands of the service, registered on each app built by create_app
+bp = Blueprint('inventory', __name__, cli_group=None)
+
+# Listing configuration
+GOODS_FIELDS = ('id', 'name', 'category', 'price', 'description', 'stock_count')
+DEFAULT_GOODS_FIELDS = ('id', 'name', 'category', 'price')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+
+# Catalog import configuration
+UPSERT_FIELDS = ('category', 'price', 'description', 'stock_count')
+NEW_ITEM_FIELDS = ('category', 'price', 'stock_count')
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+MAX_IMPORT_DETAILS = 1000
+
+# URL to Sales API, notified when item details it caches change (optional)
+sales_service_url = os.environ.get('SALES_SERVICE_URL')
+NOTIFY_TIMEOUT = 0.5
 
 # Database Configuration for Inventory Service
 base_dir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(base_dir, 'database.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+metrics = Metrics()
 
 class InventoryItem(db.Model):
     """
@@ -17,14 +52,14 @@ class InventoryItem(db.Model):
 
     Attributes:
         id (int): Unique identifier for the inventory item.
-        name (str): Name of the inventory item.
+        name (str): Unique, indexed name of the inventory item.
         category (str): Category of the inventory item.
         price (float): Price of the inventory item.
         description (str): Description of the inventory item.
         stock_count (int): Quantity of the inventory item in stock.
     """
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, unique=True, index=True)
     category = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
     description = db.Column(db.String(200))
@@ -33,25 +68,414 @@ class InventoryItem(db.Model):
     def __repr__(self):
         return f'<InventoryItem {self.name}>'
 
-    def to_dict(self):
+    def to_dict(self, include_stock=False):
         """
         Convert inventory item details into a dictionary.
 
+        Args:
+            include_stock (bool): Whether to include the current ``stock_count``.
+
         Returns:
             dict: Dictionary containing key details of the inventory item.
         """
-        return {
+        details = {
             'id': self.id,
             'name': self.name,
             'category': self.category,
             'price': self.price,
         }
+        if include_stock:
+            details['stock_count'] = self.stock_count
+        return details
+
+class StockReservation(db.Model):
+    """
+    Units of an inventory item held for a sale that is still in progress.
+
+    The units leave ``stock_count`` as soon as they are reserved. Committing the reservation makes the deduction
+    permanent; releasing it, or letting it expire, puts the units back in stock.
+
+    Attributes:
+        id (int): Unique identifier for the reservation.
+        item_id (int): The reserved inventory item.
+        amount (int): Number of units held.
+        expires_at (datetime): Time after which the reservation can no longer be committed and is swept.
+        created_at (datetime): Time the reservation was made.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('inventory_item.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        """
+        Convert reservation details into a dictionary.
+
+        Returns:
+            dict: Dictionary containing the reservation details.
+        """
+        return {
+            'reservation_id': self.id,
+            'item_id': self.item_id,
+            'amount': self.amount,
+            'expires_at': self.expires_at.isoformat(),
+        }
+
+@bp.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys():
+    """Deletes expired idempotency records. They are also purged periodically while the service handles requests."""
+    print(f'{purge_idempotency_records()} expired idempotency records deleted')
+
+def deduct_stock(item_id, amount):
+    """
+    Deducts stock from an item with a single conditional update, without committing.
+
+    The update only matches while ``stock_count >= amount``, so concurrent deductions can never drive the stock
+    negative.
+
+    Args:
+        item_id (int): The unique identifier of the item.
+        amount (int): The number of units to deduct.
+
+    Returns:
+        int: The new stock count, or None if the item does not exist or has too little stock.
+    """
+    result = db.session.execute(
+        update(InventoryItem)
+        .where(InventoryItem.id == item_id, InventoryItem.stock_count >= amount)
+        .values(stock_count=InventoryItem.stock_count - amount)
+        .returning(InventoryItem.stock_count)
+    )
+    return result.scalar()
+
+def restock(item_id, amount):
+    """
+    Adds stock back to an item with a single update, without committing.
+
+    Args:
+        item_id (int): The unique identifier of the item.
+        amount (int): The number of units to add.
+
+    Returns:
+        int: The new stock count, or None if the item does not exist.
+    """
+    result = db.session.execute(
+        update(InventoryItem)
+        .where(InventoryItem.id == item_id)
+        .values(stock_count=InventoryItem.stock_count + amount)
+        .returning(InventoryItem.stock_count)
+    )
+    return result.scalar()
+
+def sweep_reservations(limit):
+    """
+    Returns the units of expired reservations to stock, in bulk.
+
+    The expired reservations are deleted with one statement that returns what they held, and the stock of every
+    affected item is then restored with a single batched update, so a sweep costs the same few statements however
+    many reservations expired. Because the delete decides which reservations are swept, a reservation committed or
+    released concurrently is never returned to stock twice.
+
+    Args:
+        limit (int): Maximum number of reservations to sweep in one transaction.
+
+    Returns:
+        int: The number of reservations swept.
+    """
+    expired = select(StockReservation.id).where(StockReservation.expires_at <= datetime.utcnow()).limit(limit)
+    swept = db.session.execute(
+        delete(StockReservation)
+        .where(StockReservation.id.in_(expired))
+        .returning(StockReservation.item_id, StockReservation.amount)
+    ).all()
+    if not swept:
+        db.session.rollback()
+        return 0
+
+    returned = {}
+    for item_id, amount in swept:
+        returned[item_id] = returned.get(item_id, 0) + amount
+    items = InventoryItem.__table__
+    db.session.execute(
+        update(items)
+        .where(items.c.id == bindparam('item'))
+        .values(stock_count=items.c.stock_count + bindparam('amount')),
+        [{'item': item_id, 'amount': amount} for item_id, amount in returned.items()],
+    )
+    bump_version('inventory_item')
+    db.session.commit()
+    return len(swept)
+
+def process_expired_reservations(app):
+    """
+    Sweeps one batch of expired reservations.
+
+    Args:
+        app (Flask): The application whose database is swept.
+
+    Returns:
+        int: The number of reservations swept.
+    """
+    with app.app_context():
+        try:
+            return sweep_reservations(app.config['RESERVATION_SWEEP_BATCH'])
+        finally:
+            db.session.remove()
+
+@bp.cli.command('reservation-sweeper')
+def run_reservation_sweeper():
+    """Sweeps expired reservations in the foreground, for running the sweeper as a separate process."""
+    current_app.extensions['reservation_sweeper'].run_forever()
+
+def migrate_schema():
+    """
+    Brings an existing database up to the current schema.
 
-# Create the database tables
-with app.app_context():
+    Databases created before item names were unique may hold several rows with the same name. The oldest row
+    (lowest id) is kept, the stock of the newer duplicates is added to it and the duplicates are deleted, after
+    which the unique index on ``name`` is created.
+    """
+    index_name = 'ix_inventory_item_name'
+    if any(index['name'] == index_name for index in inspect(db.engine).get_indexes('inventory_item')):
+        return
+
+    duplicates = db.session.query(InventoryItem.name, func.min(InventoryItem.id)) \
+        .group_by(InventoryItem.name).having(func.count() > 1).all()
+    for name, keep_id in duplicates:
+        extra_stock = db.session.query(func.sum(InventoryItem.stock_count)) \
+            .filter(InventoryItem.name == name, InventoryItem.id != keep_id).scalar()
+        db.session.query(InventoryItem).filter(InventoryItem.name == name, InventoryItem.id != keep_id) \
+            .delete(synchronize_session=False)
+        db.session.query(InventoryItem).filter(InventoryItem.id == keep_id) \
+            .update({InventoryItem.stock_count: InventoryItem.stock_count + extra_stock}, synchronize_session=False)
+
+    db.session.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON inventory_item (name)'))
+    db.session.commit()
+
+def notify_item_changed(*names):
+    """
+    Asks the Sales Service to drop its cached copies of the given items.
+
+    This is best effort: failures are logged and never fail the update that triggered them, since the Sales
+    Service cache entries expire on their own.
+
+    Args:
+        *names (str): The names under which the items may be cached.
+    """
+    if not sales_service_url:
+        return
+    try:
+        requests.post(f'{sales_service_url}/cache/invalidate', json={'names': list(dict.fromkeys(names))}, timeout=NOTIFY_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to notify Sales Service of item change: {e}")
+
+def read_item_records(stream, fmt):
+    """
+    Parses items from a CSV (with a header row) or NDJSON text stream, one record at a time.
+
+    Args:
+        stream (io.TextIOBase): The text to parse. CSV streams must be opened with ``newline=''``.
+        fmt (str): ``csv`` or ``ndjson``.
+
+    Yields:
+        tuple: ``(line number, item dict)``, with None instead of the dict for a line that is not valid JSON.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record
+
+def parse_item(record):
+    """
+    Validates one item of a catalog import.
+
+    Only the name is required; the other fields are only updated when present. Empty CSV cells count as absent.
+
+    Args:
+        record (dict): The item details.
+
+    Returns:
+        tuple: ``(validated fields, None)``, or ``(None, error message)``.
+    """
+    if not isinstance(record, dict):
+        return None, 'Invalid JSON'
+    name = record.get('name')
+    if not isinstance(name, str) or not name:
+        return None, 'Missing name'
+
+    values = {'name': name}
+    for field in UPSERT_FIELDS:
+        value = record.get(field)
+        if value is None or value == '':
+            continue
+        try:
+            if field == 'price':
+                value = float(value)
+            elif field == 'stock_count':
+                value = int(value)
+            else:
+                value = str(value)
+        except (TypeError, ValueError):
+            return None, f'Invalid {field}'
+        if field in ('price', 'stock_count') and value < 0:
+            return None, f'Invalid {field}'
+        values[field] = value
+    return values, None
+
+def record_import_detail(report, key, detail):
+    """
+    Adds a rejected row or a planned change to an import report, keeping at most ``MAX_IMPORT_DETAILS`` of each.
+
+    Args:
+        report (dict): The import report, updated in place.
+        key (str): ``errors`` or ``changes``.
+        detail (dict): The row details.
+    """
+    if len(report[key]) < MAX_IMPORT_DETAILS:
+        report[key].append(detail)
+    else:
+        report[f'{key}_truncated'] = True
+
+def upsert_item_batch(batch, report, dry_run=False):
+    """
+    Inserts or updates one batch of catalog items in a single transaction.
+
+    The existing items of the batch are read with one query, and the batch is written with at most one batched
+    insert and one batched update, leaving unchanged items untouched.
+
+    Args:
+        batch (list): ``(line number, validated fields)`` tuples with distinct names.
+        report (dict): The import report, updated in place.
+        dry_run (bool): Only report the changes, without writing them.
+    """
+    columns = [InventoryItem.id, InventoryItem.name] + [getattr(InventoryItem, field) for field in UPSERT_FIELDS]
+    for attempt in range(2):
+        names = [values['name'] for _, values in batch]
+        existing = {row.name: row._mapping for row in db.session.query(*columns).filter(InventoryItem.name.in_(names))}
+
+        errors, changes, inserts, updates, unchanged = [], [], [], [], 0
+        for line, values in batch:
+            current = existing.get(values['name'])
+            if current is None:
+                missing = [field for field in NEW_ITEM_FIELDS if field not in values]
+                if missing:
+                    errors.append({'line': line, 'name': values['name'], 'error': f'New item is missing {", ".join(missing)}'})
+                    continue
+                row = dict({'description': ''}, **values)
+                inserts.append(row)
+                changes.append({'line': line, 'name': row['name'], 'action': 'insert', 'changes': {field: [None, row[field]] for field in UPSERT_FIELDS}})
+                continue
+
+            diff = {field: [current[field], value] for field, value in values.items() if field != 'name' and current[field] != value}
+            if not diff:
+                unchanged += 1
+                continue
+            updates.append(dict({f'new_{field}': current[field] for field in UPSERT_FIELDS}, item=current['id'],
+                                **{f'new_{field}': value for field, value in values.items() if field != 'name'}))
+            changes.append({'line': line, 'name': values['name'], 'action': 'update', 'changes': diff})
+
+        if dry_run or not (inserts or updates):
+            break
+        try:
+            if inserts:
+                db.session.execute(insert(InventoryItem), inserts)
+            if updates:
+                items = InventoryItem.__table__
+                db.session.execute(
+                    update(items)
+                    .where(items.c.id == bindparam('item'))
+                    .values({field: bindparam(f'new_{field}') for field in UPSERT_FIELDS}),
+                    updates,
+                )
+            bump_version('inventory_item')
+            db.session.commit()
+            break
+        except IntegrityError:
+            # An item of the batch was added concurrently: read the batch again, it is now an update
+            db.session.rollback()
+            if attempt:
+                raise
+
+    report['inserted'] += len(inserts)
+    report['updated'] += len(updates)
+    report['unchanged'] += unchanged
+    report['failed'] += len(errors)
+    for error in errors:
+        record_import_detail(report, 'errors', error)
+    if dry_run:
+        for change in changes:
+            record_import_detail(report, 'changes', change)
+    elif updates:
+        notify_item_changed(*[change['name'] for change in changes if change['action'] == 'update'])
+
+def upsert_items(records, dry_run=False, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Inserts new catalog items and updates existing ones, matched by name, in batched transactions.
+
+    Existing items get the category, price, description and stock count of the row, for the fields the row has;
+    new items need at least a category, price and stock count. Rows that are invalid, or repeat a name already seen
+    in the same import, are reported and skipped. In a dry run nothing is written and the report lists the changes
+    that would be made instead.
+
+    Args:
+        records (iterable): ``(line number, item dict)`` tuples, as produced by :func:`read_item_records`.
+        dry_run (bool): Only report the changes, without writing them.
+        batch_size (int): Number of items written per transaction.
+
+    Returns:
+        dict: The numbers of items inserted, updated, unchanged and rejected, the first rejected rows and, in a dry
+        run, the first changes.
+    """
+    report = {'dry_run': dry_run, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'failed': 0, 'errors': [], 'errors_truncated': False}
+    if dry_run:
+        report.update(changes=[], changes_truncated=False)
+
+    seen = set()
+    batch = []
+    for line, record in records:
+        values, error = parse_item(record)
+        if not error and values['name'] in seen:
+            error = 'Duplicate name in import'
+        if error:
+            report['failed'] += 1
+            record_import_detail(report, 'errors', {'line': line, 'name': record.get('name') if isinstance(record, dict) else None, 'error': error})
+            continue
+
+        seen.add(values['name'])
+        batch.append((line, values))
+        if len(batch) >= batch_size:
+            upsert_item_batch(batch, report, dry_run)
+            batch = []
+
+    if batch:
+        upsert_item_batch(batch, report, dry_run)
+    report['errors'].sort(key=lambda error: error['line'])
+    return report
+
+def migrate():
+    """Creates the tables and version rows that do not exist yet, then upgrades the existing tables."""
     db.create_all()
+    migrate_schema()
+    ensure_versions('inventory_item')
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Creates or upgrades the database schema. Run it once per deploy, before the workers start."""
+    migrate()
+    print('Database schema is up to date')
 
-@app.route('/')
+@bp.route('/')
 def home():
     """
     Home endpoint returning a welcome message.
@@ -61,18 +485,96 @@ def home():
     """
     return "Welcome to the Inventory Service API!"
 
-@app.route('/inventory/goods', methods=['GET'])
+def query_number(name, parse, default=None):
+    """
+    Reads a numeric query parameter, rejecting malformed values instead of ignoring them.
+
+    Args:
+        name (str): The query parameter.
+        parse (type): ``int`` or ``float``.
+        default: The value when the parameter is absent.
+
+    Returns:
+        The parsed number, or ``default``.
+
+    Raises:
+        ValueError: If the parameter is not a finite number of the given type.
+    """
+    if name not in request.args:
+        return default
+    try:
+        value = parse(request.args[name])
+    except ValueError:
+        raise ValueError(f'Invalid {name}') from None
+    if not math.isfinite(value):
+        raise ValueError(f'Invalid {name}')
+    return value
+
+@bp.route('/inventory/goods', methods=['GET'])
+@conditional('inventory_item')
 def get_goods():
     """
-    API endpoint to fetch all goods in the inventory.
+    API endpoint to fetch goods in the inventory, one page at a time.
+
+    Pages are ordered by id and addressed with a keyset cursor: pass the ``next_cursor`` of one page as ``after``
+    to fetch the next one. With ``format=ndjson`` every matching item is streamed as one JSON object per line
+    instead, for full exports.
+
+    Query Parameters:
+        after (int): Only return items with an id greater than this cursor.
+        limit (int): Page size, at most 1000 (default 100).
+        category (str): Only return items in this category.
+        min_price (float): Only return items priced at least this much.
+        max_price (float): Only return items priced at most this much.
+        fields (str): Comma-separated fields to return (default ``id,name,category,price``).
+        format (str): ``json`` (default) or ``ndjson``.
 
     Returns:
-        JSON: A list of goods from the inventory with their details.
+        JSON: A page of goods and the cursor of the next page, or an NDJSON stream of goods.
     """
-    goods = InventoryItem.query.all()
-    return jsonify({'Inventory': [good.to_dict() for good in goods]}), 200
+    fields = request.args.get('fields')
+    fields = tuple(fields.split(',')) if fields else DEFAULT_GOODS_FIELDS
+    if any(field not in GOODS_FIELDS for field in fields):
+        return jsonify({'error': f'Unknown field, choose from {", ".join(GOODS_FIELDS)}'}), 400
+
+    try:
+        after = query_number('after', int)
+        limit = query_number('limit', int, DEFAULT_PAGE_SIZE)
+        min_price = query_number('min_price', float)
+        max_price = query_number('max_price', float)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    category = request.args.get('category')
+    if limit <= 0:
+        return jsonify({'error': 'Invalid limit'}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
 
-@app.route('/inventory/goods/<string:name>', methods=['GET'])
+    # Query only the requested columns, plus id for the cursor, last so the rows line up with the fields
+    query = db.session.query(*[getattr(InventoryItem, field) for field in dict.fromkeys(fields + ('id',))])
+    if category is not None:
+        query = query.filter(InventoryItem.category == category)
+    if min_price is not None:
+        query = query.filter(InventoryItem.price >= min_price)
+    if max_price is not None:
+        query = query.filter(InventoryItem.price <= max_price)
+    if after is not None:
+        query = query.filter(InventoryItem.id > after)
+    query = query.order_by(InventoryItem.id)
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for row in query.execution_options(yield_per=EXPORT_CHUNK_SIZE):
+                yield current_app.json.dumps(dict(zip(fields, row))) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    # Fetch one extra row to learn whether another page follows
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({'Inventory': records(fields, rows), 'next_cursor': rows[-1].id if has_more else None}), 200
+
+@bp.route('/inventory/goods/<string:name>', methods=['GET'])
+@conditional('inventory_item')
 def get_good(name):
     """
     API endpoint to fetch a specific item by its name.
@@ -81,14 +583,59 @@ def get_good(name):
         name (str): The name of the item to retrieve.
 
     Returns:
-        JSON: Details of the requested item or an error message.
+        JSON: Details of the requested item, including its stock count, or an error message.
     """
     good = InventoryItem.query.filter_by(name=name).first()
     if not good:
         return jsonify({'error': 'Item not found'}), 404
-    return jsonify(good.to_dict()), 200
+    return jsonify(good.to_dict(include_stock=True)), 200
+
+@bp.route('/inventory/lookup', methods=['GET'])
+def lookup_good():
+    """
+    API endpoint to fetch a single item by id or by name, including its stock count.
+
+    Query Parameters:
+        id (int): The unique identifier of the item.
+        name (str): The name of the item, used when ``id`` is not given.
+
+    Returns:
+        JSON: Details of the requested item including ``stock_count``, or an error message.
+    """
+    item_id = request.args.get('id', type=int)
+    name = request.args.get('name')
+    if item_id is not None:
+        good = db.session.get(InventoryItem, item_id)
+    elif name:
+        good = InventoryItem.query.filter_by(name=name).first()
+    else:
+        return jsonify({'error': 'An id or name is required'}), 400
+
+    if not good:
+        return jsonify({'error': 'Item not found'}), 404
+    return jsonify(good.to_dict(include_stock=True)), 200
 
-@app.route('/inventory/add', methods=['POST'])
+@bp.route('/inventory/goods/bulk', methods=['POST'])
+def get_goods_bulk():
+    """
+    API endpoint to fetch many items by name in a single query.
+
+    Expects a JSON body of the form ``{"names": ["Laptop", "Phone"]}``.
+
+    Returns:
+        JSON: The matching items and the list of names that were not found.
+    """
+    data = request.json
+    names = data.get('names') if isinstance(data, dict) else None
+    if not isinstance(names, list) or not names or not all(isinstance(name, str) for name in names):
+        return jsonify({'error': 'Invalid input data'}), 400
+
+    found = {good.name: good for good in InventoryItem.query.filter(InventoryItem.name.in_(set(names)))}
+
+    missing = [name for name in dict.fromkeys(names) if name not in found]
+    return jsonify({'Inventory': [good.to_dict() for good in found.values()], 'missing': missing}), 200
+
+@bp.route('/inventory/add', methods=['POST'])
 def add_goods():
     """
     API endpoint to add a new item to the inventory.
@@ -108,11 +655,16 @@ def add_goods():
         stock_count=data['stock_count']
     )
 
-    db.session.add(new_item)
-    db.session.commit()
+    try:
+        db.session.add(new_item)
+        bump_version('inventory_item')
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Item already exists'}), 409
     return jsonify({'message': 'Item added successfully'}), 201
 
-@app.route('/inventory/update/<int:item_id>', methods=['PUT'])
+@bp.route('/inventory/update/<int:item_id>', methods=['PUT'])
 def update_goods(item_id):
     """
     API endpoint to update the details of an existing inventory item.
@@ -131,13 +683,22 @@ def update_goods(item_id):
     if 'stock_count' in data and data['stock_count'] < 0:
         return jsonify({'error': 'Invalid stock count'}), 400
 
+    old_name = item.name
     for key, value in data.items():
         setattr(item, key, value)
 
-    db.session.commit()
+    try:
+        bump_version('inventory_item')
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Item already exists'}), 409
+
+    notify_item_changed(old_name, item.name)
     return jsonify({'message': 'Item updated successfully'}), 200
 
-@app.route('/inventory/deduce/<int:item_id>', methods=['POST'])
+@bp.route('/inventory/deduce/<int:item_id>', methods=['POST'])
+@idempotent
 def deduce_goods(item_id):
     """
     API endpoint to reduce the stock count of an inventory item.
@@ -148,17 +709,323 @@ def deduce_goods(item_id):
     Returns:
         JSON: A success message or an error message.
     """
-    item = db.session.get(InventoryItem, item_id)
-    if not item:
-        return jsonify({'error': 'Item not found'}), 404
-
     amount = request.json.get('amount', 1)
-    if amount <= 0 or item.stock_count < amount:
+    if amount <= 0:
+        return jsonify({'error': 'Invalid deduction amount'}), 400
+
+    new_stock_count = deduct_stock(item_id, amount)
+    if new_stock_count is None:
+        db.session.rollback()
+        if not db.session.get(InventoryItem, item_id):
+            return jsonify({'error': 'Item not found'}), 404
         return jsonify({'error': 'Invalid deduction amount'}), 400
 
-    item.stock_count -= amount
+    bump_version('inventory_item')
+    db.session.commit()
+    return jsonify({'message': f'{amount} units deduced', 'new_stock_count': new_stock_count}), 200
+
+def is_stock_line(line):
+    """
+    Tells whether a line of a bulk stock request is ``{"item_id": <int>, "amount": <positive int>}``.
+
+    The amount defaults to 1. Booleans are integers in Python, but not valid ids or amounts.
+
+    Args:
+        line: A line of the request body.
+
+    Returns:
+        bool: True if the line is valid.
+    """
+    if not isinstance(line, dict):
+        return False
+    item_id, amount = line.get('item_id'), line.get('amount', 1)
+    return all(isinstance(value, int) and not isinstance(value, bool) for value in (item_id, amount)) and amount > 0
+
+@bp.route('/inventory/deduce/bulk', methods=['POST'])
+@idempotent
+def deduce_goods_bulk():
+    """
+    API endpoint to reduce the stock count of many inventory items in one transaction.
+
+    Expects a JSON body of the form ``{"items": [{"item_id": 1, "amount": 2}, ...], "partial": false}``. Each line
+    is applied as a conditional update that only succeeds while enough stock is left. By default either every line
+    is applied or none is; with ``"partial": true`` the lines that succeed are committed and the rest are reported.
+
+    Returns:
+        JSON: Per-line results, or an error message if any line could not be applied.
+    """
+    data = request.json if isinstance(request.json, dict) else {}
+    lines = data.get('items')
+    partial = bool(data.get('partial', False))
+    if not isinstance(lines, list) or not lines:
+        return jsonify({'error': 'Invalid input data'}), 400
+
+    for line in lines:
+        if not is_stock_line(line):
+            return jsonify({'error': 'Invalid deduction line', 'line': line}), 400
+
+    results = []
+    for line in lines:
+        item_id, amount = line['item_id'], line.get('amount', 1)
+        new_stock_count = deduct_stock(item_id, amount)
+        results.append({'item_id': item_id, 'amount': amount, 'success': new_stock_count is not None, 'new_stock_count': new_stock_count})
+
+    failed = [line for line in results if not line['success']]
+    if failed:
+        # One lookup tells "not found" apart from "insufficient stock" for every failed line
+        failed_ids = {line['item_id'] for line in failed}
+        existing = {item_id for (item_id,) in db.session.query(InventoryItem.id).filter(InventoryItem.id.in_(failed_ids))}
+        for line in failed:
+            line['error'] = 'Insufficient stock' if line['item_id'] in existing else 'Item not found'
+
+    if failed and not partial:
+        db.session.rollback()
+        for line in results:
+            line['new_stock_count'] = None
+        return jsonify({'error': 'Insufficient stock or item not found', 'results': results}), 409
+
+    applied = len(results) - len(failed)
+    if applied:
+        bump_version('inventory_item')
     db.session.commit()
-    return jsonify({'message': f'{amount} units deduced', 'new_stock_count': item.stock_count}), 200
+    return jsonify({'message': f'{applied} lines deduced', 'applied': applied, 'failed': len(failed), 'results': results}), 200
+
+@bp.route('/inventory/restock/bulk', methods=['POST'])
+@idempotent
+def restock_goods_bulk():
+    """
+    API endpoint to add stock back to many inventory items in one transaction.
+
+    Expects a JSON body of the form ``{"items": [{"item_id": 1, "amount": 2}, ...]}``, typically to undo a bulk
+    deduction whose sale did not go through.
+
+    Returns:
+        JSON: A success message, or an error message if any item does not exist.
+    """
+    lines = request.json.get('items') if isinstance(request.json, dict) else None
+    if not isinstance(lines, list) or not lines:
+        return jsonify({'error': 'Invalid input data'}), 400
+
+    for line in lines:
+        if not is_stock_line(line):
+            return jsonify({'error': 'Invalid restock line', 'line': line}), 400
+
+    for line in lines:
+        if restock(line['item_id'], line.get('amount', 1)) is None:
+            db.session.rollback()
+            return jsonify({'error': 'Item not found', 'line': line}), 404
+
+    bump_version('inventory_item')
+    db.session.commit()
+    return jsonify({'message': f'{len(lines)} lines restocked'}), 200
+
+@bp.route('/inventory/reserve/<int:item_id>', methods=['POST'])
+@idempotent
+def reserve_goods(item_id):
+    """
+    API endpoint to hold units of an item for a sale in progress.
+
+    Expects an optional JSON body ``{"amount": 1, "ttl": 30}``. The units are taken out of stock with the same
+    conditional update as a deduction, so concurrent buyers of the same item never wait on each other for more than
+    that one statement and can never reserve more than is in stock. The reservation must be committed before it
+    expires, otherwise the units are returned to stock by the background sweeper.
+
+    Args:
+        item_id (int): The unique identifier of the item to reserve.
+
+    Returns:
+        JSON: The reservation and the new stock count, or an error message.
+    """
+    data = request.get_json(silent=True) or {}
+    amount = data.get('amount', 1)
+    ttl = data.get('ttl', current_app.config['RESERVATION_TTL'])
+    if not isinstance(amount, int) or amount <= 0:
+        return jsonify({'error': 'Invalid reservation amount'}), 400
+    if not isinstance(ttl, (int, float)) or not 0 < ttl <= current_app.config['RESERVATION_MAX_TTL']:
+        return jsonify({'error': 'Invalid reservation TTL'}), 400
+
+    new_stock_count = deduct_stock(item_id, amount)
+    if new_stock_count is None:
+        db.session.rollback()
+        if not db.session.get(InventoryItem, item_id):
+            return jsonify({'error': 'Item not found'}), 404
+        return jsonify({'error': 'Insufficient stock'}), 409
+
+    reservation = StockReservation(item_id=item_id, amount=amount, expires_at=datetime.utcnow() + timedelta(seconds=ttl))
+    db.session.add(reservation)
+    bump_version('inventory_item')
+    db.session.commit()
+
+    # The server starts the sweeper with the process; starting it here covers servers that do not
+    current_app.extensions['reservation_sweeper'].start()
+    return jsonify({**reservation.to_dict(), 'new_stock_count': new_stock_count}), 201
+
+@bp.route('/inventory/reservations/<int:reservation_id>/commit', methods=['POST'])
+def commit_reservation(reservation_id):
+    """
+    API endpoint to make a reservation's deduction permanent once the sale went through.
+
+    Args:
+        reservation_id (int): The id returned when the units were reserved.
+
+    Returns:
+        JSON: A success message, or an error message if the reservation expired or no longer exists.
+    """
+    result = db.session.execute(
+        delete(StockReservation)
+        .where(StockReservation.id == reservation_id, StockReservation.expires_at > datetime.utcnow())
+    )
+    if result.rowcount == 0:
+        db.session.rollback()
+        return jsonify({'error': 'Reservation not found or expired'}), 404
+
+    db.session.commit()
+    return jsonify({'message': 'Reservation committed'}), 200
+
+@bp.route('/inventory/reservations/<int:reservation_id>/release', methods=['POST'])
+def release_reservation(reservation_id):
+    """
+    API endpoint to return a reservation's units to stock when the sale did not go through.
+
+    Args:
+        reservation_id (int): The id returned when the units were reserved.
+
+    Returns:
+        JSON: A success message with the new stock count, or an error message if the reservation no longer exists.
+    """
+    released = db.session.execute(
+        delete(StockReservation)
+        .where(StockReservation.id == reservation_id)
+        .returning(StockReservation.item_id, StockReservation.amount)
+    ).first()
+    if released is None:
+        db.session.rollback()
+        return jsonify({'error': 'Reservation not found or expired'}), 404
+
+    new_stock_count = restock(released.item_id, released.amount)
+    bump_version('inventory_item')
+    db.session.commit()
+    return jsonify({'message': 'Reservation released', 'new_stock_count': new_stock_count}), 200
+
+@bp.route('/inventory/import', methods=['POST'])
+def import_goods():
+    """
+    API endpoint to insert or update many inventory items from a CSV or NDJSON body, matched by name.
+
+    The body is parsed while it is read and written in batched transactions, so it can hold a whole supplier
+    catalog. The format is taken from the ``format`` query parameter, or else from the ``Content-Type`` (``text/csv``
+    for CSV, NDJSON otherwise). With ``dry_run=true`` nothing is written and the changes are listed instead.
+
+    Returns:
+        JSON: The numbers of items inserted, updated, unchanged and rejected, with the rejected rows.
+    """
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Invalid format, choose csv or ndjson'}), 400
+
+    stream = open_request_text()
+    try:
+        report = upsert_items(read_item_records(stream, fmt), dry_run=request.args.get('dry_run') == 'true')
+    except UnicodeDecodeError:
+        db.session.rollback()
+        return jsonify({'error': 'The import must be UTF-8 encoded'}), 400
+    return jsonify(report), 200
+
+@bp.cli.command('import-goods')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Input format (default: from the file extension).')
+@click.option('--dry-run', is_flag=True, help='Only print the changes, without writing them.')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True, help='Items written per transaction.')
+def import_goods_command(path, fmt, dry_run, batch_size):
+    """Inserts or updates inventory items from a CSV or NDJSON file, or from standard input with PATH ``-``."""
+    fmt = fmt or ('csv' if path.endswith('.csv') else 'ndjson')
+    with (open(path, encoding='utf-8', newline='') if path != '-' else contextlib.nullcontext(sys.stdin)) as stream:
+        report = upsert_items(read_item_records(stream, fmt), dry_run=dry_run, batch_size=batch_size)
+    for change in report.get('changes', []):
+        print(f"line {change['line']}: {change['action']} {change['name']} {json.dumps(change['changes'])}")
+    for error in report['errors']:
+        print(f"line {error['line']}: {error['error']} ({error['name']})", file=sys.stderr)
+    print(f"{'Would insert' if dry_run else 'Inserted'} {report['inserted']}, {'update' if dry_run else 'updated'} "
+          f"{report['updated']}, {report['unchanged']} unchanged, {report['failed']} rejected")
+
+@bp.cli.command('startup-report')
+@click.option('--budget', type=float, help='Fail if a cold start takes longer than this many milliseconds.')
+def startup_report_command(budget):
+    """Measures how long a fresh process takes to import and build the app, phase by phase."""
+    report = measure_cold_start(base_dir)
+    print(json.dumps(report, indent=2))
+    if budget is not None and report['total_ms'] > budget:
+        raise click.ClickException(f"Cold start took {report['total_ms']} ms, over the {budget:g} ms budget")
+
+def load_config():
+    """
+    Reads the service settings from the environment.
+
+    Returns:
+        dict: Flask configuration values.
+    """
+    return {
+        'SQLALCHEMY_DATABASE_URI': database_url(db_path),
+        'JSON_ENCODER': os.environ.get('JSON_ENCODER', 'auto'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        # Stock reservations
+        'RESERVATION_TTL': float(os.environ.get('INVENTORY_RESERVATION_TTL', 30)),
+        'RESERVATION_MAX_TTL': float(os.environ.get('INVENTORY_RESERVATION_MAX_TTL', 600)),
+        'RESERVATION_SWEEPERS': int(os.environ.get('INVENTORY_RESERVATION_SWEEPERS', 1)),
+        'RESERVATION_SWEEP_INTERVAL': float(os.environ.get('INVENTORY_RESERVATION_SWEEP_INTERVAL', 5)),
+        'RESERVATION_SWEEP_BATCH': int(os.environ.get('INVENTORY_RESERVATION_SWEEP_BATCH', 500)),
+        # Idempotency keys
+        'IDEMPOTENCY_TTL': float(os.environ.get('IDEMPOTENCY_TTL', 86400)),
+        'IDEMPOTENCY_LEASE': float(os.environ.get('IDEMPOTENCY_LEASE', 60)),
+        'IDEMPOTENCY_PURGE_INTERVAL': float(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 60)),
+    }
+
+def create_app(config=None):
+    """
+    Builds the Inventory Service app.
+
+    Building the app does not connect to the database: connections are opened by the first request, and the schema
+    is created by the ``migrate`` command instead of on every start. The reservation sweeper is listed in
+    ``app.extensions['background_workers']``; the server starts its threads in every process it serves the app from
+    (see ``post_worker_init`` in ``gunicorn.conf.py``), so reservations left over by a recycled or crashed process
+    are swept without waiting for another reservation. How long each phase took is kept in
+    ``app.extensions['startup_report']``.
+
+    Args:
+        config (dict): Settings overriding the ones read from the environment, e.g. the database URI in tests.
+
+    Returns:
+        Flask: The application.
+    """
+    timer = StartupTimer()
+    app = Flask(__name__)
+    with timer.phase('config'):
+        app.config.update(load_config())
+        app.config.update(config or {})
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+        app.json = JSONProvider(app, app.config['JSON_ENCODER'])
+    with timer.phase('database'):
+        db.init_app(app)
+        configure_engine(app, db)
+    with timer.phase('routes'):
+        app.register_blueprint(bp)
+        metrics.init_app(app, db)
+    # Background worker returning expired reservations to stock
+    app.extensions['reservation_sweeper'] = BackgroundWorker(
+        'reservation-sweeper',
+        partial(process_expired_reservations, app),
+        threads=app.config['RESERVATION_SWEEPERS'],
+        interval=app.config['RESERVATION_SWEEP_INTERVAL'],
+    )
+    app.extensions['background_workers'] = [app.extensions['reservation_sweeper']]
+    app.extensions['startup_report'] = timer.report()
+    return app
 
+# Development server only; in production the app is served by Gunicorn (see gunicorn.conf.py)
 if __name__ == "__main__":
+    app = create_app()
+    with app.app_context():
+        migrate()
+    for background_worker in app.extensions['background_workers']:
+        background_worker.start()
     app.run(host='0.0.0.0', port=5000)
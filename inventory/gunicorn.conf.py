@@ -0,0 +1,97 @@
+"""
+Gunicorn Configuration
+
+Production server settings for the service, used by ``gunicorn --config gunicorn.conf.py``. Each worker builds its own
+app with ``app:create_app()``; the schema is created beforehand with ``flask --app app migrate``. Every setting can
+be overridden with an environment variable; the defaults are derived from the number of CPUs.
+
+- ``GUNICORN_BIND`` (default ``0.0.0.0:5000``): address to listen on.
+- ``GUNICORN_WORKERS`` (default ``2 * CPUs + 1``): worker processes.
+- ``GUNICORN_THREADS`` (default ``4``): threads per worker, so requests waiting on the database or on another
+  service overlap within a worker.
+- ``GUNICORN_TIMEOUT`` (default ``30``): seconds a worker may be silent before it is killed and replaced.
+- ``GUNICORN_GRACEFUL_TIMEOUT`` (default ``30``): seconds workers get to finish their requests on reload or
+  shutdown.
+- ``GUNICORN_KEEPALIVE`` (default ``5``): seconds an idle keep-alive connection stays open.
+- ``GUNICORN_MAX_REQUESTS`` (default ``10000``): requests after which a worker is replaced, with up to 10% jitter
+  so the workers do not restart together; 0 disables it.
+- ``GUNICORN_LOG_LEVEL`` (default ``info``).
+
+The workers share a temporary ``METRICS_DIR`` (unless one is set; an empty one disables sharing), so ``/metrics``
+reports all of them; the metrics of a worker that exits are flushed, then folded into the directory's archive file,
+so recycled workers leave no files behind and their counts are kept. Each worker starts the background threads of
+its app (``app.extensions['background_workers']``, e.g. the sale outbox worker) as soon as it has booted, and logs
+how long it took to boot, from the fork to the app being ready to serve.
+
+Send ``SIGHUP`` to the master process to reload the code and configuration gracefully: new workers are started and
+the old ones exit once their requests are done.
+
+"""
+import os
+import tempfile
+import time
+
+cpus = os.cpu_count() or 1
+
+
+def setting(name, default):
+    """Returns an environment variable, or the default if it is unset or empty."""
+    return os.environ.get(name) or default
+
+
+wsgi_app = 'app:create_app()'
+bind = setting('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(setting('GUNICORN_WORKERS', cpus * 2 + 1))
+worker_class = 'gthread'
+threads = int(setting('GUNICORN_THREADS', 4))
+timeout = int(setting('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(setting('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(setting('GUNICORN_KEEPALIVE', 5))
+max_requests = int(setting('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+loglevel = setting('GUNICORN_LOG_LEVEL', 'info')
+accesslog = '-'
+errorlog = '-'
+
+# Every worker builds the app itself, so database connections and background threads are never shared across a fork
+preload_app = False
+
+
+def on_starting(server):
+    """Creates the metrics directory shared by the workers, before the first one is started."""
+    if 'METRICS_DIR' not in os.environ:
+        os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='metrics-')
+    # An empty METRICS_DIR disables the shared metrics, as in metrics.py
+    metrics_dir = os.environ['METRICS_DIR'] or None
+    if metrics_dir is not None:
+        # A directory set for the server may still hold the files of a previous server's workers
+        from metrics import archive_exited_processes
+        archive_exited_processes(metrics_dir)
+
+
+def post_fork(server, worker):
+    """Notes when the worker process started, to report its boot time."""
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    """Starts the background threads of the app, then logs how long the worker took to import and build it."""
+    for background_worker in worker.wsgi.extensions.get('background_workers', ()):
+        background_worker.start()
+    worker.log.info('Worker %s booted in %.0f ms', worker.pid, (time.perf_counter() - worker.forked_at) * 1000)
+
+
+def worker_exit(server, worker):
+    """Writes the last metrics of the worker, which it may not have flushed yet, before it exits."""
+    metrics = getattr(worker, 'wsgi', None) and worker.wsgi.extensions.get('metrics')
+    if metrics:
+        metrics.flush(force=True)
+
+
+def child_exit(server, worker):
+    """Folds the metrics of a worker that exited into the archive of the metrics directory."""
+    metrics_dir = os.environ.get('METRICS_DIR') or None
+    if metrics_dir is not None:
+        from metrics import archive_process
+        archive_process(metrics_dir, worker.pid)
@@ -0,0 +1,137 @@
+"""
+JSON Serialization
+
+This module provides the JSON provider of the service. It encodes with `orjson <https://github.com/ijl/orjson>`_
+when it is installed, which is several times faster than the standard library on large responses, and falls back to
+Flask's default encoder otherwise. ``JSON_ENCODER`` (``auto``, ``orjson`` or ``stdlib``) picks one explicitly.
+
+Both encoders produce the same documents: keys are sorted as Flask does, non-ASCII text is written as UTF-8 rather
+than escaped, datetimes are written as ``YYYY-MM-DD HH:MM:SS`` and dates as ``YYYY-MM-DD`` straight from the objects,
+and everything else Flask knows how to encode (decimals, UUIDs, dataclasses) is encoded the same way. The bytes are
+the same too, except for floats written with an exponent (``1e16`` with orjson, ``1e+16`` with the standard
+library), which parse to the same numbers.
+
+"""
+import json
+from datetime import date, datetime
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+ENCODERS = ('auto', 'orjson', 'stdlib')
+
+
+def records(fields, rows):
+    """
+    Turns result rows into JSON objects by position, without looking columns up by name.
+
+    The dicts are still built: zipping a row is cheaper than encoding its values one by one in Python, and lets the
+    encoder write every object in C (see ``benchmarks/json_serialization.py``).
+
+    Args:
+        fields (tuple): Keys of the objects, in the order of the leading columns of the rows. Extra trailing columns
+            (e.g. one only needed for a cursor) are ignored.
+        rows (list): Result rows, or any tuples.
+
+    Returns:
+        list: One dict per row.
+    """
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def encode_value(value):
+    """
+    Encodes the values the JSON encoders cannot encode by themselves.
+
+    Args:
+        value: The value to encode.
+
+    Returns:
+        The value as a JSON-compatible object.
+
+    Raises:
+        TypeError: If the value cannot be encoded.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ', timespec='seconds')
+    if isinstance(value, date):
+        return value.isoformat()
+    return DefaultJSONProvider.default(value)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider encoding with orjson when available.
+
+    Attributes:
+        encoder (str): ``orjson`` or ``stdlib``, the encoder in use.
+    """
+
+    default = staticmethod(encode_value)
+    # Write text as UTF-8, as orjson does
+    ensure_ascii = False
+
+    def __init__(self, app, encoder='auto'):
+        super().__init__(app)
+        if encoder not in ENCODERS:
+            raise ValueError(f'Invalid JSON encoder {encoder!r}, choose from {", ".join(ENCODERS)}')
+        if encoder == 'orjson' and orjson is None:
+            raise ValueError('The orjson JSON encoder is not installed')
+        self.encoder = 'orjson' if encoder != 'stdlib' and orjson is not None else 'stdlib'
+
+    def _indented(self):
+        """Tells whether documents are indented, as Flask does for responses in debug mode unless ``compact`` is set."""
+        return self.compact is False or (self.compact is None and self._app.debug)
+
+    def _orjson_options(self):
+        """Returns the orjson flags matching the provider's settings."""
+        # Datetimes go through encode_value, so both encoders format them the same way
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if self._indented():
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def _stdlib_options(self):
+        """Returns the ``json.dumps`` arguments writing the same layout as the orjson flags."""
+        return {'indent': 2} if self._indented() else {'separators': (',', ':')}
+
+    def dumps_bytes(self, obj):
+        """
+        Serializes an object to UTF-8 encoded JSON.
+
+        Args:
+            obj: The object to serialize.
+
+        Returns:
+            bytes: The JSON document.
+        """
+        if self.encoder == 'orjson':
+            try:
+                return orjson.dumps(obj, default=encode_value, option=self._orjson_options())
+            except orjson.JSONEncodeError:
+                pass  # e.g. integers beyond 64 bits, which the standard library handles
+        # Lone surrogates have no UTF-8 encoding; the escape written in their place is the JSON one
+        return super().dumps(obj, **self._stdlib_options()).encode('utf-8', 'backslashreplace')
+
+    def dumps(self, obj, **kwargs):
+        """Serializes an object to a JSON string. Extra ``json.dumps`` arguments use the standard library."""
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode()
+
+    def loads(self, s, **kwargs):
+        """Parses a JSON string or bytes. Extra ``json.loads`` arguments use the standard library."""
+        if kwargs or self.encoder != 'orjson':
+            return json.loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """Builds a JSON response, like :func:`flask.jsonify`, writing the encoded bytes directly into the body."""
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,415 @@
+"""
+Request Metrics
+
+This module instruments a Flask app and serves its metrics on ``/metrics`` in the Prometheus text format:
+
+- ``http_requests_total``: requests by method, route and status code.
+- ``http_request_duration_seconds``: latency histogram by method and route.
+- ``http_requests_in_flight``: requests being handled right now.
+- ``http_request_db_queries`` and ``http_request_db_duration_seconds``: histograms of the number of SQL statements
+  each request ran and the time spent in them, by route, fed by SQLAlchemy cursor events.
+- ``downstream_request_duration_seconds``: latency histogram of calls to other services by target host, method and
+  status, for services that report them with :meth:`Metrics.observe_downstream`.
+
+Routes are labelled with their URL rule (e.g. ``/customer/<username>``) rather than the requested path, so the number
+of series stays bounded.
+
+Metrics are kept in the process that handled the request. When ``METRICS_DIR`` is set (the Gunicorn configuration
+sets it for its workers), every process also writes its metrics to a file in that directory at most once per
+``METRICS_FLUSH_INTERVAL`` seconds (default 1), and ``/metrics`` adds up the files of all processes, so whichever
+worker answers the scrape reports the whole server. When a worker exits, the server folds its file into a single
+archive file with :func:`archive_process` (see ``child_exit`` in ``gunicorn.conf.py``), so recycled workers do not
+leave files behind and every total keeps counting them.
+
+"""
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import Response, has_request_context, request
+from sqlalchemy import event
+
+#: Latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+#: Buckets for the number of SQL statements run by one request.
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+#: File of the metrics directory holding the metrics of the processes that exited.
+ARCHIVE_FILE = 'archive.json'
+#: Number of archived processes remembered, so a scrape never counts one both in its own file and in the archive.
+ARCHIVE_MEMORY = 1000
+
+FAMILIES = {
+    'http_requests_total': ('counter', 'HTTP requests handled, by method, route and status code.', None),
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency in seconds.', LATENCY_BUCKETS),
+    'http_requests_in_flight': ('gauge', 'HTTP requests being handled.', None),
+    'http_request_db_queries': ('histogram', 'SQL statements run per HTTP request.', QUERY_COUNT_BUCKETS),
+    'http_request_db_duration_seconds': ('histogram', 'Time spent in SQL statements per HTTP request, in seconds.', LATENCY_BUCKETS),
+    'downstream_request_duration_seconds': ('histogram', 'Latency of calls to other services in seconds.', LATENCY_BUCKETS),
+}
+
+
+class Metrics:
+    """
+    Thread-safe registry of the request metrics of one process.
+
+    Attributes:
+        directory (str): Directory shared by the processes of one server, or None to only report this process.
+        flush_interval (float): Minimum seconds between two writes of this process's metrics file.
+    """
+
+    def __init__(self, directory=None, flush_interval=None):
+        self.directory = directory if directory is not None else os.environ.get('METRICS_DIR') or None
+        self.flush_interval = float(flush_interval if flush_interval is not None else os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._last_flush = 0.0
+        # Tells this process apart from an earlier one with the same pid
+        self._started = time.time()
+
+    def inc(self, name, labels, value=1):
+        """
+        Adds to a counter or gauge.
+
+        Args:
+            name (str): Name of the metric family.
+            labels (dict): Labels of the series.
+            value (float): Amount to add; negative amounts are only allowed for gauges.
+        """
+        series = self._gauges if FAMILIES[name][0] == 'gauge' else self._counters
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """
+        Records one observation in a histogram.
+
+        Args:
+            name (str): Name of the histogram family.
+            labels (dict): Labels of the series.
+            value (float): The observed value.
+        """
+        buckets = FAMILIES[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+            index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+            histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def observe_downstream(self, target, method, status, seconds):
+        """
+        Records the latency of a call to another service.
+
+        Args:
+            target (str): Host (and port) of the called service.
+            method (str): The HTTP method.
+            status: The response status code, or None if the call failed without a response.
+            seconds (float): The call latency.
+        """
+        labels = {'target': target, 'method': method, 'status': str(status) if status is not None else 'error'}
+        self.observe('downstream_request_duration_seconds', labels, seconds)
+
+    def snapshot(self):
+        """
+        Returns the metrics of this process in a JSON-serializable form.
+
+        Returns:
+            dict: The process id and start time, and its counters, gauges and histograms.
+        """
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'started': self._started,
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self._gauges.items()],
+                'histograms': [[name, list(labels), dict(h, buckets=list(h['buckets']))] for (name, labels), h in self._histograms.items()],
+            }
+
+    def flush(self, force=False):
+        """
+        Writes this process's metrics file, unless it was written less than ``flush_interval`` seconds ago.
+
+        Args:
+            force (bool): Write the file even if it was written recently.
+        """
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as stream:
+            json.dump(self.snapshot(), stream)
+        os.replace(f'{path}.tmp', path)
+
+    def collect(self):
+        """
+        Adds up the metrics of every process sharing the metrics directory, and of the ones archived after they exited.
+
+        Counters and histograms of processes that exited are kept, so totals never go down; gauges are only taken
+        from live processes.
+
+        Returns:
+            tuple: ``(counters, gauges, histograms)`` dictionaries keyed by ``(name, labels)``.
+        """
+        if not self.directory:
+            return combine([self.snapshot()])
+
+        self.flush(force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if os.path.basename(path) == ARCHIVE_FILE:
+                continue
+            try:
+                with open(path) as stream:
+                    snapshots.append(json.load(stream))
+            except (OSError, ValueError):
+                continue  # Being replaced by its process, or archived
+        # A process is added to the archive before its file is removed, so reading the archive last finds every
+        # process either in its own file or in the archive, and the archive says which files it already holds
+        archive = read_archive(self.directory)
+        archived = {tuple(process) for process in archive['archived']}
+        snapshots = [snapshot for snapshot in snapshots if (snapshot['pid'], snapshot.get('started')) not in archived]
+        return combine(snapshots + [archive])
+
+    def render(self):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics page.
+        """
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for name, (kind, description, buckets) in FAMILIES.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'histogram':
+                for (family, labels), histogram in sorted(histograms.items()):
+                    if family != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + (float('inf'),), histogram['buckets']):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(float(bound))
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+            else:
+                series = gauges if kind == 'gauge' else counters
+                for (family, labels), value in sorted(series.items()):
+                    if family == name:
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def init_app(self, app, db=None):
+        """
+        Instruments every request of an app, and the SQL statements of its database, and adds the ``/metrics`` route.
+
+        Args:
+            app (Flask): The Flask application.
+            db (SQLAlchemy): The Flask-SQLAlchemy extension bound to the app, whose statements are counted.
+        """
+        app.extensions['metrics'] = self
+
+        # Per-request state lives in the WSGI environ, which outlives the app context in every teardown order
+        @app.before_request
+        def start_request_metrics():
+            request.environ['metrics.start'] = time.perf_counter()
+            request.environ['metrics.queries'] = 0
+            request.environ['metrics.query_seconds'] = 0.0
+            self.inc('http_requests_in_flight', {})
+
+        @app.after_request
+        def record_response_status(response):
+            request.environ['metrics.status'] = response.status_code
+            return response
+
+        @app.teardown_request
+        def record_request_metrics(exc):
+            environ = request.environ
+            start = environ.pop('metrics.start', None)
+            if start is None:
+                return
+            elapsed = time.perf_counter() - start
+            route = request.url_rule.rule if request.url_rule else '(unmatched)'
+            status = environ.pop('metrics.status', 500)
+
+            self.inc('http_requests_in_flight', {}, -1)
+            self.inc('http_requests_total', {'method': request.method, 'route': route, 'status': str(status)})
+            self.observe('http_request_duration_seconds', {'method': request.method, 'route': route}, elapsed)
+            self.observe('http_request_db_queries', {'route': route}, environ['metrics.queries'])
+            self.observe('http_request_db_duration_seconds', {'route': route}, environ['metrics.query_seconds'])
+            self.flush()
+
+        def serve_metrics():
+            """Serves the metrics in the Prometheus text format."""
+            return Response(self.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+        app.add_url_rule('/metrics', 'metrics', serve_metrics)
+
+        if db is None:
+            return
+        with app.app_context():
+            engine = db.engine
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def record_query(conn, cursor, statement, parameters, context, executemany):
+            start = conn.info['metrics_query_start'].pop()
+            if has_request_context() and 'metrics.start' in request.environ:
+                request.environ['metrics.queries'] += 1
+                request.environ['metrics.query_seconds'] += time.perf_counter() - start
+
+        @event.listens_for(engine, 'handle_error')
+        def discard_query_timer(context):
+            if context.connection is not None and context.connection.info.get('metrics_query_start'):
+                context.connection.info['metrics_query_start'].pop()
+
+
+def combine(snapshots):
+    """
+    Adds up process snapshots.
+
+    Args:
+        snapshots (list): Snapshots as returned by :meth:`Metrics.snapshot`, or archives.
+
+    Returns:
+        tuple: ``(counters, gauges, histograms)`` dictionaries keyed by ``(name, labels)``.
+    """
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in snapshots:
+        alive = snapshot['pid'] is not None and (snapshot['pid'] == os.getpid() or process_alive(snapshot['pid']))
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot['gauges'] if alive else ():
+            key = (name, tuple(tuple(label) for label in labels))
+            gauges[key] = gauges.get(key, 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, {'buckets': [0] * len(histogram['buckets']), 'sum': 0.0, 'count': 0})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+    return counters, gauges, histograms
+
+
+def read_archive(directory):
+    """
+    Reads the metrics archived from the processes that exited.
+
+    Args:
+        directory (str): The metrics directory.
+
+    Returns:
+        dict: A snapshot without a process, holding their counters and histograms, and the ``[pid, started]``
+        pairs of the last archived processes.
+    """
+    try:
+        with open(os.path.join(directory, ARCHIVE_FILE)) as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return {'pid': None, 'started': None, 'counters': [], 'gauges': [], 'histograms': [], 'archived': []}
+
+
+def archive_process(directory, pid):
+    """
+    Folds the metrics file of a process that exited into the archive of the metrics directory, then removes it.
+
+    Only the server's master process calls it, one process at a time, so the archive has a single writer.
+
+    Args:
+        directory (str): The metrics directory.
+        pid (int): Id of the process that exited.
+    """
+    path = os.path.join(directory, f'{pid}.json')
+    try:
+        with open(path) as stream:
+            snapshot = json.load(stream)
+    except (OSError, ValueError):
+        snapshot = None
+
+    if snapshot is not None:
+        archive = read_archive(directory)
+        counters, _, histograms = combine([archive, dict(snapshot, gauges=[])])
+        archived = archive['archived'] + [[snapshot['pid'], snapshot.get('started')]]
+        archive = {
+            'pid': None,
+            'started': None,
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'gauges': [],
+            'histograms': [[name, list(labels), histogram] for (name, labels), histogram in histograms.items()],
+            'archived': archived[-ARCHIVE_MEMORY:],
+        }
+        archive_path = os.path.join(directory, ARCHIVE_FILE)
+        with open(f'{archive_path}.tmp', 'w') as stream:
+            json.dump(archive, stream)
+        os.replace(f'{archive_path}.tmp', archive_path)
+
+    for leftover in (path, f'{path}.tmp'):
+        try:
+            os.remove(leftover)
+        except FileNotFoundError:
+            pass
+
+
+def archive_exited_processes(directory):
+    """
+    Archives the metrics files of every process of the directory that is no longer running, e.g. the workers of a
+    previous server that shared the directory.
+
+    Args:
+        directory (str): The metrics directory.
+    """
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        name = os.path.basename(path)[:-len('.json')]
+        if name.isdigit() and not process_alive(int(name)):
+            archive_process(directory, int(name))
+
+
+def format_labels(labels):
+    """
+    Formats series labels for the Prometheus text format.
+
+    Args:
+        labels (tuple): ``(name, value)`` pairs.
+
+    Returns:
+        str: The label set in braces, or an empty string if there are no labels.
+    """
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def process_alive(pid):
+    """
+    Tells whether a process is still running.
+
+    Args:
+        pid (int): The process id.
+
+    Returns:
+        bool: False if no process has this id.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -1,9 +1,22 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import pytest
-from app import app, db  
+from app import create_app, db
 from app import InventoryItem  
+from app import StockReservation, sweep_reservations
+from app import read_item_records, upsert_items
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  
-app.config['TESTING'] = True
+# The tests get their own database file, configured before the engine is created. Reservations are swept
+# explicitly instead of in a background thread.
+app = create_app({
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='inventory-test-'), 'test.db')}",
+    'RESERVATION_SWEEPERS': 0,
+})
 
 @pytest.fixture
 def client():
@@ -61,6 +74,24 @@ def test_deduce_goods(client):
         item = db.session.get(InventoryItem, item.id)
         response = client.post(f'/inventory/deduce/{item.id}', json={'amount': 2})
         assert response.status_code == 200
+
+def test_idempotent_deduce_goods(client):
+    with client.application.app_context():
+        item = InventoryItem(name='Kettle', category='Kitchen', price=30, description='Electric kettle', stock_count=10)
+        db.session.add(item)
+        db.session.commit()
+
+        # A retry of a deduction whose response was lost gets the stored response instead of deducting again
+        headers = {'Idempotency-Key': 'sale-order-1-stock'}
+        first = client.post(f'/inventory/deduce/{item.id}', json={'amount': 2}, headers=headers)
+        retry = client.post(f'/inventory/deduce/{item.id}', json={'amount': 2}, headers=headers)
+        assert first.status_code == retry.status_code == 200
+        assert retry.headers['Idempotent-Replayed'] == 'true'
+        assert retry.json == first.json
+        assert db.session.get(InventoryItem, item.id).stock_count == 8
+
+        # The same key on another request is refused
+        assert client.post(f'/inventory/deduce/{item.id}', json={'amount': 3}, headers=headers).status_code == 422
 def test_add_goods_invalid_data(client):
     response = client.post('/inventory/add', json={
         'name': '',  # Invalid name
@@ -106,9 +137,362 @@ def test_inventory_item_representation(client):
         fetched_item = db.session.get(InventoryItem, item.id)
         assert str(fetched_item) == f'<InventoryItem {item.name}>'
 
+def test_get_goods_bulk(client):
+    with client.application.app_context():
+        db.session.add_all([
+            InventoryItem(name='Pen', category='Stationery', price=2, stock_count=100),
+            InventoryItem(name='Book', category='Stationery', price=10, stock_count=5),
+        ])
+        db.session.commit()
+
+        response = client.post('/inventory/goods/bulk', json={'names': ['Pen', 'Book', 'Ghost']})
+        assert response.status_code == 200
+        assert sorted(good['name'] for good in response.json['Inventory']) == ['Book', 'Pen']
+        assert response.json['missing'] == ['Ghost']
+
+        # Names that are not strings, e.g. unhashable lists, are rejected instead of failing the lookup
+        for names in ([['Pen']], [{'name': 'Pen'}], ['Pen', 3], 'Pen'):
+            assert client.post('/inventory/goods/bulk', json={'names': names}).status_code == 400, names
+        assert client.post('/inventory/goods/bulk', json=['Pen']).status_code == 400
+
+def test_deduce_goods_bulk(client):
+    with client.application.app_context():
+        pen = InventoryItem(name='Pen', category='Stationery', price=2, stock_count=100)
+        book = InventoryItem(name='Book', category='Stationery', price=10, stock_count=5)
+        db.session.add_all([pen, book])
+        db.session.commit()
+
+        response = client.post('/inventory/deduce/bulk', json={'items': [{'item_id': pen.id, 'amount': 10}, {'item_id': book.id, 'amount': 5}]})
+        assert response.status_code == 200
+        assert db.session.get(InventoryItem, pen.id).stock_count == 90
+        assert db.session.get(InventoryItem, book.id).stock_count == 0
+
+        # All-or-nothing: the second line fails, so the first is rolled back
+        response = client.post('/inventory/deduce/bulk', json={'items': [{'item_id': pen.id, 'amount': 10}, {'item_id': book.id, 'amount': 1}]})
+        assert response.status_code == 409
+        assert [line['success'] for line in response.json['results']] == [True, False]
+        assert response.json['results'][1]['error'] == 'Insufficient stock'
+        assert db.session.get(InventoryItem, pen.id).stock_count == 90
+
+def test_deduce_goods_bulk_partial(client):
+    with client.application.app_context():
+        pen = InventoryItem(name='Pen', category='Stationery', price=2, stock_count=100)
+        db.session.add(pen)
+        db.session.commit()
+
+        response = client.post('/inventory/deduce/bulk', json={
+            'items': [{'item_id': pen.id, 'amount': 10}, {'item_id': 999, 'amount': 1}, {'item_id': pen.id, 'amount': 500}],
+            'partial': True
+        })
+        assert response.status_code == 200
+        assert response.json['applied'] == 1
+        assert [line.get('error') for line in response.json['results']] == [None, 'Item not found', 'Insufficient stock']
+        assert db.session.get(InventoryItem, pen.id).stock_count == 90
+
+        response = client.post('/inventory/deduce/bulk', json={'items': [{'item_id': pen.id, 'amount': -1}]})
+        assert response.status_code == 400
+        # Booleans are not ids or amounts, even though Python counts them as integers
+        for line in ({'item_id': pen.id, 'amount': True}, {'item_id': True, 'amount': 1}):
+            assert client.post('/inventory/deduce/bulk', json={'items': [line]}).status_code == 400, line
+            assert client.post('/inventory/restock/bulk', json={'items': [line]}).status_code == 400, line
+        assert client.post('/inventory/deduce/bulk', json=[{'item_id': pen.id}]).status_code == 400
+        assert db.session.get(InventoryItem, pen.id).stock_count == 90
+
+def test_add_duplicate_goods(client):
+    item = {'name': 'Laptop', 'category': 'Electronics', 'price': 1000.00, 'stock_count': 5}
+    assert client.post('/inventory/add', json=item).status_code == 201
+    assert client.post('/inventory/add', json=item).status_code == 409
+
+def test_lookup_good(client):
+    with client.application.app_context():
+        item = InventoryItem(name='Monitor', category='Electronics', price=200, stock_count=7)
+        db.session.add(item)
+        db.session.commit()
+
+        response = client.get(f'/inventory/lookup?id={item.id}')
+        assert response.status_code == 200
+        assert response.json['stock_count'] == 7
+
+        response = client.get('/inventory/lookup?name=Monitor')
+        assert response.status_code == 200
+        assert response.json['id'] == item.id
+
+        assert client.get('/inventory/lookup?name=Ghost').status_code == 404
+        assert client.get('/inventory/lookup').status_code == 400
+
+def test_migrate_schema_merges_duplicates(client):
+    from app import migrate_schema
+    with client.application.app_context():
+        db.session.execute(db.text('DROP INDEX ix_inventory_item_name'))
+        db.session.add_all([
+            InventoryItem(name='Cable', category='Electronics', price=5, stock_count=3),
+            InventoryItem(name='Cable', category='Electronics', price=6, stock_count=4),
+        ])
+        db.session.commit()
+
+        migrate_schema()
+        cables = InventoryItem.query.filter_by(name='Cable').all()
+        assert len(cables) == 1
+        assert cables[0].price == 5
+        assert cables[0].stock_count == 7
+        assert 'ix_inventory_item_name' in [index['name'] for index in db.inspect(db.engine).get_indexes('inventory_item')]
+
+def test_get_goods_pagination(client):
+    with client.application.app_context():
+        db.session.add_all([
+            InventoryItem(name=f'Item {i}', category='Books' if i % 2 else 'Toys', price=i, stock_count=i)
+            for i in range(1, 6)
+        ])
+        db.session.commit()
+
+        first = client.get('/inventory/goods?limit=2')
+        assert [good['name'] for good in first.json['Inventory']] == ['Item 1', 'Item 2']
+        second = client.get(f'/inventory/goods?limit=2&after={first.json["next_cursor"]}')
+        assert [good['name'] for good in second.json['Inventory']] == ['Item 3', 'Item 4']
+        last = client.get(f'/inventory/goods?limit=2&after={second.json["next_cursor"]}')
+        assert [good['name'] for good in last.json['Inventory']] == ['Item 5']
+        assert last.json['next_cursor'] is None
+
+        response = client.get('/inventory/goods?category=Books&min_price=2&max_price=5&fields=name,stock_count')
+        assert response.json['Inventory'] == [{'name': 'Item 3', 'stock_count': 3}, {'name': 'Item 5', 'stock_count': 5}]
+
+        assert client.get('/inventory/goods?fields=password').status_code == 400
+
+def test_get_goods_rejects_malformed_numbers(client):
+    # A malformed cursor or price must not restart the listing or drop the filter
+    for query, parameter in (('after=abc', 'after'), ('limit=ten', 'limit'), ('min_price=cheap', 'min_price'),
+                             ('max_price=', 'max_price'), ('max_price=nan', 'max_price'), ('after=1.5', 'after')):
+        response = client.get(f'/inventory/goods?{query}')
+        assert response.status_code == 400, query
+        assert response.json == {'error': f'Invalid {parameter}'}
+    assert client.get('/inventory/goods?min_price=1.5&after=0').status_code == 200
+
+def test_get_goods_ndjson(client):
+    with client.application.app_context():
+        db.session.add_all([InventoryItem(name=f'Item {i}', category='Toys', price=i, stock_count=1) for i in range(3)])
+        db.session.commit()
+
+        response = client.get('/inventory/goods?format=ndjson&fields=name')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        assert [json.loads(line) for line in response.data.splitlines()] == [{'name': f'Item {i}'} for i in range(3)]
+
+def test_update_goods_notifies_sales(client, monkeypatch):
+    import app as inventory_app
+    sent = []
+    monkeypatch.setattr(inventory_app, 'sales_service_url', 'http://sales')
+    monkeypatch.setattr(inventory_app.requests, 'post', lambda url, json, timeout: sent.append((url, json)))
+    with client.application.app_context():
+        item = InventoryItem(name='Lamp', category='Home', price=30, stock_count=3)
+        db.session.add(item)
+        db.session.commit()
+
+        response = client.put(f'/inventory/update/{item.id}', json={'name': 'Desk Lamp', 'price': 25})
+        assert response.status_code == 200
+        assert sent == [('http://sales/cache/invalidate', {'names': ['Lamp', 'Desk Lamp']})]
+
+def test_get_goods_conditional(client):
+    from versions import ensure_versions
+    with client.application.app_context():
+        ensure_versions('inventory_item')
+        client.post('/inventory/add', json={'name': 'Chair', 'category': 'Home', 'price': 40, 'stock_count': 2})
+
+        response = client.get('/inventory/goods')
+        etag = response.headers['ETag']
+        assert response.status_code == 200
+        assert 'Last-Modified' in response.headers
+
+        response = client.get('/inventory/goods', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+        # A different page has its own ETag
+        assert client.get('/inventory/goods?limit=1', headers={'If-None-Match': etag}).status_code == 200
+        assert client.get('/inventory/goods/Chair', headers={'If-None-Match': etag}).status_code == 200
+
+        # Any write bumps the version and invalidates the ETag
+        item = InventoryItem.query.filter_by(name='Chair').first()
+        client.post(f'/inventory/deduce/{item.id}', json={'amount': 1})
+        assert client.get('/inventory/goods', headers={'If-None-Match': etag}).status_code == 200
+
+def test_sqlite_pragmas(client):
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+            assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+
+def test_restock_goods_bulk(client):
+    with client.application.app_context():
+        pen = InventoryItem(name='Pen', category='Stationery', price=2, stock_count=1)
+        db.session.add(pen)
+        db.session.commit()
+
+        response = client.post('/inventory/restock/bulk', json={'items': [{'item_id': pen.id, 'amount': 4}]})
+        assert response.status_code == 200
+        assert db.session.get(InventoryItem, pen.id).stock_count == 5
+
+        response = client.post('/inventory/restock/bulk', json={'items': [{'item_id': pen.id, 'amount': 1}, {'item_id': 999, 'amount': 1}]})
+        assert response.status_code == 404
+        assert db.session.get(InventoryItem, pen.id).stock_count == 5
+
+def test_get_good_includes_stock(client):
+    with client.application.app_context():
+        db.session.add(InventoryItem(name='Lamp', category='Home', price=20, stock_count=3))
+        db.session.commit()
+    response = client.get('/inventory/goods/Lamp')
+    assert response.status_code == 200
+    assert response.json['stock_count'] == 3
+
+def test_reservation_commit_and_release(client):
+    with client.application.app_context():
+        item = InventoryItem(name='Kettle', category='Home', price=30, stock_count=2)
+        db.session.add(item)
+        db.session.commit()
+
+        first = client.post(f'/inventory/reserve/{item.id}', json={'amount': 1})
+        assert first.status_code == 201
+        assert first.json['new_stock_count'] == 1
+        second = client.post(f'/inventory/reserve/{item.id}', json={'amount': 1})
+        assert second.status_code == 201
+        assert client.post(f'/inventory/reserve/{item.id}', json={'amount': 1}).status_code == 409
+        assert client.post('/inventory/reserve/999', json={'amount': 1}).status_code == 404
+        assert client.post(f'/inventory/reserve/{item.id}', json={'ttl': 0}).status_code == 400
+
+        assert client.post(f"/inventory/reservations/{first.json['reservation_id']}/commit").status_code == 200
+        assert client.post(f"/inventory/reservations/{first.json['reservation_id']}/commit").status_code == 404
+
+        response = client.post(f"/inventory/reservations/{second.json['reservation_id']}/release")
+        assert response.status_code == 200
+        assert response.json['new_stock_count'] == 1
+        assert db.session.get(InventoryItem, item.id).stock_count == 1
+        assert db.session.query(StockReservation).count() == 0
+
+def test_sweep_expired_reservations(client):
+    with client.application.app_context():
+        toaster = InventoryItem(name='Toaster', category='Home', price=25, stock_count=5)
+        blender = InventoryItem(name='Blender', category='Home', price=40, stock_count=5)
+        db.session.add_all([toaster, blender])
+        db.session.commit()
+
+        expiring = client.post(f'/inventory/reserve/{toaster.id}', json={'amount': 2, 'ttl': 0.01}).json
+        client.post(f'/inventory/reserve/{toaster.id}', json={'amount': 1, 'ttl': 0.01})
+        client.post(f'/inventory/reserve/{blender.id}', json={'amount': 3, 'ttl': 0.01})
+        client.post(f'/inventory/reserve/{blender.id}', json={'amount': 1})
+        time.sleep(0.05)
+
+        # An expired reservation can no longer be committed
+        assert client.post(f"/inventory/reservations/{expiring['reservation_id']}/commit").status_code == 404
+
+        assert sweep_reservations(limit=2) == 2
+        assert sweep_reservations(limit=100) == 1
+        assert sweep_reservations(limit=100) == 0
+        db.session.expire_all()
+        assert db.session.get(InventoryItem, toaster.id).stock_count == 5
+        assert db.session.get(InventoryItem, blender.id).stock_count == 4
+        assert db.session.query(StockReservation).count() == 1
 
+def test_gunicorn_worker_starts_reservation_sweeper(monkeypatch):
+    # Reservations left by a recycled worker are swept without waiting for the next reservation
+    import runpy
+    from types import SimpleNamespace
+    started = []
+    monkeypatch.setattr(app.extensions['reservation_sweeper'], 'start', lambda: started.append(True))
+    config = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py'))
+    worker = SimpleNamespace(wsgi=app, pid=os.getpid(), forked_at=time.perf_counter(), log=SimpleNamespace(info=lambda *args: None))
+    config['post_worker_init'](worker)
+    assert started == [True]
 
+def test_concurrent_reservations_never_oversell(client):
+    with client.application.app_context():
+        item = InventoryItem(name='Hot Item', category='Deals', price=1, stock_count=10)
+        db.session.add(item)
+        db.session.commit()
+        item_id = item.id
 
+    statuses = []
+    def buy():
+        with app.test_client() as buyer:
+            statuses.append(buyer.post(f'/inventory/reserve/{item_id}', json={'amount': 1}).status_code)
 
+    buyers = [threading.Thread(target=buy) for _ in range(25)]
+    for buyer in buyers:
+        buyer.start()
+    for buyer in buyers:
+        buyer.join()
 
+    assert statuses.count(201) == 10
+    assert statuses.count(409) == 15
+    with client.application.app_context():
+        assert db.session.get(InventoryItem, item_id).stock_count == 0
+
+def test_import_goods_upsert(client, monkeypatch):
+    notified = []
+    monkeypatch.setattr('app.notify_item_changed', lambda *names: notified.extend(names))
+    with client.application.app_context():
+        db.session.add_all([
+            InventoryItem(name='Sofa', category='Home', price=300, description='Grey', stock_count=2),
+            InventoryItem(name='Rug', category='Home', price=80, description='', stock_count=7),
+        ])
+        db.session.commit()
+
+    body = 'name,category,price,description,stock_count\n'
+    body += 'Sofa,Home,280,Grey,2\n'
+    body += 'Rug,,80,,7\n'
+    body += 'Shelf,Home,45.5,Oak,12\n'
+    body += 'Stool,,10,,3\n'
+    body += 'Vase,Home,-1,,1\n'
+    body += 'Shelf,Home,45.5,Oak,12\n'
+
+    dry = client.post('/inventory/import?dry_run=true', data=body, content_type='text/csv')
+    assert dry.status_code == 200
+    assert (dry.json['inserted'], dry.json['updated'], dry.json['unchanged'], dry.json['failed']) == (1, 1, 1, 3)
+    assert {'line': 2, 'name': 'Sofa', 'action': 'update', 'changes': {'price': [300.0, 280.0]}} in dry.json['changes']
+    assert [(error['line'], error['error']) for error in dry.json['errors']] == [
+        (5, 'New item is missing category'), (6, 'Invalid price'), (7, 'Duplicate name in import')
+    ]
+    with client.application.app_context():
+        assert InventoryItem.query.filter_by(name='Shelf').first() is None
+
+    response = client.post('/inventory/import', data=body, content_type='text/csv')
+    assert (response.json['inserted'], response.json['updated'], response.json['unchanged']) == (1, 1, 1)
+    assert 'changes' not in response.json
+    assert notified == ['Sofa']
+    with client.application.app_context():
+        assert InventoryItem.query.filter_by(name='Sofa').first().price == 280
+        shelf = InventoryItem.query.filter_by(name='Shelf').first()
+        assert (shelf.category, shelf.price, shelf.description, shelf.stock_count) == ('Home', 45.5, 'Oak', 12)
+
+def test_import_goods_ndjson_batches(client):
+    lines = [json.dumps({'name': f'Bolt {i}', 'category': 'Hardware', 'price': 0.1, 'stock_count': i}) for i in range(5)]
+    lines.append('{broken')
+    response = client.post('/inventory/import?format=ndjson', data='\n'.join(lines))
+    assert response.json['inserted'] == 5
+    assert response.json['errors'] == [{'line': 6, 'name': None, 'error': 'Invalid JSON'}]
+
+    with client.application.app_context():
+        report = upsert_items(read_item_records(io.StringIO('\n'.join(lines[:5])), 'ndjson'), batch_size=2)
+    assert (report['inserted'], report['unchanged']) == (0, 5)
+
+def test_import_goods_chunked_body_keeps_line_separators(client):
+    # Gunicorn gives a chunked body as a stream with nothing but read(), and U+2028 must not end a line
+    class ChunkedBody:
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+
+        def read(self, size=-1):
+            return self.data.read(size)
+
+    body = 'name,category,price,description,stock_count\nLamp,Home,25,line1\u2028line2,4\n'
+    response = client.post('/inventory/import', content_type='text/csv', environ_overrides={
+        'wsgi.input': ChunkedBody(body.encode('utf-8')), 'wsgi.input_terminated': True, 'CONTENT_LENGTH': '',
+    })
+    assert (response.json['inserted'], response.json['failed']) == (1, 0)
+    with client.application.app_context():
+        assert InventoryItem.query.filter_by(name='Lamp').first().description == 'line1\u2028line2'
 
+def test_metrics(client):
+    client.get('/inventory/goods/Nothing')
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'http_requests_total{method="GET",route="/inventory/goods/<string:name>",status="404"} 1' in body
+    assert 'http_request_db_queries_count{route="/inventory/goods/<string:name>"}' in body
@@ -0,0 +1,70 @@
+"""
+Background Worker
+
+This module provides the polling worker threads a service uses to process queued or expiring work outside of the
+requests that created it. Threads are started lazily and restarted after a fork, so the service can be pre-forked by
+a WSGI server without sharing threads between processes.
+
+"""
+import os
+import threading
+
+
+class BackgroundWorker:
+    """
+    Runs a batch-processing function repeatedly on a small pool of daemon threads.
+
+    The function is called in a loop; when it reports that it found no work, the thread sleeps until the poll
+    interval elapses or :meth:`wake` is called.
+
+    Attributes:
+        name (str): Prefix of the worker thread names.
+        process (callable): Function processing one batch of work and returning how many items it handled.
+        threads (int): Number of worker threads; 0 disables the worker.
+        interval (float): Seconds to sleep when there is no work.
+    """
+
+    def __init__(self, name, process, threads=1, interval=1.0):
+        self.name = name
+        self.process = process
+        self.threads = int(threads)
+        self.interval = float(interval)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """Starts the worker threads in this process if they are not running yet."""
+        if self.threads <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            for index in range(self.threads):
+                threading.Thread(target=self.run_forever, name=f'{self.name}-{index}', daemon=True).start()
+
+    def wake(self):
+        """Asks idle worker threads to look for work immediately."""
+        self._wakeup.set()
+
+    def stop(self):
+        """Asks the worker threads to exit after their current batch."""
+        self._stop.set()
+        self._wakeup.set()
+        with self._lock:
+            self._pid = None
+
+    def run_forever(self):
+        """Processes batches until :meth:`stop` is called. Used by the threads and by standalone worker processes."""
+        while not self._stop.is_set():
+            try:
+                processed = self.process()
+            except Exception as e:
+                print(f"{self.name} failed to process a batch: {e}")
+                processed = 0
+            if not processed:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
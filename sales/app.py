@@ -4,20 +4,41 @@ Sales Service API
 This module is a Flask application for a Sales Service API. Consists of functions for managing goods, sales transactions, and sales history.
 
 """
-from flask import Flask, jsonify, request
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from flask import Blueprint, Flask, Response, current_app, jsonify, request
+from sqlalchemy import func, insert, inspect, or_, select, text, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from datetime import date, datetime, timedelta
+from functools import partial
+import base64
+import click
+import json
 import requests
 import os
+import threading
+import uuid
+from urllib.parse import urlsplit
 
-app = Flask(__name__)
+from cache import TTLCache
+from db_config import configure_engine, database_url, db, engine_options
+from downstream import DownstreamClient
+from idempotency import idempotent, purge_idempotency_records
+from json_provider import JSONProvider, records
+from metrics import Metrics
+from startup import StartupTimer, measure_cold_start
+from versions import TableVersion, bump_version, conditional, ensure_versions
+from worker import BackgroundWorker
+
+# Routes and commands of the service, registered on each app built by create_app
+bp = Blueprint('sales', __name__, cli_group=None)
+
+# Sales history configuration
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
 # Database Configuration
 base_dir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(base_dir, 'database.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
-db = SQLAlchemy(app)
+metrics = Metrics()
 
 # Sales Model
 class Sales(db.Model):
@@ -31,47 +52,380 @@ class Sales(db.Model):
         name (str): Name of the item sold.
         time (datetime): Timestamp of when the sale occurred.
     """
+    __table_args__ = (db.Index('ix_sales_username_time', 'username', 'time'),)
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(255), nullable=False)
     price = db.Column(db.Float, nullable=False)
     name = db.Column(db.String(200), nullable=False)
     time = db.Column(db.DateTime, default=datetime.utcnow)
 
-# Create declared tables
-with app.app_context():
+class SaleOrder(db.Model):
+    """
+    Represents a sale accepted for asynchronous processing (the sale outbox).
+
+    The background worker moves each order from ``pending`` to ``completed`` or ``failed``, recording which
+    downstream steps already succeeded so a retry never repeats them.
+
+    Attributes:
+        id (int): Unique identifier of the order, returned to the client.
+        username (str): Username of the customer buying the item.
+        name (str): Name of the item being bought.
+        item_id (int): Inventory id of the item, once resolved.
+        price (float): Price charged, once resolved.
+        status (str): ``pending``, ``processing``, ``completed`` or ``failed``.
+        wallet_debited (bool): Whether the customer's wallet was debited.
+        stock_deducted (bool): Whether the item's stock was deducted.
+        compensate (bool): Whether the order is being rolled back, i.e. the wallet must be refunded.
+        debit_key (str): ``Idempotency-Key`` of a debit sent outside the outbox whose outcome is unknown. The debit
+            is replayed under it before the refund, so the refund is only sent if the customer was charged.
+        attempts (int): Number of processing attempts so far.
+        error (str): Last error, if any.
+        next_attempt_at (datetime): Earliest time of the next processing attempt.
+        created_at (datetime): Time the order was accepted.
+        updated_at (datetime): Time the order last changed.
+        sale_id (int): Id of the recorded sale, once completed.
+    """
+    __table_args__ = (db.Index('ix_sale_order_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(255), nullable=False)
+    name = db.Column(db.String(200), nullable=False)
+    item_id = db.Column(db.Integer)
+    price = db.Column(db.Float)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    wallet_debited = db.Column(db.Boolean, nullable=False, default=False)
+    stock_deducted = db.Column(db.Boolean, nullable=False, default=False)
+    compensate = db.Column(db.Boolean, nullable=False, default=False)
+    debit_key = db.Column(db.String(255))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(500))
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sale_id = db.Column(db.Integer)
+
+    def to_dict(self):
+        """
+        Convert the order's status into a dictionary.
+
+        Returns:
+            dict: Dictionary containing the order's progress.
+        """
+        return {
+            'sale_id': self.id,
+            'status': self.status,
+            'name': self.name,
+            'customer_user': self.username,
+            'price': self.price,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+
+class DailyItemSales(db.Model):
+    """
+    Rollup of the sales of one item on one day, kept up to date as sales are recorded.
+
+    Attributes:
+        day (date): The day of the sales.
+        name (str): Name of the item sold.
+        units (int): Number of units sold.
+        revenue (float): Total price of the units sold.
+    """
+    day = db.Column(db.Date, primary_key=True)
+    name = db.Column(db.String(200), primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+class DailyCustomerSales(db.Model):
+    """
+    Rollup of the purchases of one customer on one day, kept up to date as sales are recorded.
+
+    Attributes:
+        day (date): The day of the purchases.
+        username (str): Username of the customer.
+        purchases (int): Number of units bought.
+        spent (float): Total amount spent.
+    """
+    day = db.Column(db.Date, primary_key=True)
+    username = db.Column(db.String(255), primary_key=True)
+    purchases = db.Column(db.Integer, nullable=False, default=0)
+    spent = db.Column(db.Float, nullable=False, default=0.0)
+
+@bp.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys():
+    """Deletes expired idempotency records. They are also purged periodically while the service handles requests."""
+    print(f'{purge_idempotency_records()} expired idempotency records deleted')
+
+def migrate_schema():
+    """
+    Brings an existing database up to the current schema.
+
+    ``db.create_all()`` only creates missing tables, so indexes and columns added to existing tables are created
+    here.
+    """
+    for index in Sales.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    if 'debit_key' not in {column['name'] for column in inspect(db.engine).get_columns('sale_order')}:
+        db.session.execute(text('ALTER TABLE sale_order ADD COLUMN debit_key VARCHAR(255)'))
+        db.session.commit()
+
+def upsert_rollup(model, keys, increments):
+    """
+    Adds to a rollup row, creating it if it does not exist yet, with a single upsert statement.
+
+    Args:
+        model: The rollup model.
+        keys (dict): Primary key values of the row.
+        increments (dict): Amounts to add to the counter columns.
+    """
+    dialect = db.session.get_bind().dialect.name
+    dialect_insert = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}.get(dialect)
+    if dialect_insert is not None:
+        statement = dialect_insert(model).values(**keys, **increments)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={column: getattr(model, column) + getattr(statement.excluded, column) for column in increments},
+        )
+        db.session.execute(statement)
+        return
+
+    result = db.session.execute(
+        update(model)
+        .where(*[getattr(model, column) == value for column, value in keys.items()])
+        .values({column: getattr(model, column) + amount for column, amount in increments.items()})
+    )
+    if result.rowcount == 0:
+        db.session.execute(insert(model).values(**keys, **increments))
+
+def record_rollups(sales):
+    """
+    Adds sales to the daily rollup tables, in the same transaction as the sales themselves.
+
+    Args:
+        sales (list): Dicts with the ``username``, ``name``, ``price`` and ``time`` of each unit sold.
+    """
+    items = {}
+    customers = {}
+    for sale in sales:
+        day = sale['time'].date()
+        units, revenue = items.get((day, sale['name']), (0, 0.0))
+        items[(day, sale['name'])] = (units + 1, revenue + sale['price'])
+        purchases, spent = customers.get((day, sale['username']), (0, 0.0))
+        customers[(day, sale['username'])] = (purchases + 1, spent + sale['price'])
+
+    for (day, name), (units, revenue) in items.items():
+        upsert_rollup(DailyItemSales, {'day': day, 'name': name}, {'units': units, 'revenue': revenue})
+    for (day, username), (purchases, spent) in customers.items():
+        upsert_rollup(DailyCustomerSales, {'day': day, 'username': username}, {'purchases': purchases, 'spent': spent})
+
+@bp.cli.command('backfill-rollups')
+def backfill_rollups():
+    """Rebuilds the daily rollup tables from every recorded sale, and invalidates the ETags of the analytics."""
+    day = func.date(Sales.time)
+    db.session.query(DailyItemSales).delete()
+    db.session.query(DailyCustomerSales).delete()
+    db.session.execute(insert(DailyItemSales).from_select(
+        ['day', 'name', 'units', 'revenue'],
+        select(day, Sales.name, func.count(Sales.id), func.sum(Sales.price)).group_by(day, Sales.name),
+    ))
+    db.session.execute(insert(DailyCustomerSales).from_select(
+        ['day', 'username', 'purchases', 'spent'],
+        select(day, Sales.username, func.count(Sales.id), func.sum(Sales.price)).group_by(day, Sales.username),
+    ))
+    # The analytics endpoints are versioned with the sales, so cached responses must not survive the rebuild
+    bump_version('sales')
+    db.session.commit()
+    print(f'Rebuilt {db.session.query(DailyItemSales).count()} item rollups and '
+          f'{db.session.query(DailyCustomerSales).count()} customer rollups')
+
+def encode_cursor(sale):
+    """
+    Encodes the position of a sale in the history as an opaque cursor.
+
+    Args:
+        sale: A row with ``time`` and ``id``.
+
+    Returns:
+        str: The cursor.
+    """
+    return base64.urlsafe_b64encode(f'{sale.time.isoformat()}|{sale.id}'.encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor produced by :func:`encode_cursor`.
+
+    Args:
+        cursor (str): The cursor.
+
+    Returns:
+        tuple: The ``(time, id)`` position of the sale.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        time, sale_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(time), int(sale_id)
+    except ValueError as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+def migrate():
+    """Creates the tables and version rows that do not exist yet, then upgrades the existing tables."""
     db.create_all()
+    migrate_schema()
+    ensure_versions('sales', 'inventory')
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Creates or upgrades the database schema. Run it once per deploy, before the workers start."""
+    migrate()
+    print('Database schema is up to date')
 
 # URL to Inventory API
 inventory_service_url = os.environ.get('INVENTORY_SERVICE_URL') or 'http://localhost:5002'  # URL to Inventory API
 # URL to Customer API
 customer_service_url = os.environ.get('CUSTOMER_SERVICE_URL') or 'http://localhost:5001'  # URL to Customer API
 
+# Pooled client shared by every call to the Inventory and Customer APIs
+downstream = DownstreamClient()
+downstream.listener = lambda method, url, status, seconds: metrics.observe_downstream(urlsplit(url).netloc, method, status, seconds)
+
+# Read-through caches for inventory item lookups and catalog pages
+cache_size = int(os.environ.get('SALES_CACHE_SIZE', 1024))
+cache_ttl = float(os.environ.get('SALES_CACHE_TTL', 30))
+item_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+catalog_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+# Version of the shared 'inventory' row the caches of this process are in sync with. An invalidation reaches only
+# one server process, so it is counted in the database, where every other process sees it on its next lookup.
+cached_inventory_version = None
+cached_inventory_version_lock = threading.Lock()
+
+def read_inventory_version():
+    """
+    Reads how many inventory invalidations the Sales Service received, across all of its processes.
+
+    The ``inventory`` row of ``TableVersion`` counts the item changes reported by the Inventory Service rather than
+    writes to a local table, so every server process knows when to drop its cached inventory data.
+
+    Returns:
+        int: The version of the ``inventory`` row, or None if it does not exist yet.
+    """
+    return db.session.execute(select(TableVersion.version).where(TableVersion.table_name == 'inventory')).scalar()
+
+def sync_inventory_caches():
+    """
+    Drops the cached inventory items and catalog pages of this process if any process was told since that the
+    inventory changed.
+    """
+    global cached_inventory_version
+    version = read_inventory_version()
+    with cached_inventory_version_lock:
+        if version != cached_inventory_version:
+            item_cache.clear()
+            catalog_cache.clear()
+            cached_inventory_version = version
+
 # App Routes
-@app.route('/')
+@bp.route('/')
 def home():
     """Returns a welcome message."""
     return "Welcome to the Sales Service API!"
 
-@app.route('/display', methods=['GET'])
+@bp.route('/display', methods=['GET'])
 def display_goods():
     """
     Fetches and displays goods from the Inventory Service.
 
+    Query parameters (``after``, ``limit``, ``category``, ``min_price``, ``max_price``, ``fields`` and ``format``)
+    are passed through to the Inventory Service, so one page is fetched at a time. With ``format=ndjson`` the
+    inventory export is streamed straight through without being buffered.
+
     Returns:
-        JSON: A list of goods along with their details fetched from the Inventory Service.
+        JSON: A page of goods along with their details fetched from the Inventory Service, or an NDJSON stream.
     """
-    response = requests.get(f'{inventory_service_url}/inventory/goods')
-    if response.status_code == 200:
-        return jsonify({'Goods': response.json()})
-    else:
+    stream = request.args.get('format') == 'ndjson'
+    cache_key = request.query_string
+    stale = None
+    if not stream:
+        sync_inventory_caches()
+        cached = catalog_cache.get(cache_key)
+        if cached is not None:
+            return Response(cached[1], mimetype='application/json')
+        stale = catalog_cache.get_stale(cache_key)
+
+    # Revalidate an expired page with its ETag instead of transferring it again
+    headers = {'If-None-Match': stale[0]} if stale and stale[0] else {}
+    try:
+        response = downstream.get(f'{inventory_service_url}/inventory/goods', params=request.args, stream=stream, headers=headers)
+    except requests.exceptions.RequestException as e:
+        print(f"Network error while fetching goods: {e}")
+        return jsonify({'error': 'Unable to fetch goods from Inventory Service'}), 500
+
+    if response.status_code == 304 and stale is not None:
+        catalog_cache.revalidated(cache_key)
+        return Response(stale[1], mimetype='application/json')
+
+    if response.status_code != 200:
+        response.close()
         return jsonify({'error': 'Unable to fetch goods from Inventory Service'}), 500
 
-@app.route('/sale', methods=['POST'])
+    if stream:
+        return Response(response.iter_content(chunk_size=64 * 1024), mimetype='application/x-ndjson')
+
+    # Wrap the inventory page as-is instead of decoding and re-encoding it
+    body = b'{"Goods": ' + response.content + b'}'
+    catalog_cache.set(cache_key, (response.headers.get('ETag'), body))
+    return Response(body, mimetype='application/json')
+
+def fetch_good(name):
+    """
+    Looks up an item in the Inventory Service, unless a fresh copy is cached.
+
+    An expired cached copy is revalidated with its ETag instead of being transferred again. Callers first call
+    :func:`sync_inventory_caches`, once per request; this function does not use the database, so it can run on the
+    downstream threads.
+
+    Args:
+        name (str): Name of the item.
+
+    Returns:
+        tuple: ``(good data, None)`` on success, or ``(None, inventory response)`` if the lookup failed.
+
+    Raises:
+        requests.exceptions.RequestException: If the Inventory Service cannot be reached.
+    """
+    cached = item_cache.get(name)
+    if cached is not None:
+        return cached[1], None
+
+    stale = item_cache.get_stale(name)
+    headers = {'If-None-Match': stale[0]} if stale and stale[0] else {}
+    inventory_response = downstream.get(f'{inventory_service_url}/inventory/goods/{name}', headers=headers)
+
+    if inventory_response.status_code == 304 and stale is not None:
+        item_cache.revalidated(name)
+        return stale[1], None
+    if inventory_response.status_code != 200:
+        return None, inventory_response
+
+    good_data = inventory_response.json()
+    item_cache.set(name, (inventory_response.headers.get('ETag'), good_data))
+    return good_data, None
+
+@bp.route('/sale', methods=['POST'])
+@idempotent
 def sale_transaction():
     """
     Handles the sales transaction.
 
-    Processes the sale of an item by checking its availability, confirming the customer's balance, and updating the sales history.
+    Processes the sale of an item by looking it up, reserving one unit in the inventory, then debiting the customer's wallet in a single conditional purchase call.
+    Once both succeed the reservation is committed and the sale is recorded. If the debit fails the unit is released; if the commit fails the refund is queued in the outbox.
+    The debit is sent with an ``Idempotency-Key``; if its outcome is unknown, e.g. its response timed out, the unit is released and the debit is settled and refunded through the outbox.
+    With ``?async=true`` the sale is only recorded in the outbox and processed by the background worker; see :func:`accept_sale`.
 
     Returns:
         JSON: A success message if the sale is successful or an error message otherwise.
@@ -81,79 +435,827 @@ def sale_transaction():
     good_name = data.get('name')
     customer_user = data.get('customer_user')
 
+    if request.args.get('async') == 'true':
+        return accept_sale(good_name, customer_user)
+
     # Check availability of the good in inventory
-    inventory_api_url = f'{inventory_service_url}/inventory/goods/{good_name}'
-    inventory_response = requests.get(inventory_api_url)
+    sync_inventory_caches()
+    try:
+        good_data, inventory_response = fetch_good(good_name)
+    except requests.exceptions.RequestException as e:
+        print(f"Network error during inventory lookup: {e}")
+        return jsonify({'error': f'Error during transaction: {str(e)}'}), 500
 
-    if inventory_response.status_code != 200:
+    if good_data is None:
         # Log and return error if item is not found in inventory
         print(f"Failed to retrieve item from inventory. Status: {inventory_response.status_code}, Response: {inventory_response.text}")
         return jsonify({'error': 'Item not available in inventory'}), inventory_response.status_code
 
-    good_data = inventory_response.json()
     if good_data.get('price', 0) <= 0:
         return jsonify({'error': 'Item not available'}), 404
 
-    # Check customer's balance
-    customer_balance_api_url = f'{customer_service_url}/balance/{customer_user}'
+    # Hold one unit first, so a customer is never charged for an item that is out of stock
+    refund_reason = None
     try:
-        customer_balance_response = requests.get(customer_balance_api_url)
-
-        if customer_balance_response.status_code != 200:
-            print(f"Failed to retrieve customer balance. Status: {customer_balance_response.status_code}, Response: {customer_balance_response.text}")
-            return jsonify({'error': 'Failed to retrieve customer balance'}), customer_balance_response.status_code
+        reserve_response = downstream.post(f"{inventory_service_url}/inventory/reserve/{good_data['id']}", json={'amount': 1})
+        if reserve_response.status_code == 409:
+            return jsonify({'error': 'Item out of stock'}), 409
+        if reserve_response.status_code != 201:
+            print(f"Failed to reserve stock. Status: {reserve_response.status_code}, Response: {reserve_response.text}")
+            return jsonify({'error': 'Item not available in inventory'}), reserve_response.status_code
+        reservation_url = f"{inventory_service_url}/inventory/reservations/{reserve_response.json()['reservation_id']}"
 
-        customer_balance_data = customer_balance_response.json()
-        if customer_balance_data.get('balance', 0) < good_data['price']:
-            return jsonify({'error': 'Insufficient funds'}), 400
+        # Deduct amount from customer's wallet, giving the unit back if that fails
+        debit_key = new_debit_key()
+        try:
+            purchase_response = downstream.post(f'{customer_service_url}/purchase/{customer_user}', json={'amount': good_data['price']},
+                                                headers={'Idempotency-Key': debit_key})
+        except requests.exceptions.RequestException as e:
+            release_reservation(reservation_url)
+            queue_refund(customer_user, good_name, good_data['price'], f'Wallet debit outcome unknown: {e}', debit_key=debit_key)
+            raise
+        if purchase_response.status_code != 200:
+            release_reservation(reservation_url)
+            if purchase_response.status_code == 400:
+                return jsonify({'error': 'Insufficient funds'}), 400
+            print(f"Failed to deduct amount from wallet. Status: {purchase_response.status_code}, Response: {purchase_response.text}")
+            return jsonify({'error': 'Failed to deduct amount from wallet'}), purchase_response.status_code
 
-        # Deduct amount from customer's wallet
-        wallet_deduct_api_url = f'{customer_service_url}/deduct_wallet/{customer_user}'
-        wallet_deduct_response = requests.post(wallet_deduct_api_url, json={'amount': good_data['price']})
-
-        if wallet_deduct_response.status_code != 200:
-            print(f"Failed to deduct amount from wallet. Status: {wallet_deduct_response.status_code}, Response: {wallet_deduct_response.text}")
-            return jsonify({'error': 'Failed to deduct amount from wallet'}), wallet_deduct_response.status_code
+        # Make the deduction permanent. If that fails the reservation expires on its own, so only the payment is
+        # given back
+        try:
+            commit_response = downstream.post(f'{reservation_url}/commit')
+            if commit_response.status_code != 200:
+                refund_reason = 'Stock reservation expired'
+        except requests.exceptions.RequestException as e:
+            print(f"Network error while committing reservation: {e}")
+            refund_reason = f'Stock reservation commit failed: {e}'
 
     except requests.exceptions.RequestException as e:
-        print(f"Network error during customer balance check or wallet deduction: {e}")
+        print(f"Network error during sale: {e}")
         return jsonify({'error': f'Error during transaction: {str(e)}'}), 500
 
+    if refund_reason is not None:
+        queue_refund(customer_user, good_name, good_data['price'], refund_reason)
+        return jsonify({'error': 'Stock reservation expired'}), 409
+
     # Register the sale
     sale = Sales(username=customer_user, name=good_name, price=good_data['price'], time=datetime.utcnow())
     db.session.add(sale)
+    record_rollups([{'username': sale.username, 'name': sale.name, 'price': sale.price, 'time': sale.time}])
+    bump_version('sales')
     db.session.commit()
 
     return jsonify({'message': 'Sale successful'}), 200
 
+def new_debit_key():
+    """
+    Builds the ``Idempotency-Key`` of a wallet debit sent by a request, unique to that request.
+
+    Returns:
+        str: The key.
+    """
+    return f'sale-{uuid.uuid4().hex}-debit'
+
+def release_reservation(reservation_url):
+    """
+    Gives reserved units back to the stock after a failed sale.
+
+    A failed release is only logged: the reservation expires on its own and the sweeper returns the units.
+
+    Args:
+        reservation_url (str): URL of the reservation in the Inventory Service.
+    """
+    try:
+        downstream.post(f'{reservation_url}/release')
+    except requests.exceptions.RequestException as e:
+        print(f"Network error while releasing reservation: {e}")
+
+class RetryableSaleError(Exception):
+    """A downstream step of an asynchronous sale failed in a way that may succeed if retried."""
+
+class SaleRejected(Exception):
+    """An asynchronous sale cannot go through, e.g. the item is unknown or the customer cannot pay."""
+
+def accept_sale(good_name, customer_user):
+    """
+    Records a sale in the outbox for the background worker and returns immediately.
+
+    Args:
+        good_name (str): Name of the item being bought.
+        customer_user (str): Username of the customer buying it.
+
+    Returns:
+        JSON: The id and status URL of the accepted sale, with status 202.
+    """
+    if not good_name or not customer_user:
+        return jsonify({'error': 'Item name and customer are required'}), 400
+
+    order = SaleOrder(username=customer_user, name=good_name)
+    db.session.add(order)
+    db.session.commit()
+
+    # The server starts the worker with the process; starting it here covers servers that do not
+    sale_worker = current_app.extensions['sale_worker']
+    sale_worker.start()
+    sale_worker.wake()
+    response = jsonify({'message': 'Sale accepted', 'sale_id': order.id, 'status': order.status, 'status_url': f'/sale/{order.id}'})
+    response.headers['Location'] = f'/sale/{order.id}'
+    return response, 202
+
+def claim_sale_orders(limit):
+    """
+    Claims due outbox orders for this worker.
+
+    Each order is claimed with a conditional update, so concurrent workers never process the same order. Orders
+    left in ``processing`` longer than the lease (e.g. by a crashed worker) are claimed again.
+
+    Args:
+        limit (int): Maximum number of orders to claim.
+
+    Returns:
+        list: Ids of the claimed orders.
+    """
+    now = datetime.utcnow()
+    expired_lease = now - timedelta(seconds=current_app.config['OUTBOX_LEASE'])
+    due = or_(
+        (SaleOrder.status == 'pending') & (SaleOrder.next_attempt_at <= now),
+        (SaleOrder.status == 'processing') & (SaleOrder.updated_at < expired_lease),
+    )
+    candidates = [order_id for (order_id,) in db.session.query(SaleOrder.id).filter(due).order_by(SaleOrder.next_attempt_at).limit(limit)]
+
+    claimed = []
+    for order_id in candidates:
+        result = db.session.execute(
+            update(SaleOrder)
+            .where(SaleOrder.id == order_id, due)
+            .values(status='processing', attempts=SaleOrder.attempts + 1, updated_at=now)
+        )
+        if result.rowcount:
+            claimed.append(order_id)
+    db.session.commit()
+    return claimed
+
+def order_key(order, step):
+    """
+    Builds the ``Idempotency-Key`` header of one downstream write of an outbox order.
+
+    The key only depends on the order and the step, so every retry of the step sends the same key.
+
+    Args:
+        order (SaleOrder): The order being processed.
+        step (str): ``debit``, ``stock`` or ``refund``.
+
+    Returns:
+        dict: The request headers.
+    """
+    return {'Idempotency-Key': f'sale-order-{order.id}-{step}'}
+
+def run_sale_order(order_id):
+    """
+    Drives one claimed outbox order through the sale pipeline.
+
+    The steps are: resolve the item, debit the wallet, deduct the stock and record the sale. Each successful
+    downstream step is committed on the order before the next one starts, and recording the sale completes the
+    order in the same transaction. The writes are sent with an ``Idempotency-Key`` derived from the order (see
+    :func:`order_key`), so retrying a step whose response was lost, e.g. a timeout after the other service
+    committed, gets the stored response back instead of charging or deducting twice. Transient failures put the order back to ``pending`` with exponential backoff;
+    a rejected sale, or one that ran out of attempts, has its wallet debit refunded before it is marked ``failed``.
+
+    Args:
+        order_id (int): Id of the claimed order.
+    """
+    order = db.session.get(SaleOrder, order_id)
+    try:
+        if order.compensate:
+            refund_sale_order(order)
+            return
+
+        if order.price is None:
+            sync_inventory_caches()
+            good_data, inventory_response = fetch_good(order.name)
+            if good_data is None:
+                if inventory_response.status_code == 404:
+                    raise SaleRejected('Item not available in inventory')
+                raise RetryableSaleError(f'Inventory lookup failed with status {inventory_response.status_code}')
+            if good_data.get('price', 0) <= 0:
+                raise SaleRejected('Item not available')
+            order.price = good_data['price']
+            order.item_id = good_data.get('id')
+            db.session.commit()
+
+        if not order.wallet_debited:
+            purchase_response = downstream.post(f'{customer_service_url}/purchase/{order.username}', json={'amount': order.price},
+                                                headers=order_key(order, 'debit'))
+            if purchase_response.status_code == 400:
+                raise SaleRejected('Insufficient funds')
+            if purchase_response.status_code == 404:
+                raise SaleRejected('Customer not found')
+            if purchase_response.status_code != 200:
+                raise RetryableSaleError(f'Wallet debit failed with status {purchase_response.status_code}')
+            order.wallet_debited = True
+            db.session.commit()
+
+        if not order.stock_deducted and order.item_id is not None:
+            deduct_response = downstream.post(f'{inventory_service_url}/inventory/deduce/{order.item_id}', json={'amount': 1},
+                                              headers=order_key(order, 'stock'))
+            if deduct_response.status_code in (400, 404):
+                raise SaleRejected('Insufficient stock')
+            if deduct_response.status_code != 200:
+                raise RetryableSaleError(f'Stock deduction failed with status {deduct_response.status_code}')
+            order.stock_deducted = True
+            db.session.commit()
+
+        # Record the sale and complete the order in one transaction
+        sale = Sales(username=order.username, name=order.name, price=order.price, time=datetime.utcnow())
+        db.session.add(sale)
+        record_rollups([{'username': sale.username, 'name': sale.name, 'price': sale.price, 'time': sale.time}])
+        bump_version('sales')
+        db.session.flush()
+        order.sale_id = sale.id
+        order.status = 'completed'
+        order.error = None
+        order.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    except SaleRejected as e:
+        db.session.rollback()
+        order.error = str(e)
+        if order.wallet_debited:
+            order.compensate = True
+            retry_sale_order(order)
+        else:
+            fail_sale_order(order)
+
+    except (RetryableSaleError, requests.exceptions.RequestException) as e:
+        db.session.rollback()
+        order.error = str(e)
+        if order.attempts < current_app.config['OUTBOX_MAX_ATTEMPTS'] or order.stock_deducted:
+            retry_sale_order(order)
+        elif order.wallet_debited:
+            # Out of attempts after the customer paid: roll the payment back
+            order.compensate = True
+            retry_sale_order(order)
+        else:
+            fail_sale_order(order)
+
+def refund_sale_order(order):
+    """
+    Refunds the wallet debit of an order being rolled back, then marks it ``failed``.
+
+    A failed refund is retried until it succeeds, under the same ``Idempotency-Key``, so the customer never loses
+    the money and is never refunded twice. If the order has a ``debit_key``, the debit is first replayed under it:
+    the Customer Service answers with the stored outcome if the debit went through, or applies it now if it never
+    arrived, so the refund always matches exactly one debit. A debit that is refused needs no refund.
+
+    Args:
+        order (SaleOrder): The order to roll back.
+    """
+    try:
+        if not order.wallet_debited:
+            debit_response = downstream.post(f'{customer_service_url}/purchase/{order.username}', json={'amount': order.price},
+                                             headers={'Idempotency-Key': order.debit_key})
+            if debit_response.status_code in (400, 404):
+                order.compensate = False
+                order.error = 'Wallet was not debited'
+                fail_sale_order(order)
+                return
+            if debit_response.status_code != 200:
+                raise RetryableSaleError(f'Settling the debit failed with status {debit_response.status_code}')
+            order.wallet_debited = True
+            db.session.commit()
+
+        refund_response = downstream.post(f'{customer_service_url}/charge_wallet/{order.username}', json={'amount': order.price},
+                                          headers=order_key(order, 'refund'))
+        if refund_response.status_code != 200:
+            raise RetryableSaleError(f'Refund failed with status {refund_response.status_code}')
+    except (RetryableSaleError, requests.exceptions.RequestException) as e:
+        print(f"Failed to refund sale {order.id}: {e}")
+        retry_sale_order(order)
+        return
+
+    order.wallet_debited = False
+    order.compensate = False
+    fail_sale_order(order)
+
+def retry_sale_order(order):
+    """
+    Puts an order back in the queue with exponential backoff, capped at one minute.
+
+    Args:
+        order (SaleOrder): The order to retry.
+    """
+    now = datetime.utcnow()
+    delay = min(current_app.config['OUTBOX_RETRY_BACKOFF'] * 2 ** max(order.attempts - 1, 0), 60)
+    order.status = 'pending'
+    order.next_attempt_at = now + timedelta(seconds=delay)
+    order.updated_at = now
+    db.session.commit()
+
+def fail_sale_order(order):
+    """
+    Marks an order as ``failed`` for good.
+
+    Args:
+        order (SaleOrder): The order that failed.
+    """
+    order.status = 'failed'
+    order.updated_at = datetime.utcnow()
+    db.session.commit()
+
+def queue_refund(username, name, amount, reason, debit_key=None):
+    """
+    Queues the refund of a wallet debit whose sale did not go through.
+
+    The refund is written to the outbox as an order being rolled back, so the background worker sends it and keeps
+    retrying until it succeeds, instead of it being attempted once in the request.
+
+    Args:
+        username (str): Username of the customer to refund.
+        name (str): Name of what was being bought, reported by the order status.
+        amount (float): The amount debited.
+        reason (str): Why the sale did not go through.
+        debit_key (str): ``Idempotency-Key`` of the debit if its outcome is unknown, see :func:`refund_sale_order`.
+
+    Returns:
+        SaleOrder: The queued order.
+    """
+    order = SaleOrder(username=username, name=name[:200], price=amount, wallet_debited=debit_key is None, compensate=True,
+                      debit_key=debit_key, error=reason[:500])
+    db.session.add(order)
+    db.session.commit()
+
+    sale_worker = current_app.extensions['sale_worker']
+    sale_worker.start()
+    sale_worker.wake()
+    return order
+
+def process_sale_outbox(app):
+    """
+    Claims and processes one batch of due outbox orders.
+
+    Args:
+        app (Flask): The application whose outbox is processed.
+
+    Returns:
+        int: The number of orders processed.
+    """
+    with app.app_context():
+        try:
+            order_ids = claim_sale_orders(app.config['OUTBOX_BATCH_SIZE'])
+            for order_id in order_ids:
+                run_sale_order(order_id)
+            return len(order_ids)
+        finally:
+            db.session.remove()
+
+@bp.cli.command('sale-worker')
+def run_sale_worker():
+    """Processes the sale outbox in the foreground, for running the worker as a separate process."""
+    current_app.extensions['sale_worker'].run_forever()
+
+@bp.route('/sale/<int:sale_id>', methods=['GET'])
+def get_sale_status(sale_id):
+    """
+    Reports the progress of a sale accepted with ``POST /sale?async=true``.
+
+    Args:
+        sale_id (int): The id returned when the sale was accepted.
+
+    Returns:
+        JSON: The status of the sale, or an error message.
+    """
+    order = db.session.get(SaleOrder, sale_id)
+    if not order:
+        return jsonify({'error': 'Sale not found'}), 404
+    return jsonify(order.to_dict()), 200
+
+@bp.route('/checkout', methods=['POST'])
+def checkout():
+    """
+    Handles the checkout of a basket of goods.
+
+    Resolves every item with one bulk inventory lookup, revalidating expired cached items at the same time. Then it
+    debits the customer's wallet once for the basket total, deducts all stock in one bulk call and records every
+    unit sold in a single transaction. If the stock deduction fails after the wallet was debited, the total is
+    refunded through the outbox, so the refund is retried until it succeeds. The debit is sent with an
+    ``Idempotency-Key``, so if its outcome is unknown the outbox can settle it and refund it the same way.
+
+    Expects a JSON body of the form ``{"customer_user": "john_doe", "items": [{"name": "Laptop", "quantity": 2}]}``.
+
+    Returns:
+        JSON: A success message with the basket total, or an error message otherwise.
+    """
+    data = request.json
+    customer_user = data.get('customer_user') if isinstance(data, dict) else None
+    lines = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(customer_user, str) or not customer_user or not isinstance(lines, list) or not lines:
+        return jsonify({'error': 'Invalid basket'}), 400
+
+    # Merge repeated lines for the same good
+    quantities = {}
+    for line in lines:
+        name = line.get('name') if isinstance(line, dict) else None
+        quantity = line.get('quantity', 1) if isinstance(line, dict) else None
+        # Names are dict keys and quantities are counts, so a list as a name or a bool as a quantity is rejected
+        if not isinstance(name, str) or not name or not isinstance(quantity, int) or isinstance(quantity, bool) \
+                or quantity <= 0:
+            return jsonify({'error': 'Invalid basket line', 'line': line}), 400
+        quantities[name] = quantities.get(name, 0) + quantity
+
+    try:
+        # Items cached with an ETag are revalidated if they expired, and the others are resolved with one bulk
+        # call. These lookups are independent of each other, so they run concurrently.
+        sync_inventory_caches()
+        goods = {}
+        revalidated = []
+        for name in quantities:
+            cached = item_cache.get(name)
+            if cached is not None:
+                goods[name] = cached[1]
+            elif (item_cache.get_stale(name) or (None,))[0]:
+                revalidated.append(name)
+        uncached = [name for name in quantities if name not in goods and name not in revalidated]
+
+        lookups = [partial(fetch_good, name) for name in revalidated]
+        if uncached:
+            lookups.append(partial(downstream.post, f'{inventory_service_url}/inventory/goods/bulk', json={'names': uncached}))
+        results = downstream.concurrently(*lookups)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        missing = []
+        for name, (good_data, inventory_response) in zip(revalidated, results):
+            if good_data is not None:
+                goods[name] = good_data
+            elif inventory_response.status_code == 404:
+                missing.append(name)
+            else:
+                print(f"Failed to retrieve item from inventory. Status: {inventory_response.status_code}, Response: {inventory_response.text}")
+                return jsonify({'error': 'Items not available in inventory'}), inventory_response.status_code
+
+        if uncached:
+            inventory_response = results[-1]
+            if inventory_response.status_code != 200:
+                print(f"Failed to retrieve items from inventory. Status: {inventory_response.status_code}, Response: {inventory_response.text}")
+                return jsonify({'error': 'Items not available in inventory'}), inventory_response.status_code
+
+            inventory_data = inventory_response.json()
+            for good in inventory_data.get('Inventory', []):
+                goods[good['name']] = good
+                item_cache.set(good['name'], (None, good))
+            missing += inventory_data.get('missing', [])
+
+        unavailable = missing + [name for name, good in goods.items() if good.get('price', 0) <= 0]
+        if unavailable:
+            return jsonify({'error': 'Items not available', 'items': unavailable}), 404
+
+        total = sum(goods[name]['price'] * quantity for name, quantity in quantities.items())
+
+    except requests.exceptions.RequestException as e:
+        print(f"Network error during checkout: {e}")
+        return jsonify({'error': f'Error during transaction: {str(e)}'}), 500
+
+    # Debit the wallet once for the whole basket. If the outcome is unknown the customer may have been charged,
+    # so the outbox settles the debit under its key and refunds it.
+    debit_key = new_debit_key()
+    try:
+        purchase_response = downstream.post(f'{customer_service_url}/purchase/{customer_user}', json={'amount': total},
+                                            headers={'Idempotency-Key': debit_key})
+    except requests.exceptions.RequestException as e:
+        print(f"Network error during checkout: {e}")
+        queue_refund(customer_user, ', '.join(quantities), total, f'Wallet debit outcome unknown: {e}', debit_key=debit_key)
+        return jsonify({'error': f'Error during transaction: {str(e)}'}), 500
+    if purchase_response.status_code == 400:
+        return jsonify({'error': 'Insufficient funds'}), 400
+    if purchase_response.status_code != 200:
+        print(f"Failed to deduct amount from wallet. Status: {purchase_response.status_code}, Response: {purchase_response.text}")
+        return jsonify({'error': 'Failed to deduct amount from wallet'}), purchase_response.status_code
+
+    # Deduct all stock in one batch once the basket is paid for, refunding the wallet if that fails
+    deduct_lines = [{'item_id': goods[name]['id'], 'amount': quantity} for name, quantity in quantities.items()]
+    try:
+        deduct_response = downstream.post(f'{inventory_service_url}/inventory/deduce/bulk', json={'items': deduct_lines})
+    except requests.exceptions.RequestException as e:
+        print(f"Network error during checkout: {e}")
+        queue_refund(customer_user, ', '.join(quantities), total, f'Stock deduction failed: {e}')
+        return jsonify({'error': f'Error during transaction: {str(e)}'}), 500
+    if deduct_response.status_code != 200:
+        print(f"Failed to deduct stock. Status: {deduct_response.status_code}, Response: {deduct_response.text}")
+        queue_refund(customer_user, ', '.join(quantities), total, 'Insufficient stock')
+        return jsonify({'error': 'Insufficient stock'}), 409
+
+    # Register every unit sold in one transaction
+    now = datetime.utcnow()
+    rows = [
+        {'username': customer_user, 'name': name, 'price': goods[name]['price'], 'time': now}
+        for name, quantity in quantities.items()
+        for _ in range(quantity)
+    ]
+    db.session.execute(insert(Sales), rows)
+    record_rollups(rows)
+    bump_version('sales')
+    db.session.commit()
+
+    return jsonify({'message': 'Checkout successful', 'total': total, 'units': len(rows)}), 200
+
+@bp.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """
+    Drops cached inventory data after an item changed.
+
+    Called by the Inventory Service when an item is updated. Expects an optional JSON body of the form
+    ``{"names": ["Laptop"]}``; the named items are dropped from the item cache and every cached catalog page is
+    dropped. Without names, the item cache is cleared as well.
+
+    Only one server process receives the call, so it also bumps the shared ``inventory`` version: every other
+    process clears its caches on its next lookup (see :func:`sync_inventory_caches`).
+
+    Returns:
+        JSON: A success message.
+    """
+    global cached_inventory_version
+    names = (request.get_json(silent=True) or {}).get('names')
+    bump_version('inventory')
+    db.session.commit()
+    version = read_inventory_version()
+
+    with cached_inventory_version_lock:
+        if names:
+            for name in names:
+                item_cache.invalidate(name)
+        else:
+            item_cache.clear()
+        catalog_cache.clear()
+        # Only the named items changed if no other invalidation arrived since this process last synced
+        if cached_inventory_version is not None and version == cached_inventory_version + 1:
+            cached_inventory_version = version
+    return jsonify({'message': 'Cache invalidated'}), 200
+
+@bp.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    Reports hit/miss/eviction counters for the item and catalog caches.
+
+    Returns:
+        JSON: Counters for each cache.
+    """
+    return jsonify({'items': item_cache.stats(), 'catalog': catalog_cache.stats()}), 200
+
+@bp.route('/downstream/stats', methods=['GET'])
+def downstream_stats():
+    """
+    Reports connection pool and latency counters for calls to the Inventory and Customer services.
+
+    Returns:
+        JSON: Request and error counts, pool hits/misses and latency figures.
+    """
+    return jsonify(downstream.stats()), 200
+
 # additional route in case of sales history 
-@app.route('/sales-history/<username>', methods=['GET'])
+@bp.route('/sales-history/<username>', methods=['GET'])
+@conditional('sales')
 def get_sales_history(username):
 
     """
-    Retrieves the sales history of a specific customer.
+    Retrieves the sales history of a specific customer, one page at a time.
+
+    Sales are ordered by time, oldest first (``order=desc`` for newest first), and paged with a cursor: pass the
+    ``next_cursor`` of one page as ``after`` to fetch the next one. With ``summary=true`` the total spend, the
+    number of purchases and per-item totals are returned instead, aggregated in SQL.
 
     Args:
         username (str): Username of the customer.
 
+    Query Parameters:
+        start (str): Only include sales at or after this ISO 8601 time.
+        end (str): Only include sales before this ISO 8601 time.
+        after (str): Cursor of the last sale of the previous page.
+        limit (int): Page size, at most 1000 (default 100).
+        order (str): ``asc`` (default) or ``desc``.
+        summary (str): ``true`` to return aggregates instead of individual sales.
+
     Returns:
-        JSON: A list of all sales transactions associated with the given username.
+        JSON: A page of sales transactions associated with the given username, or their summary.
     """
-    history = Sales.query.filter_by(username=username).all()
+    try:
+        start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else None
+        after = decode_cursor(request.args['after']) if 'after' in request.args else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    filters = [Sales.username == username]
+    if start is not None:
+        filters.append(Sales.time >= start)
+    if end is not None:
+        filters.append(Sales.time < end)
+
+    if request.args.get('summary') == 'true':
+        count, total = db.session.query(func.count(Sales.id), func.coalesce(func.sum(Sales.price), 0.0)).filter(*filters).one()
+        per_item = db.session.query(Sales.name, func.count(Sales.id), func.sum(Sales.price)) \
+            .filter(*filters).group_by(Sales.name).order_by(func.sum(Sales.price).desc()).all()
+        return jsonify({
+            'username': username,
+            'count': count,
+            'total_spent': total,
+            'items': [{'good': name, 'count': item_count, 'total': item_total} for name, item_count, item_total in per_item],
+        })
+
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    descending = request.args.get('order') == 'desc'
+    position = tuple_(Sales.time, Sales.id)
+    if after is not None:
+        filters.append(position < after if descending else position > after)
+    order = (Sales.time.desc(), Sales.id.desc()) if descending else (Sales.time, Sales.id)
+
+    # Fetch one extra row to learn whether another page follows
+    history = db.session.query(Sales.name, Sales.price, Sales.time, Sales.id).filter(*filters).order_by(*order).limit(limit + 1).all()
+    has_more = len(history) > limit
+    history = history[:limit]
 
     if history:
-        formatted_sales_history = [
-            {
-                'good': sale.name,
-                'price': sale.price,
-                'time': sale.time.strftime('%Y-%m-%d %H:%M:%S')
-            }
-            for sale in history
-        ]
-        return jsonify({'sales_history': formatted_sales_history})
+        # Rows are serialized by position; the JSON provider formats the times
+        formatted_sales_history = records(('good', 'price', 'time'), history)
+        return jsonify({'sales_history': formatted_sales_history, 'next_cursor': encode_cursor(history[-1]) if has_more else None})
     else:
         return jsonify({'message': f'No sales history found for {username}'})
 
 
+def parse_day_range():
+    """
+    Reads the ``start`` and ``end`` day query parameters of the analytics endpoints.
+
+    Returns:
+        tuple: The first and last day to include; either may be None.
+
+    Raises:
+        ValueError: If a day is not in ``YYYY-MM-DD`` format.
+    """
+    start = date.fromisoformat(request.args['start']) if 'start' in request.args else None
+    end = date.fromisoformat(request.args['end']) if 'end' in request.args else None
+    return start, end
+
+@bp.route('/analytics/items', methods=['GET'])
+@conditional('sales')
+def item_analytics():
+    """
+    Reports units sold and revenue per item per day, read from the daily rollup table.
+
+    Query Parameters:
+        start (str): First day to include (``YYYY-MM-DD``).
+        end (str): Last day to include (``YYYY-MM-DD``).
+        name (str): Only report this item.
+
+    Returns:
+        JSON: One row per item per day, ordered by day.
+    """
+    try:
+        start, end = parse_day_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    query = db.session.query(DailyItemSales)
+    if start is not None:
+        query = query.filter(DailyItemSales.day >= start)
+    if end is not None:
+        query = query.filter(DailyItemSales.day <= end)
+    if 'name' in request.args:
+        query = query.filter(DailyItemSales.name == request.args['name'])
+
+    rows = query.order_by(DailyItemSales.day, DailyItemSales.name).all()
+    return jsonify({'items': [
+        {'day': row.day.isoformat(), 'good': row.name, 'units': row.units, 'revenue': row.revenue}
+        for row in rows
+    ]}), 200
+
+@bp.route('/analytics/top-customers', methods=['GET'])
+@conditional('sales')
+def top_customers():
+    """
+    Reports the customers who spent the most over a range of days, read from the daily rollup table.
+
+    Query Parameters:
+        start (str): First day to include (``YYYY-MM-DD``).
+        end (str): Last day to include (``YYYY-MM-DD``).
+        limit (int): Number of customers to return, at most 1000 (default 10).
+
+    Returns:
+        JSON: Customers ordered by amount spent, highest first.
+    """
+    try:
+        start, end = parse_day_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        limit = int(request.args.get('limit', 10))
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    spent = func.sum(DailyCustomerSales.spent)
+    query = db.session.query(DailyCustomerSales.username, func.sum(DailyCustomerSales.purchases), spent)
+    if start is not None:
+        query = query.filter(DailyCustomerSales.day >= start)
+    if end is not None:
+        query = query.filter(DailyCustomerSales.day <= end)
+
+    rows = query.group_by(DailyCustomerSales.username).order_by(spent.desc()).limit(min(limit, MAX_PAGE_SIZE)).all()
+    return jsonify({'customers': [
+        {'username': username, 'purchases': purchases, 'spent': total}
+        for username, purchases, total in rows
+    ]}), 200
+
+
+@bp.cli.command('startup-report')
+@click.option('--budget', type=float, help='Fail if a cold start takes longer than this many milliseconds.')
+def startup_report_command(budget):
+    """Measures how long a fresh process takes to import and build the app, phase by phase."""
+    report = measure_cold_start(base_dir)
+    print(json.dumps(report, indent=2))
+    if budget is not None and report['total_ms'] > budget:
+        raise click.ClickException(f"Cold start took {report['total_ms']} ms, over the {budget:g} ms budget")
+
+def load_config():
+    """
+    Reads the service settings from the environment.
+
+    Returns:
+        dict: Flask configuration values.
+    """
+    return {
+        'SQLALCHEMY_DATABASE_URI': database_url(db_path),
+        'JSON_ENCODER': os.environ.get('JSON_ENCODER', 'auto'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': True,
+        # Asynchronous sale pipeline
+        'OUTBOX_WORKERS': int(os.environ.get('SALES_OUTBOX_WORKERS', 2)),
+        'OUTBOX_POLL_INTERVAL': float(os.environ.get('SALES_OUTBOX_POLL_INTERVAL', 1.0)),
+        'OUTBOX_BATCH_SIZE': int(os.environ.get('SALES_OUTBOX_BATCH_SIZE', 20)),
+        'OUTBOX_MAX_ATTEMPTS': int(os.environ.get('SALES_OUTBOX_MAX_ATTEMPTS', 5)),
+        'OUTBOX_RETRY_BACKOFF': float(os.environ.get('SALES_OUTBOX_RETRY_BACKOFF', 0.5)),
+        'OUTBOX_LEASE': float(os.environ.get('SALES_OUTBOX_LEASE', 60)),
+        # Idempotency keys
+        'IDEMPOTENCY_TTL': float(os.environ.get('IDEMPOTENCY_TTL', 86400)),
+        'IDEMPOTENCY_LEASE': float(os.environ.get('IDEMPOTENCY_LEASE', 60)),
+        'IDEMPOTENCY_PURGE_INTERVAL': float(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 60)),
+    }
+
+def create_app(config=None):
+    """
+    Builds the Sales Service app.
+
+    Building the app does not connect to the database: connections are opened by the first request, and the schema
+    is created by the ``migrate`` command instead of on every start. The outbox worker is listed in
+    ``app.extensions['background_workers']``; the server starts its threads in every process it serves the app from
+    (see ``post_worker_init`` in ``gunicorn.conf.py``), so orders left over by a recycled or crashed process are
+    picked up without waiting for another sale. How long each phase took is kept in
+    ``app.extensions['startup_report']``.
+
+    Args:
+        config (dict): Settings overriding the ones read from the environment, e.g. the database URI in tests.
+
+    Returns:
+        Flask: The application.
+    """
+    timer = StartupTimer()
+    app = Flask(__name__)
+    with timer.phase('config'):
+        app.config.update(load_config())
+        app.config.update(config or {})
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+        app.json = JSONProvider(app, app.config['JSON_ENCODER'])
+    with timer.phase('database'):
+        db.init_app(app)
+        configure_engine(app, db)
+    with timer.phase('routes'):
+        app.register_blueprint(bp)
+        metrics.init_app(app, db)
+    # Background worker processing the sale outbox
+    app.extensions['sale_worker'] = BackgroundWorker(
+        'sale-outbox-worker',
+        partial(process_sale_outbox, app),
+        threads=app.config['OUTBOX_WORKERS'],
+        interval=app.config['OUTBOX_POLL_INTERVAL'],
+    )
+    app.extensions['background_workers'] = [app.extensions['sale_worker']]
+    app.extensions['startup_report'] = timer.report()
+    return app
+
+# Development server only; in production the app is served by Gunicorn (see gunicorn.conf.py)
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app = create_app()
+    with app.app_context():
+        migrate()
+    for background_worker in app.extensions['background_workers']:
+        background_worker.start()
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,141 @@
+"""
+Lookup Cache
+
+This module provides the in-process cache used by the Sales Service for inventory item lookups and catalog pages.
+Entries expire after a fixed time-to-live, and the least recently used entry is evicted once the cache is full.
+Expired entries stay readable through :meth:`TTLCache.get_stale` so they can be revalidated with a conditional
+request instead of being fetched again in full.
+
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread-safe, size-bounded cache whose entries expire after a time-to-live.
+
+    Attributes:
+        maxsize (int): Maximum number of entries kept before the least recently used one is evicted.
+        ttl (float): Seconds an entry stays fresh after it was stored.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30.0):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+        self._revalidations = 0
+
+    def get(self, key):
+        """
+        Returns the cached value for a key.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            The cached value, or None if the key is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def get_stale(self, key):
+        """
+        Returns the cached value for a key even if it has expired, without touching the counters.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            The cached value, or None if the key is missing.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def revalidated(self, key):
+        """
+        Counts a stale entry that the origin confirmed is unchanged, and makes it fresh again.
+
+        Args:
+            key: The cache key.
+        """
+        value = self.get_stale(key)
+        if value is not None:
+            self.set(key, value)
+            with self._lock:
+                self._revalidations += 1
+
+    def set(self, key, value):
+        """
+        Stores a value, evicting the least recently used entry if the cache is full.
+
+        Args:
+            key: The cache key.
+            value: The value to cache.
+        """
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        """
+        Removes a key from the cache.
+
+        Args:
+            key: The cache key.
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._invalidations += 1
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        with self._lock:
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Size, capacity, TTL and hit/miss/eviction/expiration/invalidation/revalidation counts.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(self._hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+                'revalidations': self._revalidations,
+            }
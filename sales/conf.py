@@ -29,3 +29,4 @@ html_static_path = ['_static']
 import os
 import sys
 sys.path.insert(0, os.path.abspath('..'))
+sys.path.insert(0, os.path.abspath('.'))
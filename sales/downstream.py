@@ -0,0 +1,179 @@
+"""
+Downstream HTTP Client
+
+This module provides the pooled HTTP client used by the Sales Service to call the Inventory and Customer services.
+Connections are kept alive and reused per host, every call carries a connect/read timeout, and idempotent GETs
+are retried with exponential backoff. Independent calls can be issued concurrently on a small thread pool.
+
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class DownstreamClient:
+    """
+    Pooled, keep-alive HTTP client for calls to other services.
+
+    Each setting falls back to an environment variable and then to a default.
+
+    Attributes:
+        pool_size (int): Maximum number of kept-alive connections per host (``DOWNSTREAM_POOL_SIZE``, default 10).
+        connect_timeout (float): Seconds to wait for a connection (``DOWNSTREAM_CONNECT_TIMEOUT``, default 2).
+        read_timeout (float): Seconds to wait for a response (``DOWNSTREAM_READ_TIMEOUT``, default 5).
+        retries (int): Retry attempts for idempotent GETs (``DOWNSTREAM_RETRIES``, default 2).
+        backoff_factor (float): Exponential backoff factor between retries (``DOWNSTREAM_BACKOFF``, default 0.1).
+        concurrency (int): Threads used by :meth:`concurrently` (``DOWNSTREAM_CONCURRENCY``, default 4); 1 or
+            less runs the calls one after the other in the calling thread.
+        listener (callable): Called after every request with the method, the URL, the status code (None if the
+            request failed) and the latency in seconds, e.g. to record metrics.
+    """
+
+    #: HTTP status codes on which an idempotent GET is retried.
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None, retries=None, backoff_factor=None, concurrency=None):
+        self.pool_size = int(pool_size if pool_size is not None else os.environ.get('DOWNSTREAM_POOL_SIZE', 10))
+        self.connect_timeout = float(connect_timeout if connect_timeout is not None else os.environ.get('DOWNSTREAM_CONNECT_TIMEOUT', 2))
+        self.read_timeout = float(read_timeout if read_timeout is not None else os.environ.get('DOWNSTREAM_READ_TIMEOUT', 5))
+        self.retries = int(retries if retries is not None else os.environ.get('DOWNSTREAM_RETRIES', 2))
+        self.backoff_factor = float(backoff_factor if backoff_factor is not None else os.environ.get('DOWNSTREAM_BACKOFF', 0.1))
+        self.concurrency = int(concurrency if concurrency is not None else os.environ.get('DOWNSTREAM_CONCURRENCY', 4))
+
+        # Only GETs are retried on read errors and bad statuses; connection failures are safe to retry for any
+        # method because the request never reached the server.
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self.listener = None
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._requests = 0
+        self._errors = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    @property
+    def timeout(self):
+        """tuple: The ``(connect, read)`` timeout passed to every request."""
+        return (self.connect_timeout, self.read_timeout)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request through the pooled session and records its latency.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The full URL of the downstream endpoint.
+            **kwargs: Extra arguments forwarded to :meth:`requests.Session.request`.
+
+        Returns:
+            requests.Response: The downstream response.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails after all retries.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        response = None
+        try:
+            response = self.session.request(method, url, **kwargs)
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._requests += 1
+                self._errors += response is None
+                self._latency_total += elapsed
+                self._latency_max = max(self._latency_max, elapsed)
+            if self.listener is not None:
+                self.listener(method, url, response.status_code if response is not None else None, elapsed)
+
+    def get(self, url, **kwargs):
+        """Sends a GET request. See :meth:`request`."""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """Sends a POST request. See :meth:`request`."""
+        return self.request('POST', url, **kwargs)
+
+    def concurrently(self, *calls):
+        """
+        Runs independent calls at the same time and waits for all of them.
+
+        Every call runs to completion even if another one fails, so the caller can compensate for the ones that
+        succeeded. Exceptions are returned in place of results rather than raised.
+
+        Args:
+            *calls (callable): Functions taking no arguments, typically wrapping :meth:`get` or :meth:`post`.
+
+        Returns:
+            list: The result or the exception of each call, in the order the calls were given.
+        """
+        if self.concurrency <= 1 or len(calls) <= 1:
+            return [self._capture(call) for call in calls]
+
+        futures = [self._get_executor().submit(self._capture, call) for call in calls]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _capture(call):
+        """Runs a call and returns its result, or the exception it raised."""
+        try:
+            return call()
+        except Exception as e:
+            return e
+
+    def _get_executor(self):
+        """Returns the thread pool for concurrent calls, creating it in this process if needed."""
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='downstream')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def stats(self):
+        """
+        Returns connection pool and latency counters.
+
+        A pool hit is a request served on an already-open connection; a miss is one that had to open a new
+        connection.
+
+        Returns:
+            dict: Request count, error count, pool hits/misses and latency figures in milliseconds.
+        """
+        opened = 0
+        served = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                served += pool.num_requests
+
+        with self._lock:
+            count = self._requests
+            return {
+                'requests': count,
+                'errors': self._errors,
+                'pool_hits': max(served - opened, 0),
+                'pool_misses': opened,
+                'latency_avg_ms': round(self._latency_total / count * 1000, 3) if count else 0.0,
+                'latency_max_ms': round(self._latency_max * 1000, 3),
+            }
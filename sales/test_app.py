@@ -1,7 +1,21 @@
 import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
 import pytest
+import requests
 import requests_mock
-from app import app, db, Sales
+from app import create_app, db, migrate, Sales, SaleOrder, item_cache, catalog_cache, process_sale_outbox, queue_refund
+from cache import TTLCache
+from versions import bump_version
+
+# The tests get their own database file, configured before the engine is created
+app = create_app({
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='sales-test-'), 'test.db')}",
+})
 
 # URL to Inventory API
 inventory_service_url = os.environ.get('INVENTORY_SERVICE_URL') or 'http://localhost:5002'  # URL to Inventory API
@@ -12,25 +26,49 @@ customer_service_url = os.environ.get('CUSTOMER_SERVICE_URL') or 'http://localho
 @pytest.fixture(scope='module')
 def test_client():
     flask_app = app
-    # Configure the app for testing
-    flask_app.config['TESTING'] = True
-    flask_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    
+
     # Create a test client using the Flask application
     with flask_app.test_client() as testing_client:
         # Establish an application context
         with flask_app.app_context():
-            db.create_all()
+            migrate()
         yield testing_client  # This is where the testing happens
         with flask_app.app_context():
             db.drop_all()
 
+# Start every test with empty lookup caches
+@pytest.fixture(autouse=True)
+def clear_caches():
+    item_cache.clear()
+    catalog_cache.clear()
+
 # Mock external requests
 @pytest.fixture
 def mock_external_requests():
     with requests_mock.Mocker() as m:
         yield m
 
+def mock_reservation(mocker, item_id, reservation_id=1):
+    """Mocks a successful reservation of an item and returns the commit and release mocks."""
+    mocker.post(f'http://localhost:5002/inventory/reserve/{item_id}', json={"reservation_id": reservation_id}, status_code=201)
+    commit = mocker.post(f'http://localhost:5002/inventory/reservations/{reservation_id}/commit', json={})
+    release = mocker.post(f'http://localhost:5002/inventory/reservations/{reservation_id}/release', json={})
+    return commit, release
+
+def commit_then_time_out(applied):
+    """
+    Mocks an idempotent downstream write whose first response is lost: the write is applied, then the client times
+    out. Retries with the same ``Idempotency-Key`` get the stored response, and ``applied`` lists the keys applied.
+    """
+    def respond(request, context):
+        key = request.headers['Idempotency-Key']
+        if key not in applied:
+            applied.append(key)
+            raise requests.exceptions.ReadTimeout('Response lost')
+        context.headers['Idempotent-Replayed'] = 'true'
+        return {}
+    return respond
+
 # Test the home endpoint
 def test_home_endpoint(test_client):
     response = test_client.get('/')
@@ -44,18 +82,33 @@ def test_display_goods(test_client, mock_external_requests):
     assert response.status_code == 200
     assert b"Goods" in response.data
 
+def test_display_goods_pagination(test_client, mock_external_requests):
+    mock_external_requests.get('http://localhost:5002/inventory/goods?limit=2&after=5', json={"Inventory": [{"id": 6}], "next_cursor": None})
+    response = test_client.get('/display?limit=2&after=5')
+    assert response.status_code == 200
+    assert response.json == {"Goods": {"Inventory": [{"id": 6}], "next_cursor": None}}
+    assert mock_external_requests.last_request.qs == {'limit': ['2'], 'after': ['5']}
+
+def test_display_goods_ndjson(test_client, mock_external_requests):
+    mock_external_requests.get('http://localhost:5002/inventory/goods?format=ndjson', content=b'{"id": 1}\n{"id": 2}\n')
+    response = test_client.get('/display?format=ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.data == b'{"id": 1}\n{"id": 2}\n'
+
 # Test sale transaction
 def test_sale_transaction(test_client, mock_external_requests):
     # Mock the inventory service response
-    mock_external_requests.get('http://localhost:5002/inventory/goods/good_name', json={"price": 100}, status_code=200)
-    # Mock the customer service responses
-    mock_external_requests.get('http://localhost:5001/balance/customer_user', json={"balance": 200}, status_code=200)
-    mock_external_requests.post('http://localhost:5001/deduct_wallet/customer_user', json={}, status_code=200)
+    mock_external_requests.get('http://localhost:5002/inventory/goods/good_name', json={"id": 1, "price": 100}, status_code=200)
+    commit, release = mock_reservation(mock_external_requests, 1)
+    # Mock the customer service response
+    mock_external_requests.post('http://localhost:5001/purchase/customer_user', json={"new_balance": 100}, status_code=200)
 
     # Test successful transaction
     response = test_client.post('/sale', json={"name": "good_name", "customer_user": "customer_user"})
     assert response.status_code == 200
     assert b"Sale successful" in response.data
+    assert commit.call_count == 1 and release.call_count == 0
 
     # Verify database entry
     with app.app_context():
@@ -63,9 +116,591 @@ def test_sale_transaction(test_client, mock_external_requests):
         assert sale is not None
         assert sale.name == "good_name"
 
+def test_sale_transaction_insufficient_funds(test_client, mock_external_requests):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/good_name', json={"id": 1, "price": 100}, status_code=200)
+    commit, release = mock_reservation(mock_external_requests, 1)
+    mock_external_requests.post('http://localhost:5001/purchase/poor_user', json={"error": "Insufficient funds"}, status_code=400)
+
+    response = test_client.post('/sale', json={"name": "good_name", "customer_user": "poor_user"})
+    assert response.status_code == 400
+    assert b"Insufficient funds" in response.data
+    # The reserved unit goes back to stock
+    assert release.call_count == 1 and commit.call_count == 0
+
+def test_idempotent_sale(test_client, mock_external_requests, outbox):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/once_good', json={"id": 6, "price": 3})
+    commit, _ = mock_reservation(mock_external_requests, 6)
+    purchase = mock_external_requests.post('http://localhost:5001/purchase/once_user', json={"new_balance": 7})
+    headers = {'Idempotency-Key': uuid.uuid4().hex}
+
+    for _ in range(2):
+        response = test_client.post('/sale', json={"name": "once_good", "customer_user": "once_user"}, headers=headers)
+        assert response.status_code == 200
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert purchase.call_count == 1 and commit.call_count == 1
+    with app.app_context():
+        assert Sales.query.filter_by(username="once_user").count() == 1
+
+    # Server errors are not stored, so the retry runs again
+    mock_external_requests.post('http://localhost:5001/purchase/once_user', exc=requests.exceptions.ConnectTimeout)
+    headers = {'Idempotency-Key': uuid.uuid4().hex}
+    assert test_client.post('/sale', json={"name": "once_good", "customer_user": "once_user"}, headers=headers).status_code == 500
+    purchase = mock_external_requests.post('http://localhost:5001/purchase/once_user', json={"new_balance": 4})
+    response = test_client.post('/sale', json={"name": "once_good", "customer_user": "once_user"}, headers=headers)
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+
+    # The debit that timed out is settled under its own key and refunded
+    refund = mock_external_requests.post('http://localhost:5001/charge_wallet/once_user', json={})
+    process_sale_outbox(app)
+    assert purchase.call_count == 2 and refund.call_count == 1
+    assert purchase.request_history[0].headers['Idempotency-Key'] != purchase.request_history[1].headers['Idempotency-Key']
+
+def test_sale_transaction_out_of_stock(test_client, mock_external_requests):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/sold_out', json={"id": 2, "price": 10})
+    mock_external_requests.post('http://localhost:5002/inventory/reserve/2', json={"error": "Insufficient stock"}, status_code=409)
+    purchase = mock_external_requests.post('http://localhost:5001/purchase/eager_user', json={"new_balance": 90})
+
+    response = test_client.post('/sale', json={"name": "sold_out", "customer_user": "eager_user"})
+    assert response.status_code == 409
+    assert b"Item out of stock" in response.data
+    # The customer is never charged for an item that could not be reserved
+    assert purchase.call_count == 0
+
+def test_sale_transaction_expired_reservation(test_client, mock_external_requests, outbox):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/slow_good', json={"id": 3, "price": 10})
+    mock_external_requests.post('http://localhost:5002/inventory/reserve/3', json={"reservation_id": 5}, status_code=201)
+    mock_external_requests.post('http://localhost:5002/inventory/reservations/5/commit', json={}, status_code=404)
+    mock_external_requests.post('http://localhost:5001/purchase/slow_user', json={"new_balance": 90})
+    refund = mock_external_requests.post('http://localhost:5001/charge_wallet/slow_user', [
+        {'exc': requests.exceptions.ConnectionError('down')},
+        {'json': {}},
+    ])
+
+    response = test_client.post('/sale', json={"name": "slow_good", "customer_user": "slow_user"})
+    assert response.status_code == 409
+    with app.app_context():
+        assert Sales.query.filter_by(username="slow_user").count() == 0
+
+    # The refund is queued in the outbox, so it is retried until the customer gets the money back
+    process_sale_outbox(app)
+    process_sale_outbox(app)
+    assert refund.call_count == 2
+    assert refund.last_request.json() == {"amount": 10}
+
+# Test basket checkout
+def test_checkout(test_client, mock_external_requests):
+    mock_external_requests.post('http://localhost:5002/inventory/goods/bulk', json={
+        "Inventory": [{"id": 1, "name": "pen", "price": 2}, {"id": 2, "name": "book", "price": 10}],
+        "missing": []
+    })
+    mock_external_requests.post('http://localhost:5001/purchase/basket_user', json={"new_balance": 76})
+    deduct = mock_external_requests.post('http://localhost:5002/inventory/deduce/bulk', json={"results": []})
+
+    response = test_client.post('/checkout', json={
+        "customer_user": "basket_user",
+        "items": [{"name": "pen", "quantity": 2}, {"name": "book", "quantity": 1}, {"name": "pen", "quantity": 1}]
+    })
+    assert response.status_code == 200
+    assert response.json['total'] == 16
+    assert deduct.last_request.json() == {"items": [{"item_id": 1, "amount": 3}, {"item_id": 2, "amount": 1}]}
+    assert deduct.call_count == 1
+
+    with app.app_context():
+        assert Sales.query.filter_by(username="basket_user").count() == 4
+
+def test_checkout_refunds_on_stock_failure(test_client, mock_external_requests, outbox):
+    mock_external_requests.post('http://localhost:5002/inventory/goods/bulk', json={
+        "Inventory": [{"id": 1, "name": "pen", "price": 2}], "missing": []
+    })
+    mock_external_requests.post('http://localhost:5001/purchase/refund_user', json={"new_balance": 0})
+    mock_external_requests.post('http://localhost:5002/inventory/deduce/bulk', json={"error": "Insufficient stock"}, status_code=409)
+    refund = mock_external_requests.post('http://localhost:5001/charge_wallet/refund_user', [
+        {'exc': requests.exceptions.ConnectionError('down')},
+        {'json': {}},
+    ])
+
+    response = test_client.post('/checkout', json={"customer_user": "refund_user", "items": [{"name": "pen", "quantity": 5}]})
+    assert response.status_code == 409
+    assert b"Insufficient stock" in response.data
+
+    # The refund goes through the outbox, so a failed attempt is retried instead of losing the money
+    process_sale_outbox(app)
+    process_sale_outbox(app)
+    assert refund.call_count == 2
+    assert refund.last_request.json() == {"amount": 10}
+
+def test_checkout_debits_before_deducting(test_client, mock_external_requests):
+    mock_external_requests.post('http://localhost:5002/inventory/goods/bulk', json={
+        "Inventory": [{"id": 1, "name": "pen", "price": 2}], "missing": []
+    })
+    mock_external_requests.post('http://localhost:5001/purchase/broke_user', json={"error": "Insufficient funds"}, status_code=400)
+    deduct = mock_external_requests.post('http://localhost:5002/inventory/deduce/bulk', json={"results": []})
+
+    response = test_client.post('/checkout', json={"customer_user": "broke_user", "items": [{"name": "pen", "quantity": 3}]})
+    assert response.status_code == 400
+    assert b"Insufficient funds" in response.data
+    assert deduct.call_count == 0
+
+def test_checkout_revalidates_expired_items(test_client, mock_external_requests, monkeypatch):
+    item_cache.set('lamp', ('"lamp-v1"', {"id": 3, "name": "lamp", "price": 5}))
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + item_cache.ttl + 1)
+
+    revalidate = mock_external_requests.get('http://localhost:5002/inventory/goods/lamp', status_code=304)
+    bulk = mock_external_requests.post('http://localhost:5002/inventory/goods/bulk', json={
+        "Inventory": [{"id": 1, "name": "pen", "price": 2}], "missing": []
+    })
+    mock_external_requests.post('http://localhost:5001/purchase/lamp_user', json={"new_balance": 0})
+    mock_external_requests.post('http://localhost:5002/inventory/deduce/bulk', json={"results": []})
+
+    response = test_client.post('/checkout', json={"customer_user": "lamp_user", "items": [{"name": "lamp"}, {"name": "pen"}]})
+    assert response.status_code == 200
+    assert response.json['total'] == 7
+    assert revalidate.last_request.headers['If-None-Match'] == '"lamp-v1"'
+    assert bulk.last_request.json() == {"names": ["pen"]}
+
+def test_downstream_concurrently():
+    from downstream import DownstreamClient
+    client = DownstreamClient(concurrency=2)
+    barrier = threading.Barrier(2, timeout=5)
+
+    def call():
+        barrier.wait()  # only passes if both calls run at the same time
+        return 'ok'
+
+    def fail():
+        barrier.wait()
+        raise requests.exceptions.ConnectionError('down')
+
+    ok, error = client.concurrently(call, fail)
+    assert ok == 'ok'
+    assert isinstance(error, requests.exceptions.ConnectionError)
+
+def test_checkout_invalid_basket(test_client):
+    response = test_client.post('/checkout', json={"customer_user": "basket_user", "items": [{"name": "pen", "quantity": 0}]})
+    assert response.status_code == 400
+    for line in ({"name": "pen", "quantity": True}, {"name": ["pen"], "quantity": 1}, {"name": {"a": 1}}, {"name": 7}):
+        response = test_client.post('/checkout', json={"customer_user": "basket_user", "items": [line]})
+        assert response.status_code == 400, line
+        assert response.json['error'] == 'Invalid basket line'
+    assert test_client.post('/checkout', json={"customer_user": ["basket_user"], "items": [{"name": "pen"}]}).status_code == 400
+    assert test_client.post('/checkout', json=[{"name": "pen"}]).status_code == 400
+
+# Test the lookup cache
+def test_ttl_cache_eviction_and_expiry(monkeypatch):
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)  # evicts 'b', the least recently used
+    assert cache.get('b') is None
+    assert cache.stats()['evictions'] == 1
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 11)
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+def test_sale_uses_item_cache(test_client, mock_external_requests):
+    lookup = mock_external_requests.get('http://localhost:5002/inventory/goods/cached_good', json={"id": 4, "price": 5})
+    mock_reservation(mock_external_requests, 4)
+    mock_external_requests.post('http://localhost:5001/purchase/cache_user', json={"new_balance": 100})
+    hits = item_cache.stats()['hits']
+
+    for _ in range(3):
+        response = test_client.post('/sale', json={"name": "cached_good", "customer_user": "cache_user"})
+        assert response.status_code == 200
+    assert lookup.call_count == 1
+
+    # A change notification from the inventory service forces a fresh lookup
+    response = test_client.post('/cache/invalidate', json={"names": ["cached_good"]})
+    assert response.status_code == 200
+    test_client.post('/sale', json={"name": "cached_good", "customer_user": "cache_user"})
+    assert lookup.call_count == 2
+
+    stats = test_client.get('/cache/stats').json['items']
+    assert stats['hits'] - hits == 2
+    assert stats['size'] == 1
+
+def test_sale_revalidates_expired_item(test_client, mock_external_requests, monkeypatch):
+    lookup = mock_external_requests.get('http://localhost:5002/inventory/goods/etag_good', json={"id": 5, "price": 5}, headers={'ETag': '"v1"'})
+    mock_reservation(mock_external_requests, 5)
+    mock_external_requests.post('http://localhost:5001/purchase/cache_user', json={"new_balance": 100})
+    test_client.post('/sale', json={"name": "etag_good", "customer_user": "cache_user"})
+
+    # Once the entry expires, it is revalidated with If-None-Match and reused on 304
+    revalidations = item_cache.stats()['revalidations']
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + item_cache.ttl + 1)
+    mock_external_requests.get('http://localhost:5002/inventory/goods/etag_good', status_code=304)
+    response = test_client.post('/sale', json={"name": "etag_good", "customer_user": "cache_user"})
+    assert response.status_code == 200
+    revalidation = [r for r in mock_external_requests.request_history if r.method == 'GET'][-1]
+    assert revalidation.headers['If-None-Match'] == '"v1"'
+    assert item_cache.stats()['revalidations'] - revalidations == 1
+    assert lookup.call_count == 1
+
+def test_invalidation_reaches_every_worker(test_client, mock_external_requests):
+    lookup = mock_external_requests.get('http://localhost:5002/inventory/goods/shared_good', json={"id": 10, "price": 5})
+    other = mock_external_requests.get('http://localhost:5002/inventory/goods/other_good', json={"id": 11, "price": 6})
+    mock_reservation(mock_external_requests, 10)
+    mock_reservation(mock_external_requests, 11, reservation_id=2)
+    mock_external_requests.post('http://localhost:5001/purchase/shared_user', json={"new_balance": 100})
+
+    def buy(name):
+        assert test_client.post('/sale', json={"name": name, "customer_user": "shared_user"}).status_code == 200
+
+    buy('shared_good')
+    buy('other_good')
+    # An invalidation received by this process only drops the named item
+    test_client.post('/cache/invalidate', json={"names": ["shared_good"]})
+    buy('shared_good')
+    buy('other_good')
+    assert (lookup.call_count, other.call_count) == (2, 1)
+
+    # Another worker process received an invalidation: it bumped the shared version, not this process's caches
+    with app.app_context():
+        bump_version('inventory')
+        db.session.commit()
+    buy('shared_good')
+    buy('other_good')
+    assert (lookup.call_count, other.call_count) == (3, 2)
+
+def test_display_uses_catalog_cache(test_client, mock_external_requests):
+    catalog = mock_external_requests.get('http://localhost:5002/inventory/goods', json={"Inventory": []})
+    test_client.get('/display')
+    test_client.get('/display')
+    assert catalog.call_count == 1
+
+    test_client.post('/cache/invalidate')
+    test_client.get('/display')
+    assert catalog.call_count == 2
+
 # Test sales history
 def test_sales_history(test_client):
     response = test_client.get('/sales-history/customer_user')
     assert response.status_code == 200
     # Add more assertions based on your expected output
 
+def test_sales_history_pagination_and_summary(test_client):
+    with app.app_context():
+        db.session.add_all([
+            Sales(username='history_user', name='pen' if day % 2 else 'book', price=day, time=datetime(2024, 1, day))
+            for day in range(1, 6)
+        ])
+        db.session.commit()
+
+    first = test_client.get('/sales-history/history_user?limit=2').json
+    assert [sale['time'] for sale in first['sales_history']] == ['2024-01-01 00:00:00', '2024-01-02 00:00:00']
+    second = test_client.get(f'/sales-history/history_user?limit=2&after={first["next_cursor"]}').json
+    assert [sale['price'] for sale in second['sales_history']] == [3, 4]
+
+    newest = test_client.get('/sales-history/history_user?limit=1&order=desc').json
+    assert newest['sales_history'][0]['price'] == 5
+
+    ranged = test_client.get('/sales-history/history_user?start=2024-01-02&end=2024-01-04').json
+    assert [sale['price'] for sale in ranged['sales_history']] == [2, 3]
+    assert ranged['next_cursor'] is None
+
+    summary = test_client.get('/sales-history/history_user?summary=true').json
+    assert summary['count'] == 5
+    assert summary['total_spent'] == 15
+    assert summary['items'] == [{'good': 'pen', 'count': 3, 'total': 9}, {'good': 'book', 'count': 2, 'total': 6}]
+
+    assert test_client.get('/sales-history/history_user?start=yesterday').status_code == 400
+    assert test_client.get('/sales-history/history_user?limit=ten').json == {'error': 'Invalid limit'}
+    assert test_client.get('/sales-history/history_user?after=bogus').status_code == 400
+
+def test_sales_history_index(test_client):
+    with app.app_context():
+        indexes = db.inspect(db.engine).get_indexes('sales')
+    assert {'name': 'ix_sales_username_time', 'column_names': ['username', 'time']}.items() <= next(
+        index for index in indexes if index['name'] == 'ix_sales_username_time').items()
+
+# Test the asynchronous sale pipeline
+@pytest.fixture
+def outbox(monkeypatch):
+    # Process the outbox from the test instead of background threads, with no retry delay
+    monkeypatch.setattr(app.extensions['sale_worker'], 'threads', 0)
+    monkeypatch.setitem(app.config, 'OUTBOX_RETRY_BACKOFF', 0)
+    monkeypatch.setitem(app.config, 'OUTBOX_MAX_ATTEMPTS', 2)
+
+def test_async_sale(test_client, mock_external_requests, outbox):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/async_good', json={"id": 7, "price": 9})
+    purchase = mock_external_requests.post('http://localhost:5001/purchase/async_user', json={"new_balance": 1})
+    deduct = mock_external_requests.post('http://localhost:5002/inventory/deduce/7', json={"new_stock_count": 0})
+
+    response = test_client.post('/sale?async=true', json={"name": "async_good", "customer_user": "async_user"})
+    assert response.status_code == 202
+    status_url = response.json['status_url']
+    assert response.headers['Location'] == status_url
+    assert test_client.get(status_url).json['status'] == 'pending'
+
+    assert process_sale_outbox(app) == 1
+    status = test_client.get(status_url).json
+    assert status['status'] == 'completed'
+    assert status['price'] == 9
+    assert purchase.call_count == 1 and deduct.call_count == 1
+    with app.app_context():
+        assert Sales.query.filter_by(username='async_user').count() == 1
+
+    assert test_client.get('/sale/999999').status_code == 404
+
+def test_async_sale_retries_then_refunds(test_client, mock_external_requests, outbox):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/flaky_good', json={"id": 8, "price": 4})
+    mock_external_requests.post('http://localhost:5001/purchase/flaky_user', json={"new_balance": 1})
+    deduct = mock_external_requests.post('http://localhost:5002/inventory/deduce/8', status_code=503)
+    refund = mock_external_requests.post('http://localhost:5001/charge_wallet/flaky_user', json={})
+
+    sale_id = test_client.post('/sale?async=true', json={"name": "flaky_good", "customer_user": "flaky_user"}).json['sale_id']
+
+    # First attempt: wallet debited, stock deduction fails and is retried
+    process_sale_outbox(app)
+    assert test_client.get(f'/sale/{sale_id}').json['status'] == 'pending'
+    # Second attempt fails again and runs out of attempts, so the payment is rolled back
+    process_sale_outbox(app)
+    assert deduct.call_count == 2
+    process_sale_outbox(app)
+    status = test_client.get(f'/sale/{sale_id}').json
+    assert status['status'] == 'failed'
+    assert refund.call_count == 1
+    assert refund.last_request.json() == {"amount": 4}
+    assert refund.last_request.headers['Idempotency-Key'] == f'sale-order-{sale_id}-refund'
+
+def test_async_sale_survives_lost_responses(test_client, mock_external_requests, outbox, monkeypatch):
+    monkeypatch.setitem(app.config, 'OUTBOX_MAX_ATTEMPTS', 5)
+    mock_external_requests.get('http://localhost:5002/inventory/goods/lost_good', json={"id": 10, "price": 6})
+    debits, deductions = [], []
+    purchase = mock_external_requests.post('http://localhost:5001/purchase/lost_user', json=commit_then_time_out(debits))
+    deduct = mock_external_requests.post('http://localhost:5002/inventory/deduce/10', json=commit_then_time_out(deductions))
+
+    sale_id = test_client.post('/sale?async=true', json={"name": "lost_good", "customer_user": "lost_user"}).json['sale_id']
+
+    # The debit times out after the customer was charged, then the stock deduction does the same after the stock
+    # went down; each retry is answered from its key instead of being applied again
+    for _ in range(3):
+        process_sale_outbox(app)
+    assert test_client.get(f'/sale/{sale_id}').json['status'] == 'completed'
+    assert debits == [f'sale-order-{sale_id}-debit']
+    assert deductions == [f'sale-order-{sale_id}-stock']
+    assert purchase.call_count == 2 and deduct.call_count == 2
+    with app.app_context():
+        assert Sales.query.filter_by(username='lost_user').count() == 1
+
+def test_sale_refunds_debit_with_lost_response(test_client, mock_external_requests, outbox):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/timeout_good', json={"id": 11, "price": 5})
+    commit, release = mock_reservation(mock_external_requests, 11, reservation_id=11)
+    debits, refunds = [], []
+    purchase = mock_external_requests.post('http://localhost:5001/purchase/timeout_user', json=commit_then_time_out(debits))
+    refund = mock_external_requests.post('http://localhost:5001/charge_wallet/timeout_user', json=commit_then_time_out(refunds))
+
+    # The customer is charged but the response times out, so the sale fails and the unit goes back to stock
+    response = test_client.post('/sale', json={"name": "timeout_good", "customer_user": "timeout_user"})
+    assert response.status_code == 500
+    assert release.call_count == 1 and commit.call_count == 0
+
+    # The outbox replays the debit under the same key, which reports the charge, then refunds it exactly once
+    process_sale_outbox(app)
+    process_sale_outbox(app)
+    assert purchase.call_count == 2 and len(debits) == 1
+    assert purchase.last_request.headers['Idempotency-Key'] == debits[0]
+    assert refund.call_count == 2 and len(refunds) == 1
+    with app.app_context():
+        assert Sales.query.filter_by(username='timeout_user').count() == 0
+
+def test_checkout_debit_never_sent(test_client, mock_external_requests, outbox):
+    mock_external_requests.post('http://localhost:5002/inventory/goods/bulk', json={
+        "Inventory": [{"id": 1, "name": "pen", "price": 2}], "missing": []
+    })
+    purchase = mock_external_requests.post('http://localhost:5001/purchase/unsent_user', [
+        {'exc': requests.exceptions.ConnectionError('down')},
+        {'json': {"error": "Insufficient funds"}, 'status_code': 400},
+    ])
+    refund = mock_external_requests.post('http://localhost:5001/charge_wallet/unsent_user', json={})
+    deduct = mock_external_requests.post('http://localhost:5002/inventory/deduce/bulk', json={"results": []})
+
+    response = test_client.post('/checkout', json={"customer_user": "unsent_user", "items": [{"name": "pen"}]})
+    assert response.status_code == 500
+    assert deduct.call_count == 0
+
+    # Settling the debit shows the customer was never charged, so nothing is refunded
+    process_sale_outbox(app)
+    assert purchase.call_count == 2
+    assert purchase.request_history[0].headers['Idempotency-Key'] == purchase.last_request.headers['Idempotency-Key']
+    assert refund.call_count == 0
+
+def test_outbox_refund_survives_lost_response(test_client, mock_external_requests, outbox):
+    refunds = []
+    refund = mock_external_requests.post('http://localhost:5001/charge_wallet/lost_refund_user', json=commit_then_time_out(refunds))
+    with app.app_context():
+        order_id = queue_refund('lost_refund_user', 'lost_good', 6, 'Stock deduction failed').id
+
+    process_sale_outbox(app)
+    process_sale_outbox(app)
+    assert refund.call_count == 2
+    assert refunds == [f'sale-order-{order_id}-refund']
+    with app.app_context():
+        assert db.session.get(SaleOrder, order_id).status == 'failed'
+
+def test_async_sale_rejected(test_client, mock_external_requests, outbox):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/pricey_good', json={"id": 9, "price": 1000})
+    mock_external_requests.post('http://localhost:5001/purchase/broke_user', json={"error": "Insufficient funds"}, status_code=400)
+
+    sale_id = test_client.post('/sale?async=true', json={"name": "pricey_good", "customer_user": "broke_user"}).json['sale_id']
+    process_sale_outbox(app)
+    status = test_client.get(f'/sale/{sale_id}').json
+    assert status['status'] == 'failed'
+    assert status['error'] == 'Insufficient funds'
+
+def test_background_worker_threads():
+    from worker import BackgroundWorker
+    batches = []
+    done = threading.Event()
+
+    def process():
+        batches.append(1)
+        if len(batches) >= 2:
+            done.set()
+        return 0
+
+    worker = BackgroundWorker('test-worker', process, threads=1, interval=10)
+    worker.start()
+    worker.wake()
+    assert done.wait(5)
+    worker.stop()
+
+def test_gunicorn_worker_starts_outbox_worker(monkeypatch):
+    # Orders left by a recycled worker must not wait for the next asynchronous sale to be processed
+    import runpy
+    from types import SimpleNamespace
+    started = []
+    monkeypatch.setattr(app.extensions['sale_worker'], 'start', lambda: started.append(True))
+    config = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py'))
+    worker = SimpleNamespace(wsgi=app, pid=os.getpid(), forked_at=time.perf_counter(), log=SimpleNamespace(info=lambda *args: None))
+    config['post_worker_init'](worker)
+    assert started == [True]
+
+# Test analytics
+def test_rollups_follow_sales(test_client, mock_external_requests):
+    mock_external_requests.post('http://localhost:5002/inventory/goods/bulk', json={
+        "Inventory": [{"id": 1, "name": "mug", "price": 4}, {"id": 2, "name": "tea", "price": 3}], "missing": []
+    })
+    mock_external_requests.post('http://localhost:5001/purchase/rollup_user', json={"new_balance": 100})
+    mock_external_requests.post('http://localhost:5002/inventory/deduce/bulk', json={"results": []})
+    mock_external_requests.get('http://localhost:5002/inventory/goods/mug', json={"id": 1, "price": 4})
+    mock_reservation(mock_external_requests, 1)
+
+    test_client.post('/checkout', json={"customer_user": "rollup_user", "items": [{"name": "mug", "quantity": 2}, {"name": "tea", "quantity": 1}]})
+    test_client.post('/sale', json={"name": "mug", "customer_user": "rollup_user"})
+
+    today = datetime.utcnow().date().isoformat()
+    items = test_client.get(f'/analytics/items?start={today}&end={today}&name=mug').json['items']
+    assert items == [{'day': today, 'good': 'mug', 'units': 3, 'revenue': 12}]
+
+    customers = test_client.get(f'/analytics/top-customers?start={today}').json['customers']
+    assert {'username': 'rollup_user', 'purchases': 4, 'spent': 15} in customers
+
+    assert test_client.get('/analytics/items?start=today').status_code == 400
+
+def test_backfill_rollups(test_client):
+    with app.app_context():
+        db.session.add_all([
+            Sales(username='backfill_user', name='lamp', price=20, time=datetime(2023, 6, 1, 9)),
+            Sales(username='backfill_user', name='lamp', price=20, time=datetime(2023, 6, 1, 17)),
+            Sales(username='backfill_user', name='bulb', price=2, time=datetime(2023, 6, 2, 12)),
+        ])
+        db.session.commit()
+    etag = test_client.get('/analytics/items?start=2023-06-01&end=2023-06-02').headers['ETag']
+
+    result = app.test_cli_runner().invoke(args=['backfill-rollups'])
+    assert result.exit_code == 0
+
+    # The rebuild changes the ETag, so a client revalidating its copy gets the new rollups
+    response = test_client.get('/analytics/items?start=2023-06-01&end=2023-06-02', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    items = response.json['items']
+    assert items == [
+        {'day': '2023-06-01', 'good': 'lamp', 'units': 2, 'revenue': 40},
+        {'day': '2023-06-02', 'good': 'bulb', 'units': 1, 'revenue': 2},
+    ]
+    customers = test_client.get('/analytics/top-customers?start=2023-06-01&end=2023-06-02&limit=1').json['customers']
+    assert customers == [{'username': 'backfill_user', 'purchases': 3, 'spent': 42}]
+    assert test_client.get('/analytics/top-customers?limit=ten').json == {'error': 'Invalid limit'}
+
+def test_sales_history_conditional(test_client):
+    response = test_client.get('/sales-history/customer_user')
+    etag = response.headers['ETag']
+    response = test_client.get('/sales-history/customer_user', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+# Test the pooled downstream client
+def test_downstream_client_defaults():
+    from downstream import DownstreamClient
+    client = DownstreamClient(pool_size=4, connect_timeout=1, read_timeout=3, retries=1)
+    assert client.timeout == (1.0, 3.0)
+    assert client.adapter.max_retries.total == 1
+    assert 'POST' not in client.adapter.max_retries.allowed_methods
+
+def test_downstream_timeout(test_client, mock_external_requests):
+    mock_external_requests.get('http://localhost:5002/inventory/goods', exc=requests.exceptions.ConnectTimeout)
+    response = test_client.get('/display')
+    assert response.status_code == 500
+
+    response = test_client.get('/downstream/stats')
+    assert response.status_code == 200
+    assert response.json['errors'] >= 1
+    assert 'pool_hits' in response.json
+
+def test_sqlite_pragmas(test_client):
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+            assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+
+def test_metrics(test_client, mock_external_requests):
+    mock_external_requests.get('http://localhost:5002/inventory/goods/metric_good', status_code=404)
+    test_client.post('/sale', json={"name": "metric_good", "customer_user": "metric_user"})
+    body = test_client.get('/metrics').get_data(as_text=True)
+    assert 'http_requests_total{method="POST",route="/sale",status="404"}' in body
+    assert 'downstream_request_duration_seconds_count{method="GET",status="404",target="localhost:5002"}' in body
+
+
+def test_json_provider_encoders_agree():
+    from decimal import Decimal
+    from json_provider import JSONProvider, orjson, records
+    document = {
+        'sales': records(('good', 'price', 'time'), [('Laptop', 999.5, datetime(2024, 1, 2, 3, 4, 5, 678), 1)]),
+        'day': datetime(2024, 1, 2).date(),
+        'total': Decimal('999.50'),
+        'name': 'Café',
+    }
+    stdlib = JSONProvider(app, 'stdlib')
+    assert stdlib.loads(stdlib.dumps(document)) == {
+        'sales': [{'good': 'Laptop', 'price': 999.5, 'time': '2024-01-02 03:04:05'}],
+        'day': '2024-01-02',
+        'total': '999.50',
+        'name': 'Café',
+    }
+    if orjson is not None:
+        fast = JSONProvider(app, 'orjson')
+        assert fast.loads(fast.dumps_bytes(document)) == stdlib.loads(stdlib.dumps(document))
+        assert list(fast.loads(fast.dumps({'b': 1, 'a': 2}))) == ['a', 'b']
+    with pytest.raises(ValueError):
+        JSONProvider(app, 'yaml')
+
+def test_json_provider_bodies_match_for_non_ascii():
+    # Both encoders write text as UTF-8, so a non-ASCII row gives the same body either way
+    from json_provider import JSONProvider, orjson, records
+    rows = [('Café crème', 2.5, datetime(2024, 1, 2, 3, 4, 5), 1), ('日本茶', 4.0, datetime(2024, 1, 3), 2)]
+    document = {'sales_history': records(('good', 'price', 'time'), rows), 'next_cursor': None}
+    providers = [JSONProvider(app, 'stdlib')] + ([JSONProvider(app, 'orjson')] if orjson is not None else [])
+    with app.app_context():
+        bodies = {provider.response(document).get_data() for provider in providers}
+        assert bodies == {
+            '{"next_cursor":null,"sales_history":[{"good":"Café crème","price":2.5,"time":"2024-01-02 03:04:05"},'
+            '{"good":"日本茶","price":4.0,"time":"2024-01-03 00:00:00"}]}\n'.encode()
+        }
+        # A lone surrogate has no UTF-8 encoding and is escaped instead
+        assert {provider.response({'name': '\ud800'}).get_data() for provider in providers} == {b'{"name":"\\ud800"}\n'}
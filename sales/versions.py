@@ -0,0 +1,105 @@
+"""
+Table Versions
+
+This module provides the write counters behind the services' conditional GETs. Every table an endpoint reads from
+has a ``TableVersion`` row; every committed write to the table bumps it with :func:`bump_version`, in the same
+transaction, and :func:`conditional` turns the version into ``ETag`` and ``Last-Modified`` headers.
+
+"""
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, make_response, request
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from db_config import db
+
+
+class TableVersion(db.Model):
+    """
+    Write counter for a table, used to build ETags for the endpoints that read it.
+
+    Attributes:
+        table_name (str): Name of the versioned table.
+        version (int): Incremented by every committed write to the table.
+        updated_at (datetime): Time of the last write, served as ``Last-Modified``.
+    """
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+def bump_version(table_name):
+    """
+    Marks a table as changed, in the same transaction as the write itself.
+
+    Args:
+        table_name (str): Name of the table being written.
+    """
+    db.session.execute(
+        update(TableVersion)
+        .where(TableVersion.table_name == table_name)
+        .values(version=TableVersion.version + 1, updated_at=datetime.utcnow())
+    )
+
+
+def ensure_versions(*table_names):
+    """
+    Creates the version rows for the given tables if they do not exist yet.
+
+    Args:
+        *table_names (str): Names of the versioned tables.
+    """
+    for table_name in table_names:
+        if not db.session.get(TableVersion, table_name):
+            db.session.add(TableVersion(table_name=table_name, version=0, updated_at=datetime.utcnow()))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker created them first
+        db.session.rollback()
+
+
+def conditional(table_name):
+    """
+    Decorator adding ``ETag``/``Last-Modified`` headers to a read endpoint.
+
+    The ETag is derived from the table version and the request path and query string, so it is known before the
+    endpoint runs. A request whose ``If-None-Match`` (or, failing that, ``If-Modified-Since``) matches gets an empty
+    ``304 Not Modified`` without querying or serializing the body.
+
+    ``Last-Modified`` only has a resolution of one second, so it is rounded up to the second after the last write
+    once that second is over. Until then the truncated time is sent, and ``If-Modified-Since`` is compared with the
+    exact time of the write, so a write in the same second as a previous response is never reported as unchanged.
+
+    Args:
+        table_name (str): Name of the table the endpoint reads.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = db.session.get(TableVersion, table_name)
+            if version is None:
+                return view(*args, **kwargs)
+
+            etag = hashlib.md5(f'{table_name}:{version.version}:{request.full_path}'.encode()).hexdigest()
+            last_modified = version.updated_at.replace(microsecond=0)
+            if last_modified < version.updated_at and last_modified + timedelta(seconds=1) <= datetime.utcnow():
+                last_modified += timedelta(seconds=1)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = request.if_modified_since is not None and version.updated_at <= request.if_modified_since.replace(tzinfo=None)
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
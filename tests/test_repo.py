@@ -0,0 +1,69 @@
+"""
+Repository Checks
+
+Checks that span the services rather than belonging to one of them. Run them from the repository root with
+``python -m pytest tests``; each service's own tests run from its directory.
+
+"""
+import os
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVICES = ('customers', 'inventory', 'sales')
+
+# The services share these helper modules; each image is built from its own directory, so each holds a copy
+SHARED_MODULES = (
+    'db_config.py', 'gunicorn.conf.py', 'idempotency.py', 'json_provider.py', 'metrics.py', 'request_body.py', 'startup.py',
+    'versions.py', 'worker.py',
+)
+
+
+@pytest.mark.parametrize('module', SHARED_MODULES)
+def test_shared_modules_match(module):
+    copies = {}
+    for service in SERVICES:
+        path = os.path.join(ROOT, service, module)
+        if os.path.exists(path):
+            with open(path, 'rb') as stream:
+                copies[service] = stream.read()
+    assert len(copies) >= 2, f'{module} is not shared by two services'
+    first, content = next(iter(copies.items()))
+    for service, copy in copies.items():
+        assert copy == content, f'{service}/{module} differs from {first}/{module}; copy the change to every service'
+
+
+def test_compose_databases_not_shared():
+    # WAL keeps -wal and -shm files next to the database, so no other container may open the same file
+    yaml = pytest.importorskip('yaml')
+    with open(os.path.join(ROOT, 'docker-compose.yml')) as stream:
+        services = yaml.safe_load(stream)['services']
+
+    def storage(service):
+        volumes = {volume['source'] if isinstance(volume, dict) else volume.split(':')[0] for volume in service.get('volumes', [])}
+        environment = service.get('environment') or []
+        if isinstance(environment, dict):
+            environment = [f'{name}={value}' for name, value in environment.items()]
+        urls = {entry.split('=', 1)[1] for entry in environment if entry.startswith('DATABASE_URL=')}
+        return volumes | urls
+
+    owners = {}
+    for name, service in services.items():
+        for source in storage(service):
+            assert not source.endswith('.db'), f'{name} mounts the database file {source} instead of a directory'
+            assert source not in owners, f'{name} and {owners.get(source)} share {source}'
+            owners[source] = name
+
+
+def read_requirements(path):
+    """Returns the requirement lines of a pip requirements file, without comments and blank lines."""
+    with open(path) as stream:
+        return {line.split('#')[0].strip() for line in stream} - {''}
+
+
+def test_root_requirements_cover_services():
+    # A local install from the root file must be able to run every service
+    root = read_requirements(os.path.join(ROOT, 'requirements.txt'))
+    for service in SERVICES:
+        missing = read_requirements(os.path.join(ROOT, service, 'requirements.txt')) - root
+        assert not missing, f'requirements.txt lacks {", ".join(sorted(missing))} from {service}/requirements.txt'